@@ -0,0 +1,102 @@
+import numpy as np
+from typing import Dict, List, Tuple
+
+
+# Canonical edge types of the lane / vehicle / pedestrian heterograph
+etypes = [('l', 'successor', 'l'), ('l', 'proximal', 'l'), ('v', 'v_close_l', 'l'), ('v', 'v_interact_v', 'v'),
+          ('p', 'p_interact_v', 'v')]
+
+
+def num_valid_rows(masks: np.ndarray, offset: int) -> np.ndarray:
+    """
+    Returns index of the last row with a valid frame + offset for each sample, 0 for samples without one
+    :param masks: masks of first feature, shape [batch_size, num_rows, num_frames], 0 where valid
+    :param offset: offset added to index of last valid row
+    """
+    valid = (masks == 0).any(-1)
+    if valid.shape[1] == 0:
+        return np.zeros(len(valid), dtype=int)
+    last = valid.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1)
+    return np.where(valid.any(-1), last + offset, 0)
+
+
+def get_heterograph_edges(adj: np.ndarray, veh_masks: np.ndarray, ped_masks: np.ndarray,
+                          lane_node_masks: np.ndarray, lane_veh_adj_matrix: np.ndarray, succ_adj_matrix: np.ndarray,
+                          prox_adj_matrix: np.ndarray, lane_keep: np.ndarray = None,
+                          num_v: np.ndarray = None) -> Dict[Tuple[str, str, str], Tuple[np.ndarray, ...]]:
+    """
+    Computes edges of the lane / vehicle / pedestrian heterograph for a stack of samples. Vehicle nodes are the focal
+    vehicle followed by vehicles that are not fully masked out, pedestrian nodes are rows of the interaction graph
+    following the last vehicle and lane nodes are lanes that are not masked out.
+    :param adj: interaction graph adjacency, shape [batch_size, num_agents, num_agents]
+    :param veh_masks: vehicle masks of first feature, shape [batch_size, max_vehicles, num_frames]
+    :param ped_masks: pedestrian masks of first feature, shape [batch_size, max_pedestrians, num_frames]
+    :param lane_node_masks: lane node masks of first feature, shape [batch_size, max_nodes, polyline_length]
+    :param lane_veh_adj_matrix: vehicle-node masks, 0 where adjacent, shape [batch_size, max_vehicles, max_nodes]
+    :param succ_adj_matrix: successor adjacency, shape [batch_size, max_nodes, max_nodes]
+    :param prox_adj_matrix: proximal adjacency, shape [batch_size, max_nodes, max_nodes]
+    :param lane_keep: lanes to keep, False for masked out lanes, shape [batch_size, max_nodes]. All lanes by default.
+    :param num_v: number of vehicle rows in the interaction graph, including the focal vehicle, shape [batch_size].
+        Computed from veh_masks by default.
+    :return: dict with (batch index, source ids, destination ids) for each canonical edge type
+    """
+    batch_size, num_agents = adj.shape[:2]
+    if lane_keep is None:
+        lane_keep = np.ones(lane_node_masks.shape[:2], dtype=bool)
+    if num_v is None:
+        num_v = num_valid_rows(veh_masks, offset=2)
+
+    # Vehicle nodes, ids are positions in the vehicle node list
+    v_nodes_mask = (veh_masks.sum(-1) == veh_masks.shape[-1]) == False
+    v_keep = np.zeros((batch_size, num_agents), dtype=bool)
+    v_keep[:, 0] = True
+    v_keep[:, 1:v_nodes_mask.shape[1] + 1] = v_nodes_mask
+    v_ids = np.cumsum(v_keep, axis=1) - 1
+    l_ids = np.cumsum(lane_keep, axis=1) - 1
+
+    # Vehicle - vehicle edges
+    b, u, v = np.nonzero((adj != 0) & v_keep[:, :, None] & v_keep[:, None, :])
+    edges = {('v', 'v_interact_v', 'v'): (b, v_ids[b, u], v_ids[b, v])}
+
+    # Pedestrian - vehicle edges, pedestrian rows follow the vehicle rows in the interaction graph
+    num_p = num_valid_rows(ped_masks, offset=1)
+    rows = np.arange(num_agents)
+    p_rows = (rows[None, :] >= num_v[:, None]) & (rows[None, :] < (num_v + num_p)[:, None])
+    b, u, v = np.nonzero((adj == 1) & p_rows[:, :, None] & v_keep[:, None, :])
+    edges[('p', 'p_interact_v', 'v')] = (b, u - num_v[b], v_ids[b, v])
+
+    # Vehicle - lane edges, the focal vehicle is connected to all lanes that are not empty
+    lane_mask = (lane_node_masks == 0).any(-1)
+    lane_veh_adj_matrix = np.concatenate((~lane_mask[:, None, :] * 1, lane_veh_adj_matrix), axis=1)
+    b, u, v = np.nonzero((lane_veh_adj_matrix == 0) & v_keep[:, :lane_veh_adj_matrix.shape[1], None] &
+                         lane_keep[:, None, :])
+    edges[('v', 'v_close_l', 'l')] = (b, v_ids[b, u], l_ids[b, v])
+
+    # Lane - lane edges
+    lane_pairs = lane_keep[:, :, None] & lane_keep[:, None, :]
+    b, u, v = np.nonzero((succ_adj_matrix != 0) & lane_pairs)
+    edges[('l', 'successor', 'l')] = (b, l_ids[b, u], l_ids[b, v])
+    b, u, v = np.nonzero((prox_adj_matrix != 0) & lane_pairs)
+    edges[('l', 'proximal', 'l')] = (b, l_ids[b, u], l_ids[b, v])
+
+    return edges
+
+
+def to_edge_arrays(edges: Dict[Tuple[str, str, str], Tuple[np.ndarray, ...]]) -> Dict[str, np.ndarray]:
+    """
+    Converts edges of a single sample to arrays of (source, destination) pairs keyed by edge type, for storage
+    """
+    return {etype[1]: np.stack(edges[etype][1:], axis=-1) for etype in etypes}
+
+
+def from_edge_arrays(edge_arrays: List[Dict[str, np.ndarray]]) -> Dict[Tuple[str, str, str], Tuple[np.ndarray, ...]]:
+    """
+    Stacks stored edges of a batch of samples, inverse of to_edge_arrays
+    """
+    edges = {}
+    for etype in etypes:
+        pairs = [np.asarray(sample_edges[etype[1]], dtype=int).reshape(-1, 2) for sample_edges in edge_arrays]
+        b = np.repeat(np.arange(len(pairs)), [len(p) for p in pairs])
+        pairs = np.concatenate(pairs, axis=0)
+        edges[etype] = (b, pairs[:, 0], pairs[:, 1])
+    return edges
@@ -0,0 +1,84 @@
+from nuscenes import NuScenes
+from nuscenes.map_expansion.map_api import NuScenesMap
+from nuscenes.prediction import PredictHelper
+from typing import List
+
+
+class LazyNuScenes:
+    """
+    Stand-in for a NuScenes object that only loads the metadata tables on first access. version and dataroot are
+    available without loading, so datasets in load_data mode can be set up without touching the raw nuScenes metadata.
+    """
+
+    def __init__(self, version: str, dataroot: str):
+        """
+        :param version: nuScenes version, e.g. 'v1.0-trainval'
+        :param dataroot: nuScenes root directory
+        """
+        self.version = version
+        self.dataroot = dataroot
+        self._nusc = None
+
+    def load(self) -> NuScenes:
+        """
+        Returns the NuScenes object, loading it if needed
+        """
+        if self._nusc is None:
+            self._nusc = NuScenes(self.version, dataroot=self.dataroot)
+        return self._nusc
+
+    def __getattr__(self, name: str):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+
+class LazyPredictHelper:
+    """
+    Stand-in for a PredictHelper that is only built, along with the underlying NuScenes object, on first access
+    """
+
+    def __init__(self, nusc: LazyNuScenes):
+        """
+        :param nusc: lazily loaded NuScenes object
+        """
+        self.data = nusc
+        self._helper = None
+
+    def load(self) -> PredictHelper:
+        """
+        Returns the PredictHelper, building it if needed
+        """
+        if self._helper is None:
+            self._helper = PredictHelper(self.data.load())
+        return self._helper
+
+    def __getattr__(self, name: str):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+
+class LazyMaps(dict):
+    """
+    Dictionary of NuScenesMap objects keyed by map name, loading each map on first access
+    """
+
+    def __init__(self, dataroot: str):
+        """
+        :param dataroot: nuScenes root directory
+        """
+        super().__init__()
+        self.dataroot = dataroot
+
+    def load(self, map_names: List[str]):
+        """
+        Loads maps ahead of first access, e.g. before forking worker processes that should share them
+        """
+        for map_name in map_names:
+            if map_name not in self:
+                self[map_name] = NuScenesMap(map_name=map_name, dataroot=self.dataroot)
+
+    def __missing__(self, map_name: str) -> NuScenesMap:
+        self[map_name] = NuScenesMap(map_name=map_name, dataroot=self.dataroot)
+        return self[map_name]
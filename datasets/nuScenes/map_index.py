@@ -0,0 +1,305 @@
+from nuscenes.map_expansion.map_api import NuScenesMap
+from matplotlib.path import Path
+from shapely.geometry import box
+import numpy as np
+from typing import Dict, List, Tuple
+import pickle
+
+
+# Distance (m) within which a point is considered to lie on a polygon ring
+boundary_tol = 1e-9
+
+
+def ring_distance(points: np.ndarray, vertices: np.ndarray) -> np.ndarray:
+    """
+    Returns distance of each point to the closest segment of a closed ring
+    :param points: ndarray of points, shape [N, 2]
+    :param vertices: ring vertices with the first vertex repeated at the end, shape [M + 1, 2]
+    :return: distances, shape [N]
+    """
+    start, end = vertices[:-1], vertices[1:]
+    seg = end - start
+    seg_len_sq = np.maximum(np.sum(seg ** 2, axis=-1), np.finfo(float).tiny)
+    t = np.clip(np.sum((points[:, None, :] - start[None]) * seg[None], axis=-1) / seg_len_sq, 0, 1)
+    closest = start[None] + t[:, :, None] * seg[None]
+    return np.min(np.linalg.norm(points[:, None, :] - closest, axis=-1), axis=1)
+
+
+class MapPolygonIndex:
+    """
+    Per-map index of polygon layers (e.g. cross-walks and stop lines) for bulk point-in-polygon queries. Polygons are
+    extracted from the map api once, and stored with their bounding boxes, exterior and interior rings as matplotlib
+    paths and precomputed flag indices (stop line types), so that all lane poses of a sample can be flagged with a
+    few vectorized calls per polygon instead of a shapely call per pose and polygon.
+    """
+
+    def __init__(self, map_api: NuScenesMap, layer_names: List[str], stop_line_flags: Dict[str, int]):
+        """
+        Builds polygon index for a map
+        :param map_api: nuScenes map api
+        :param layer_names: polygon layers to index, in the order used for default flag indices
+        :param stop_line_flags: flag index for each stop line type
+        """
+        self.layer_names = layer_names
+        self.layer_tokens = {layer_name: [record['token'] for record in getattr(map_api, layer_name)]
+                             for layer_name in layer_names}
+        self.records = {}
+        for n, layer_name in enumerate(layer_names):
+            for record in getattr(map_api, layer_name):
+                polygon = map_api.extract_polygon(record['polygon_token'])
+                if layer_name == 'stop_line':
+                    flag = stop_line_flags[record['stop_line_type']]
+                else:
+                    flag = n
+                self.records[record['token']] = {
+                    'bounds': polygon.bounds,
+                    'exterior': Path(np.asarray(polygon.exterior.coords)[:, :2]),
+                    'interiors': [Path(np.asarray(interior.coords)[:, :2]) for interior in polygon.interiors],
+                    'flag': flag
+                }
+
+    def get_flags(self, poses: np.ndarray, record_tokens: Dict[str, List[str]], num_flags: int) -> np.ndarray:
+        """
+        Returns flags indicating whether poses lie within the polygons of each layer. For each layer, a pose takes the
+        flag of the first polygon (in the order of record_tokens) that contains it.
+        :param poses: ndarray of poses in global co-ordinates, shape [N, >=2]
+        :param record_tokens: polygon record tokens to query for each layer, e.g. records in radius of the agent
+        :param num_flags: number of flags
+        :return flags: ndarray of flags, shape [N, num_flags]
+        """
+        poses = np.asarray(poses, dtype=float).reshape(len(poses), -1)
+        flags = np.zeros((len(poses), num_flags))
+        if len(poses) == 0:
+            return flags
+
+        points = poses[:, :2]
+        for layer_name, tokens in record_tokens.items():
+            assigned = np.zeros(len(points), dtype=bool)
+            for token in tokens:
+                record = self.records[token]
+
+                # Bounding box pre-filter, skipping poses already assigned to a polygon of this layer
+                x_min, y_min, x_max, y_max = record['bounds']
+                candidates = np.where(~assigned &
+                                      (points[:, 0] >= x_min) & (points[:, 0] <= x_max) &
+                                      (points[:, 1] >= y_min) & (points[:, 1] <= y_max))[0]
+                if len(candidates) == 0:
+                    continue
+
+                # Point in polygon test, excluding holes
+                hits = candidates[self.contains(record, points[candidates])]
+                flags[hits, record['flag']] = 1
+                assigned[hits] = True
+
+        return flags
+
+    @staticmethod
+    def contains(record: Dict, points: np.ndarray) -> np.ndarray:
+        """
+        Point in polygon test for an indexed polygon, with the semantics of shapely Polygon.contains: points inside
+        holes or on the exterior or interior rings are not contained. matplotlib's contains_points alone accepts some
+        points on the rings, so points within boundary_tol of a ring are excluded explicitly.
+        :param record: indexed polygon
+        :param points: ndarray of points, shape [N, 2]
+        :return: mask of contained points, shape [N]
+        """
+        inside = record['exterior'].contains_points(points)
+        for interior in record['interiors']:
+            inside &= ~interior.contains_points(points)
+        for ring in [record['exterior']] + record['interiors']:
+            idcs = np.where(inside)[0]
+            if len(idcs) == 0:
+                break
+            inside[idcs[ring_distance(points[idcs], ring.vertices) <= boundary_tol]] = False
+
+        return inside
+
+    def get_hits(self, poses: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns all (pose, polygon) pairs where the pose lies within the polygon, over all indexed polygons
+        :param poses: ndarray of poses in global co-ordinates, shape [N, >=2]
+        :return: pose indices, layer indices, record positions within the layer and flag indices of each pair, sorted
+            by pose, layer and record position
+        """
+        points = np.asarray(poses, dtype=float).reshape(len(poses), -1)[:, :2]
+        hits = [np.zeros((0, 4), dtype=int)]
+        for n, layer_name in enumerate(self.layer_names):
+            for m, token in enumerate(self.layer_tokens[layer_name]):
+                record = self.records[token]
+                x_min, y_min, x_max, y_max = record['bounds']
+                candidates = np.where((points[:, 0] >= x_min) & (points[:, 0] <= x_max) &
+                                      (points[:, 1] >= y_min) & (points[:, 1] <= y_max))[0]
+                if len(candidates) == 0:
+                    continue
+                pose_idcs = candidates[self.contains(record, points[candidates])]
+                hits.append(np.stack((pose_idcs, np.full_like(pose_idcs, n), np.full_like(pose_idcs, m),
+                                      np.full_like(pose_idcs, record['flag'])), axis=1))
+
+        hits = np.concatenate(hits)
+        hits = hits[np.lexsort((hits[:, 2], hits[:, 1], hits[:, 0]))]
+        return hits[:, 0], hits[:, 1], hits[:, 2], hits[:, 3]
+
+
+class MapLaneCache:
+    """
+    Per-map cache of the lane graph, built once from the map api and stored on disk:
+        - bounding boxes and polygons of lane, lane connector and polygon layer records, for radius queries
+        - discretized lane polylines, concatenated with offsets for each lane
+        - lane flags, stored as all (lane pose, polygon) pairs where the pose lies within a polygon
+        - outgoing and incoming lane connectivity
+    Per-sample map extraction then reduces to a vectorized radius query and array slicing, with the same outputs as
+    the corresponding map api calls.
+    """
+
+    # Incremented when the cached contents change, so that caches built by earlier versions are rebuilt
+    version = 2
+
+    def __init__(self, map_api: NuScenesMap, resolution: float, polygon_layers: List[str],
+                 stop_line_flags: Dict[str, int]):
+        """
+        Builds lane graph cache for a map
+        :param map_api: nuScenes map api
+        :param resolution: resolution used to discretize lanes, in meters
+        :param polygon_layers: polygon layers used for lane flags, e.g. cross-walks and stop lines
+        :param stop_line_flags: flag index for each stop line type
+        """
+        self.map_name = map_api.map_name
+        self.resolution = resolution
+        self.polygon_layers = polygon_layers
+
+        # Records of lane and polygon layers, in map order
+        self.layers = {}
+        for layer_name in ['lane', 'lane_connector'] + polygon_layers:
+            records = getattr(map_api, layer_name)
+            polygons = [map_api.extract_polygon(record['polygon_token']) for record in records]
+            bounds = np.asarray([polygon.bounds if not polygon.is_empty else (np.inf, np.inf, -np.inf, -np.inf)
+                                 for polygon in polygons]).reshape(-1, 4)
+            self.layers[layer_name] = {'tokens': [record['token'] for record in records],
+                                       'rows': {record['token']: m for m, record in enumerate(records)},
+                                       'bounds': bounds,
+                                       'polygons': polygons}
+
+        # Discretized lanes
+        lane_tokens = self.layers['lane']['tokens'] + self.layers['lane_connector']['tokens']
+        discretized_lanes = map_api.discretize_lanes(lane_tokens, resolution)
+        self.lane_rows = {token: n for n, token in enumerate(lane_tokens)}
+        lane_poses = [np.asarray(discretized_lanes[token], dtype=float).reshape(-1, 3) for token in lane_tokens]
+        self.lane_offsets = np.zeros(len(lane_tokens) + 1, dtype=int)
+        self.lane_offsets[1:] = np.cumsum([len(poses) for poses in lane_poses])
+        self.lane_poses = np.concatenate(lane_poses) if len(lane_poses) > 0 else np.zeros((0, 3))
+
+        # Lane flags
+        polygon_index = MapPolygonIndex(map_api, polygon_layers, stop_line_flags)
+        self.hit_pose, self.hit_layer, self.hit_record, self.hit_flag = polygon_index.get_hits(self.lane_poses)
+
+        # Connectivity
+        self.connectivity = {token: map_api.connectivity[token] for token in lane_tokens
+                             if token in map_api.connectivity}
+
+    @staticmethod
+    def load(filename: str) -> 'MapLaneCache':
+        """
+        Loads lane graph cache from disk
+        """
+        with open(filename, 'rb') as handle:
+            return pickle.load(handle)
+
+    def save(self, filename: str):
+        """
+        Saves lane graph cache to disk
+        """
+        with open(filename, 'wb') as handle:
+            pickle.dump(self, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def get_records_in_radius(self, x: float, y: float, radius: float, layer_names: List[str]) -> Dict[str, List[str]]:
+        """
+        Same as NuScenesMap.get_records_in_radius (in 'intersect' mode) for cached layers. Bounding boxes are tested
+        for all records at once and the exact intersection test is only run for records whose bounding box crosses the
+        boundary of the patch.
+        :param x: x co-ordinate of the patch center in global co-ordinates
+        :param y: y co-ordinate of the patch center in global co-ordinates
+        :param radius: half side length of the square patch
+        :param layer_names: layers to query
+        :return: Dictionary of layer_name - tokens pairs
+        """
+        x_min, y_min, x_max, y_max = x - radius, y - radius, x + radius, y + radius
+        patch = box(x_min, y_min, x_max, y_max)
+        records = {}
+        for layer_name in layer_names:
+            layer = self.layers[layer_name]
+            bounds = layer['bounds']
+            overlap = (bounds[:, 0] <= x_max) & (bounds[:, 2] >= x_min) & (bounds[:, 1] <= y_max) & \
+                      (bounds[:, 3] >= y_min)
+            within = (bounds[:, 0] >= x_min) & (bounds[:, 2] <= x_max) & (bounds[:, 1] >= y_min) & \
+                     (bounds[:, 3] <= y_max)
+            in_patch = overlap & within
+            for m in np.where(overlap & ~within)[0]:
+                in_patch[m] = layer['polygons'][m].intersects(patch)
+            records[layer_name] = [layer['tokens'][m] for m in np.where(in_patch)[0]]
+
+        return records
+
+    def discretize_lanes(self, tokens: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Returns cached discretized lane polylines, as NuScenesMap.discretize_lanes at the cache resolution
+        :param tokens: lane and lane connector tokens
+        :return: Mapping from lane token to ndarray of poses along the lane, shape [N, 3]
+        """
+        lanes = {}
+        for token in tokens:
+            row = self.lane_rows[token]
+            lanes[token] = self.lane_poses[self.lane_offsets[row]:self.lane_offsets[row + 1]]
+        return lanes
+
+    def get_lane_flags(self, tokens: List[str], polygons: Dict[str, List[str]], num_flags: int) -> List[np.ndarray]:
+        """
+        Returns flags indicating whether each pose on the lanes lies within the given polygons. As in
+        MapPolygonIndex.get_flags, for each layer a pose takes the flag of the first containing polygon in map order.
+        :param tokens: lane and lane connector tokens
+        :param polygons: polygon record tokens for each layer, e.g. records in radius of the agent
+        :param num_flags: number of flags
+        :return lane_flags: list of ndarrays with flags, shape [len(lane), num_flags]
+        """
+        # Polygons that can set flags for this sample
+        queried = {}
+        for layer_name, layer_tokens in polygons.items():
+            queried[layer_name] = np.zeros(len(self.layers[layer_name]['tokens']), dtype=bool)
+            queried[layer_name][[self.layers[layer_name]['rows'][token] for token in layer_tokens]] = True
+
+        lane_flags = []
+        for token in tokens:
+            row = self.lane_rows[token]
+            start, end = self.lane_offsets[row], self.lane_offsets[row + 1]
+            flags = np.zeros((end - start, num_flags))
+            hit_start, hit_end = np.searchsorted(self.hit_pose, [start, end])
+            if hit_end > hit_start:
+                hit_pose = self.hit_pose[hit_start:hit_end]
+                hit_layer = self.hit_layer[hit_start:hit_end]
+                keep = np.zeros(len(hit_pose), dtype=bool)
+                for n, layer_name in enumerate(self.polygon_layers):
+                    if layer_name in queried:
+                        layer_hits = hit_layer == n
+                        keep[layer_hits] = queried[layer_name][self.hit_record[hit_start:hit_end][layer_hits]]
+
+                # First polygon of each layer containing the pose
+                _, first = np.unique(hit_pose[keep] * len(self.polygon_layers) + hit_layer[keep], return_index=True)
+                flags[hit_pose[keep][first] - start, self.hit_flag[hit_start:hit_end][keep][first]] = 1
+            lane_flags.append(flags)
+
+        return lane_flags
+
+    def get_outgoing_lane_ids(self, lane_token: str) -> List[str]:
+        """
+        Same as NuScenesMap.get_outgoing_lane_ids
+        """
+        if lane_token not in self.connectivity:
+            raise ValueError(f"{lane_token} is not a valid lane.")
+        return self.connectivity[lane_token]['outgoing']
+
+    def get_incoming_lane_ids(self, lane_token: str) -> List[str]:
+        """
+        Same as NuScenesMap.get_incoming_lane_ids
+        """
+        if lane_token not in self.connectivity:
+            raise ValueError(f"{lane_token} is not a valid lane.")
+        return self.connectivity[lane_token]['incoming']
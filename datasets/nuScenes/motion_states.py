@@ -0,0 +1,88 @@
+from nuscenes import NuScenes
+from nuscenes.eval.common.utils import quaternion_yaw
+from pyquaternion import Quaternion
+import numpy as np
+import pickle
+
+
+class MotionStateTable:
+    """
+    Dataset-wide table of motion states (velocity, acceleration, yaw rate) for every sample annotation, keyed by
+    annotation token. Motion states are computed once with finite differences over the full track of each instance,
+    with the same definitions as PredictHelper.get_velocity_for_agent, get_acceleration_for_agent and
+    get_heading_change_rate_for_agent: values are nan if an annotation has no previous annotation or if the previous
+    annotation is more than max_time_diff seconds older.
+    """
+
+    def __init__(self, nusc: NuScenes, max_time_diff: float = 1.5):
+        """
+        Builds motion state table
+        :param nusc: NuScenes object
+        :param max_time_diff: maximum time difference (s) to the previous annotation, as in PredictHelper
+        """
+        self.version = nusc.version
+        self.max_time_diff = max_time_diff
+
+        # Walk each instance's track in temporal order
+        tokens, prev_tokens, translations, yaws, times = [], [], [], [], []
+        for instance in nusc.instance:
+            ann_token = instance['first_annotation_token']
+            while ann_token != '':
+                annotation = nusc.get('sample_annotation', ann_token)
+                tokens.append(ann_token)
+                prev_tokens.append(annotation['prev'])
+                translations.append(annotation['translation'])
+                yaws.append(quaternion_yaw(Quaternion(annotation['rotation'])))
+                times.append(1e-6 * nusc.get('sample', annotation['sample_token'])['timestamp'])
+                ann_token = annotation['next']
+
+        self.rows = {token: n for n, token in enumerate(tokens)}
+        translations = np.asarray(translations, dtype=float).reshape(-1, 3)
+        yaws = np.asarray(yaws, dtype=float)
+        times = np.asarray(times, dtype=float)
+
+        # Annotations with a recent enough previous annotation
+        has_prev = np.asarray([prev_token != '' for prev_token in prev_tokens], dtype=bool)
+        prev_rows = np.asarray([self.rows[prev_token] if prev_token != '' else n
+                                for n, prev_token in enumerate(prev_tokens)], dtype=int)
+        time_diff = times - times[prev_rows]
+        valid = np.where(has_prev & (time_diff <= max_time_diff))[0]
+        dt = time_diff[valid]
+
+        # Finite differences
+        self.states = np.full((len(tokens), 3), np.nan)
+        diff = (translations[valid] - translations[prev_rows[valid]]) / dt[:, np.newaxis]
+        self.states[valid, 0] = np.linalg.norm(diff[:, :2], axis=1)
+        self.states[valid, 1] = (self.states[valid, 0] - self.states[prev_rows[valid], 0]) / dt
+        self.states[valid, 2] = self.angle_diff(yaws[valid], yaws[prev_rows[valid]], 2 * np.pi) / dt
+
+    @staticmethod
+    def load(filename: str) -> 'MotionStateTable':
+        """
+        Loads motion state table from disk
+        """
+        with open(filename, 'rb') as handle:
+            return pickle.load(handle)
+
+    def save(self, filename: str):
+        """
+        Saves motion state table to disk
+        """
+        with open(filename, 'wb') as handle:
+            pickle.dump(self, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def get(self, ann_token: str) -> np.ndarray:
+        """
+        Returns motion state of a sample annotation
+        :param ann_token: sample annotation token
+        :return: [velocity, acceleration, yaw_rate], nan where undefined
+        """
+        return np.array(self.states[self.rows[ann_token]])
+
+    @staticmethod
+    def angle_diff(x: np.ndarray, y: np.ndarray, period: float) -> np.ndarray:
+        """
+        Vectorized nuscenes.eval.common.utils.angle_diff: signed smallest angle difference from y to x
+        """
+        diff = (x - y + period / 2) % period - period / 2
+        return np.where(diff > np.pi, diff - (2 * np.pi), diff)
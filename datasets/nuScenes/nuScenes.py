@@ -1,4 +1,7 @@
 from datasets.interface import SingleAgentDataset
+from datasets.sample_store import SampleStore
+from datasets.nuScenes.motion_states import MotionStateTable
+from datasets.nuScenes.split_index import SplitIndex
 from nuscenes.eval.prediction.splits import get_prediction_challenge_split
 from nuscenes.prediction import PredictHelper
 import numpy as np
@@ -24,13 +27,35 @@ class NuScenesTrajectories(SingleAgentDataset):
         super().__init__(mode, data_dir)
         self.helper = helper
 
-        # nuScenes sample and instance tokens for prediction challenge
-        self.token_list = get_prediction_challenge_split(args['split'], dataroot=helper.data.dataroot)
+        # nuScenes sample and instance tokens for prediction challenge. These are read from the split index built while
+        # extracting data along with target agent annotations and groupings, so the raw metadata is not needed.
+        self.split = args['split']
+        self.index_dir = os.path.join(data_dir, 'index_' + self.split)
+        if not SplitIndex.exists(self.index_dir) and mode == 'extract_data':
+            token_list = get_prediction_challenge_split(args['split'], dataroot=helper.data.dataroot)
+            SplitIndex.build(self.index_dir, token_list, helper)
+        if SplitIndex.exists(self.index_dir):
+            self.index = SplitIndex(self.index_dir)
+            self.token_list = self.index.token_list
+        else:
+            self.index = None
+            self.token_list = get_prediction_challenge_split(args['split'], dataroot=helper.data.dataroot)
 
         # Past and prediction horizons
         self.t_h = args['t_h']
         self.t_f = args['t_f']
 
+        # Packed sample store, used instead of per-sample pickle files if it has been packed
+        self.store_dir = os.path.join(data_dir, 'store_' + self.split)
+        self.store = SampleStore(self.store_dir) if mode == 'load_data' and SampleStore.exists(self.store_dir) else None
+
+        # Motion state table: velocity, acceleration and yaw rate of all annotations in the dataset, computed once and
+        # stored in data_dir. Replaces per-annotation PredictHelper calls while extracting data.
+        self.motion_state_table = args['motion_state_table'] if 'motion_state_table' in args.keys() else False
+        self.motion_states = None
+        if self.motion_state_table and mode != 'load_data':
+            self.motion_states = self.get_motion_state_table()
+
     def __len__(self):
         """
         Size of dataset
@@ -80,6 +105,17 @@ class NuScenesTrajectories(SingleAgentDataset):
         :param idx: data index
         :return data: Dictionary with batched tensors
         """
+        if self.store is not None:
+            return self.store.get(self.token_list[idx])
+
+        return self.load_pickle(idx)
+
+    def load_pickle(self, idx: int) -> Dict:
+        """
+        Loads extracted data from the pickle file of a sample.
+        :param idx: data index
+        :return data: Dictionary with pre-processed data
+        """
         filename = os.path.join(self.data_dir, self.token_list[idx] + '.pickle')
 
         if not os.path.isfile(filename):
@@ -89,6 +125,52 @@ class NuScenesTrajectories(SingleAgentDataset):
             data = pickle.load(handle)
         return data
 
+    def pack_data(self, verbose: bool = False):
+        """
+        Packs per-sample pickle files of the split into a columnar, memory-mapped sample store
+        :param verbose: Whether to print progress
+        """
+        SampleStore.pack(self.store_dir, self.token_list, self.load_pickle, verbose)
+
+    def get_target_agent_annotation(self, i_t: str, s_t: str) -> Dict:
+        """
+        Returns translation and rotation of a target agent's sample annotation, from the split index if loaded
+        :param i_t: instance token
+        :param s_t: sample token
+        :return: Dictionary with 'translation' and 'rotation'
+        """
+        if self.index is not None:
+            return self.index.get_annotation(i_t + '_' + s_t)
+
+        return self.helper.get_sample_annotation(i_t, s_t)
+
+    def get_motion_state_table(self) -> MotionStateTable:
+        """
+        Loads motion state table from disk, building and saving it if it does not exist yet
+        """
+        filename = os.path.join(self.data_dir, 'motion_states_' + self.helper.data.version + '.pickle')
+        if os.path.isfile(filename):
+            return MotionStateTable.load(filename)
+
+        motion_states = MotionStateTable(self.helper.data)
+        motion_states.save(filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+        return motion_states
+
+    def get_motion_state(self, i_t: str, s_t: str) -> np.ndarray:
+        """
+        Returns motion state of an agent, from the motion state table if available
+        :param i_t: instance token
+        :param s_t: sample token
+        :return: [velocity, acceleration, yaw_rate], nan where undefined
+        """
+        if self.motion_states is not None:
+            return self.motion_states.get(self.helper.get_sample_annotation(i_t, s_t)['token'])
+
+        return np.asarray([self.helper.get_velocity_for_agent(i_t, s_t),
+                           self.helper.get_acceleration_for_agent(i_t, s_t),
+                           self.helper.get_heading_change_rate_for_agent(i_t, s_t)])
+
     def get_target_agent_future(self, idx: int) -> np.ndarray:
         """
         Extracts future trajectory for target agent
@@ -1,11 +1,16 @@
 import matplotlib.pyplot as plt
 from datasets.nuScenes.nuScenes_vector import NuScenesVector
+from datasets.nuScenes.map_index import MapLaneCache
+import datasets.nuScenes.reference as reference
+import datasets.nuScenes.heterograph as hg
 from nuscenes.prediction.input_representation.static_layers import correct_yaw , get_lanes_for_agent 
 from nuscenes.map_expansion.map_api import NuScenesMap
 from nuscenes.prediction import PredictHelper
 import numpy as np
 from typing import Dict, Tuple, Union, List
-from scipy.spatial.distance import cdist
+from scipy.spatial import cKDTree
+import glob
+import os
 
 
 class NuScenesGraphs(NuScenesVector):
@@ -24,23 +29,39 @@ class NuScenesGraphs(NuScenesVector):
         super().__init__(mode, data_dir, args, helper)
         self.traversal_horizon = args['traversal_horizon']
 
+        # Store edge lists of the lane / vehicle / pedestrian heterograph with each sample, so that the collate
+        # function does not need to recompute them from the dense adjacency matrices and masks every epoch
+        self.heterograph_edges = args['heterograph_edges'] if 'heterograph_edges' in args.keys() else False
+
         # Load dataset stats (max nodes, max agents etc.)
         if self.mode == 'extract_data':
             stats = self.load_stats()
             self.max_nbr_nodes = stats['max_nbr_nodes']
 
+            # Traversal labels recomputed for the previously extracted data are stale
+            for filename in glob.glob(os.path.join(self.data_dir, 'traversal_labels_' + self.split + '_*.npz')):
+                os.remove(filename)
+
+        # Traversal labels for the configured traversal horizon if it differs from the horizon used while extracting
+        # data, recomputed for all samples once and stored in data_dir/traversal_labels_<split>_<horizon>.npz
+        self.traversal_labels = None
+        if self.mode == 'load_data' and len(self.token_list) > 0:
+            if len(self.load_extracted(0)['inputs']['node_seq_gt']) != self.traversal_horizon:
+                self.traversal_labels = self.load_traversal_labels()
+
     def compute_stats(self, idx: int) -> Dict[str, int]:
         """
         Function to compute statistics for a given data point
         """
-        num_lane_nodes, max_nbr_nodes = self.get_map_representation(idx)
-        num_vehicles, num_pedestrians, num_objects = self.get_surrounding_agent_representation(idx)
+        map_elements, agent_elements = self.get_sample_elements(idx)
+        e_succ, e_prox = map_elements['e_succ'], map_elements['e_prox']
+        num_nbrs = [len(e_succ[i]) + len(e_prox[i]) for i in range(len(e_succ))]
         stats = {
-            'num_lane_nodes': num_lane_nodes,
-            'max_nbr_nodes': max_nbr_nodes,
-            'num_vehicles': num_vehicles,
-            'num_pedestrians': num_pedestrians,
-            'num_objects': num_objects
+            'num_lane_nodes': len(map_elements['lane_node_feats']),
+            'max_nbr_nodes': max(num_nbrs) if len(num_nbrs) > 0 else 0,
+            'num_vehicles': len(agent_elements['vehicles']),
+            'num_pedestrians': len(agent_elements['pedestrians']),
+            'num_objects': len(agent_elements['objects'])
         }
 
         return stats
@@ -53,6 +74,12 @@ class NuScenesGraphs(NuScenesVector):
         inputs = self.get_inputs(idx)
         ground_truth = self.get_ground_truth(idx)
         node_seq_gt, evf_gt = self.get_visited_edges(idx, inputs['map_representation'])
+        if self.verify_extraction:
+            fut_xy = self.get_target_agent_future(idx)
+            reference.check_equal('traversal labels', (node_seq_gt, evf_gt),
+                                  reference.get_visited_edges(fut_xy, inputs['map_representation'],
+                                                              self.traversal_horizon, self.polyline_length,
+                                                              self.polyline_resolution, self.map_extent))
         init_node = self.get_initial_node(inputs['map_representation'])
 
         ground_truth['evf_gt'] = evf_gt
@@ -61,24 +88,178 @@ class NuScenesGraphs(NuScenesVector):
         data = {'inputs': inputs, 'ground_truth': ground_truth}
         self.save_data(idx, data)
 
+    def load_data(self, idx: int) -> Dict:
+        """
+        Loads extracted data, with traversal labels for the configured traversal horizon if it differs from the one
+        used during extraction, so the horizon can be changed without re-extracting the dataset.
+        :param idx: data index
+        :return data: Dictionary with pre-processed data
+        """
+        data = super().load_data(idx)
+
+        if self.traversal_labels is not None:
+            evf_offsets = self.traversal_labels['evf_offsets']
+            evf_gt = np.zeros_like(data['ground_truth']['evf_gt'])
+            evf_gt[tuple(self.traversal_labels['evf_idcs'][evf_offsets[idx]:evf_offsets[idx + 1]].T)] = 1
+            node_seq_gt = self.traversal_labels['node_seq_gt'][idx].astype(data['inputs']['node_seq_gt'].dtype)
+            data['inputs']['node_seq_gt'] = node_seq_gt
+            data['ground_truth']['evf_gt'] = evf_gt
+
+        return data
+
+    def load_extracted(self, idx: int) -> Dict:
+        """
+        Loads extracted data as stored, from the packed sample store if it exists, from the pickle file otherwise
+        :param idx: data index
+        :return data: Dictionary with pre-processed data
+        """
+        return self.store.get(self.token_list[idx]) if self.store is not None else self.load_pickle(idx)
+
+    def load_traversal_labels(self) -> Dict[str, np.ndarray]:
+        """
+        Loads traversal labels of all samples of the split for the configured traversal horizon, recomputing them from
+        the stored lane graphs and ground truth trajectories if they have not been saved yet. Loaded when the dataset
+        is initialized, before any data loader workers are started, rather than recomputed for every sample loaded.
+        :return: Dictionary with
+            'node_seq_gt': node sequences, shape [num_samples, traversal_horizon]
+            'evf_idcs': indices of visited edges of all samples, concatenated, shape [num_visited_edges, 2]
+            'evf_offsets': offsets of the visited edges of each sample in evf_idcs, shape [num_samples + 1]
+        """
+        filename = os.path.join(self.data_dir, 'traversal_labels_' + self.split + '_' + str(self.traversal_horizon) +
+                                '.npz')
+        if os.path.isfile(filename):
+            with np.load(filename) as labels:
+                return dict(labels)
+
+        print('Traversal horizon differs from extracted data, recomputing traversal labels for ' + self.split + '...')
+        node_seq_gt = np.zeros((len(self.token_list), self.traversal_horizon), dtype=np.int16)
+        evf_idcs = []
+        for idx in range(len(self.token_list)):
+            data = self.load_extracted(idx)
+            node_seq, evf = self.get_traversal_labels(data['ground_truth']['traj'],
+                                                      data['inputs']['map_representation'])
+            node_seq_gt[idx] = node_seq
+            evf_idcs.append(np.argwhere(evf).astype(np.int16))
+        evf_offsets = np.zeros(len(evf_idcs) + 1, dtype=np.int64)
+        evf_offsets[1:] = np.cumsum([len(idcs) for idcs in evf_idcs])
+        labels = {'node_seq_gt': node_seq_gt, 'evf_idcs': np.concatenate(evf_idcs).reshape(-1, 2),
+                  'evf_offsets': evf_offsets}
+
+        # Write to a temporary file first, so that an interrupted run does not leave a partial file behind
+        tmp_filename = filename[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_filename, **labels)
+        os.replace(tmp_filename, filename)
+
+        return labels
+
     def get_inputs(self, idx: int) -> Dict:
         inputs = super().get_inputs(idx)
         a_n_masks = self.get_agent_node_masks(inputs['map_representation'], inputs['surrounding_agent_representation'])
-        inputs['agent_node_masks'] = a_n_masks
+
+        if self.heterograph_edges:
+            inputs['heterograph_edges'] = self.get_heterograph_edges(inputs['map_representation'],
+                                                                     inputs['surrounding_agent_representation'],
+                                                                     a_n_masks)
+
+        # Store (node, agent) pairs that are not masked in ragged mode
+        if self.ragged:
+            inputs['agent_node_edges'] = {k: np.argwhere(v == 0) for k, v in a_n_masks.items()}
+        else:
+            inputs['agent_node_masks'] = a_n_masks
         return inputs
 
+    @staticmethod
+    def get_heterograph_edges(map_representation: Dict, surrounding_agent_representation: Dict,
+                              agent_node_masks: Dict) -> Dict[str, np.ndarray]:
+        """
+        Computes edges of the lane / vehicle / pedestrian heterograph built by the collate function, without lane or
+        frame masking. Node ids do not depend on padding, so edges are the same in ragged and padded mode.
+        :param map_representation: map representation, with dense or COO lane adjacency
+        :param surrounding_agent_representation: surrounding agent representation, with dense or COO adjacency
+        :param agent_node_masks: dense agent-node masks
+        :return: (source, destination) pairs for each edge type, shape [num_edges, 2]
+        """
+        lane_node_masks = map_representation['lane_node_masks']
+        agents = surrounding_agent_representation
+        num_nodes = len(lane_node_masks)
+        num_agents = 1 + len(agents['vehicle_masks']) + len(agents['pedestrian_masks']) + len(agents['object_masks'])
+
+        # Dense adjacency from COO adjacency in ragged mode
+        adj_matrices = {}
+        for key in ['succ', 'prox']:
+            if key + '_adj_matrix' in map_representation:
+                adj_matrices[key] = map_representation[key + '_adj_matrix']
+            else:
+                edges = map_representation[key + '_edges']
+                adj_matrices[key] = np.zeros((num_nodes, num_nodes), dtype=np.uint8)
+                adj_matrices[key][edges[:, 0], edges[:, 1]] = 1
+        if 'adj_matrix' in agents:
+            adj_matrix = agents['adj_matrix']
+        else:
+            adj_matrix = np.zeros((num_agents, num_agents), dtype=np.uint8)
+            adj_matrix[agents['adj_edges'][:, 0], agents['adj_edges'][:, 1]] = 1
+
+        edges = hg.get_heterograph_edges(adj_matrix[np.newaxis],
+                                         agents['vehicle_masks'][np.newaxis, :, :, 0],
+                                         agents['pedestrian_masks'][np.newaxis, :, :, 0],
+                                         lane_node_masks[np.newaxis, :, :, 0],
+                                         agent_node_masks['vehicles'].transpose(1, 0)[np.newaxis],
+                                         adj_matrices['succ'][np.newaxis],
+                                         adj_matrices['prox'][np.newaxis])
+
+        return hg.to_edge_arrays(edges)
+
     def get_ground_truth(self, idx: int) -> Dict:
         ground_truth = super().get_ground_truth(idx)
         return ground_truth
 
 
-    def get_map_representation(self, idx: int) -> Union[Tuple[int, int], Dict]:
+    def get_map_representation(self, idx: int) -> Dict:
         """
         Extracts map representation
         :param idx: data index
         :return: Returns an ndarray with lane node features, shape [max_nodes, polyline_length, 5] and an ndarray of
             masks of the same shape, with value 1 if the nodes/poses are empty,
         """
+        map_elements = self.get_sample_elements(idx)[0]
+        lane_node_feats = map_elements['lane_node_feats']
+        e_succ, e_prox = map_elements['e_succ'], map_elements['e_prox']
+
+        # Get edge lookup tables
+        max_nodes = len(lane_node_feats) if self.ragged else self.max_nodes
+        with self.timed('edges'):
+            s_next, edge_type = self.get_edge_lookup(e_succ, e_prox, max_nodes)
+
+            # Build adjacency matrix for heterograph - treating succ and prox edges separately and directional 
+            succ_adj_matrix, prox_adj_matrix = self.build_adj_mat_directional_with_types(s_next, edge_type)
+        
+        # Convert list of lane node feats to fixed size numpy array and masks
+        lane_node_feats, lane_node_masks = self.list_to_tensor(lane_node_feats, max_nodes, self.polyline_length, 8,
+                                                               self.ragged)
+
+        map_representation = {
+            'lane_node_feats': lane_node_feats,
+            'lane_node_masks': lane_node_masks, 
+            's_next': s_next,
+            'edge_type': edge_type, 
+            'succ_adj_matrix': succ_adj_matrix,
+            'prox_adj_matrix': prox_adj_matrix
+        }
+
+        # Store adjacency in COO format in ragged mode
+        if self.ragged:
+            del map_representation['succ_adj_matrix'], map_representation['prox_adj_matrix']
+            map_representation['succ_edges'] = np.argwhere(succ_adj_matrix)
+            map_representation['prox_edges'] = np.argwhere(prox_adj_matrix)
+
+        return map_representation
+
+    def get_map_elements(self, idx: int) -> Dict:
+        """
+        Extracts variable-length map elements
+        :param idx: data index
+        :return: Dictionary with list of lane node features and lists of successor and proximal edges for each node
+        """
         i_t, s_t = self.token_list[idx].split("_")
         map_name = self.helper.get_map_name_from_sample_token(s_t)
         map_api = self.maps[map_name]
@@ -104,8 +285,9 @@ class NuScenesGraphs(NuScenesVector):
         lane_node_feats, lane_ids = self.discard_poses_outside_extent(lane_node_feats, lane_ids)
 
         # Get edges:
-        e_succ = self.get_successor_edges(lane_ids, map_api)
-        e_prox = self.get_proximal_edges(lane_node_feats, e_succ)
+        with self.timed('edges'):
+            e_succ = self.get_successor_edges(lane_ids, self.lane_caches[map_name] if self.map_cache else map_api)
+            e_prox = self.get_proximal_edges(lane_node_feats, e_succ)
 
         # Concatentate flag indicating whether a node hassss successors to lane node feats
         lane_node_feats = self.add_boundary_flag(e_succ, lane_node_feats)
@@ -116,34 +298,7 @@ class NuScenesGraphs(NuScenesVector):
             e_succ = [[]]
             e_prox = [[]]
 
-        # While running the dataset class in 'compute_stats' mode:
-        if self.mode == 'compute_stats':
-
-            num_nbrs = [len(e_succ[i]) + len(e_prox[i]) for i in range(len(e_succ))]
-            max_nbrs = max(num_nbrs) if len(num_nbrs) > 0 else 0
-            num_nodes = len(lane_node_feats)
-
-            return num_nodes, max_nbrs
-
-        # Get edge lookup tables
-        s_next, edge_type = self.get_edge_lookup(e_succ, e_prox)
-
-        # Build adjacency matrix for heterograph - treating succ and prox edges separately and directional 
-        succ_adj_matrix, prox_adj_matrix = self.build_adj_mat_directional_with_types(s_next, edge_type)
-        
-        # Convert list of lane node feats to fixed size numpy array and masks
-        lane_node_feats, lane_node_masks = self.list_to_tensor(lane_node_feats, self.max_nodes, self.polyline_length, 8)
-
-        map_representation = {
-            'lane_node_feats': lane_node_feats,
-            'lane_node_masks': lane_node_masks, 
-            's_next': s_next,
-            'edge_type': edge_type, 
-            'succ_adj_matrix': succ_adj_matrix,
-            'prox_adj_matrix': prox_adj_matrix
-        }
-
-        return map_representation
+        return {'lane_node_feats': lane_node_feats, 'e_succ': e_succ, 'e_prox': e_prox}
 
     @staticmethod
     def build_adj_mat_directional_with_types(edges, edges_type):
@@ -171,10 +326,15 @@ class NuScenesGraphs(NuScenesVector):
         return edges_succ_adj, edges_prox_adj
     
     @staticmethod
-    def get_successor_edges(lane_ids: List[str], map_api: NuScenesMap) -> List[List[int]]:
+    def get_successor_edges(lane_ids: List[str], map_api: Union[NuScenesMap, MapLaneCache]) -> List[List[int]]:
         """
         Returns successor edge list for each node
         """
+        # First node of each lane
+        first_node_ids = {}
+        for node_id, lane_id in enumerate(lane_ids):
+            first_node_ids.setdefault(lane_id, node_id)
+
         e_succ = []
         for node_id, lane_id in enumerate(lane_ids):
             e_succ_node = []
@@ -183,8 +343,8 @@ class NuScenesGraphs(NuScenesVector):
             else:
                 outgoing_lane_ids = map_api.get_outgoing_lane_ids(lane_id)
                 for outgoing_id in outgoing_lane_ids:
-                    if outgoing_id in lane_ids:
-                        e_succ_node.append(lane_ids.index(outgoing_id))
+                    if outgoing_id in first_node_ids:
+                        e_succ_node.append(first_node_ids[outgoing_id])
 
             e_succ.append(e_succ_node)
 
@@ -194,24 +354,42 @@ class NuScenesGraphs(NuScenesVector):
     def get_proximal_edges(lane_node_feats: List[np.ndarray], e_succ: List[List[int]],
                            dist_thresh=4, yaw_thresh=np.pi/4) -> List[List[int]]:
         """
-        Returns proximal edge list for each node
+        Returns proximal edge list for each node. Node pairs within dist_thresh are found with a single KD-tree query
+        over all node poses, and the successor and yaw filters are applied to all candidate pairs at once.
         """
         e_prox = [[] for _ in lane_node_feats]
-        for src_node_id, src_node_feats in enumerate(lane_node_feats):
-            for dest_node_id in range(src_node_id + 1, len(lane_node_feats)):
-                if dest_node_id not in e_succ[src_node_id] and src_node_id not in e_succ[dest_node_id]:
-                    dest_node_feats = lane_node_feats[dest_node_id]
-                    pairwise_dist = cdist(src_node_feats[:, :2], dest_node_feats[:, :2])
-                    min_dist = np.min(pairwise_dist)
-                    if min_dist <= dist_thresh:
-                        yaw_src = np.arctan2(np.mean(np.sin(src_node_feats[:, 2])),
-                                             np.mean(np.cos(src_node_feats[:, 2])))
-                        yaw_dest = np.arctan2(np.mean(np.sin(dest_node_feats[:, 2])),
-                                              np.mean(np.cos(dest_node_feats[:, 2])))
-                        yaw_diff = np.arctan2(np.sin(yaw_src-yaw_dest), np.cos(yaw_src-yaw_dest))
-                        if np.absolute(yaw_diff) <= yaw_thresh:
-                            e_prox[src_node_id].append(dest_node_id)
-                            e_prox[dest_node_id].append(src_node_id)
+        if len(lane_node_feats) < 2:
+            return e_prox
+
+        # Node id of each pose
+        node_lens = np.asarray([len(feats) for feats in lane_node_feats])
+        poses = np.concatenate([feats[:, :3] for feats in lane_node_feats])
+        pose_node_ids = np.repeat(np.arange(len(lane_node_feats)), node_lens)
+
+        # Node pairs with minimum pose distance within threshold
+        pose_pairs = cKDTree(poses[:, :2]).query_pairs(dist_thresh, output_type='ndarray')
+        node_pairs = np.sort(pose_node_ids[pose_pairs], axis=1).reshape(-1, 2)
+        node_pairs = np.unique(node_pairs[node_pairs[:, 0] != node_pairs[:, 1]], axis=0)
+
+        # Discard pairs connected by successor edges
+        succ = np.zeros((len(lane_node_feats), len(lane_node_feats)), dtype=bool)
+        for src_node_id, successors in enumerate(e_succ):
+            succ[src_node_id, successors] = True
+        node_pairs = node_pairs[~succ[node_pairs[:, 0], node_pairs[:, 1]] & ~succ[node_pairs[:, 1], node_pairs[:, 0]]]
+
+        # Discard pairs with mean yaw differing by more than threshold
+        starts = np.concatenate(([0], np.cumsum(node_lens)[:-1]))
+        yaw = np.arctan2(np.add.reduceat(np.sin(poses[:, 2]), starts) / node_lens,
+                         np.add.reduceat(np.cos(poses[:, 2]), starts) / node_lens)
+        yaw_diff = yaw[node_pairs[:, 0]] - yaw[node_pairs[:, 1]]
+        yaw_diff = np.arctan2(np.sin(yaw_diff), np.cos(yaw_diff))
+        node_pairs = node_pairs[np.absolute(yaw_diff) <= yaw_thresh]
+
+        # Edge lists in ascending order of node ids, as with pairwise comparisons
+        for src_node_id, dest_node_id in node_pairs:
+            e_prox[src_node_id].append(int(dest_node_id))
+            e_prox[dest_node_id].append(int(src_node_id))
+        e_prox = [sorted(nbrs) for nbrs in e_prox]
 
         return e_prox
 
@@ -221,18 +399,23 @@ class NuScenesGraphs(NuScenesVector):
         Adds a binary flag to lane node features indicating whether the lane node has any successors.
         Serves as an indicator for boundary nodes.
         """
-        for n, lane_node_feat_array in enumerate(lane_node_feats):
-            flag = 1 if len(e_succ[n]) == 0 else 0
-            lane_node_feats[n] = np.concatenate((lane_node_feat_array, flag * np.ones((len(lane_node_feat_array), 1))),
-                                                axis=1)
+        if len(lane_node_feats) == 0:
+            return lane_node_feats
 
-        return lane_node_feats
+        # Flag all poses of the concatenated lane nodes at once
+        offsets = NuScenesVector.get_offsets(lane_node_feats)
+        flags = np.repeat([1. if len(e_succ_node) == 0 else 0. for e_succ_node in e_succ[:len(lane_node_feats)]],
+                          np.diff(offsets))
+        lane_node_feats = np.concatenate((np.concatenate(lane_node_feats), flags[:, np.newaxis]), axis=1)
 
-    def get_edge_lookup(self, e_succ: List[List[int]], e_prox: List[List[int]]):
+        return np.split(lane_node_feats, offsets[1:-1])
+
+    def get_edge_lookup(self, e_succ: List[List[int]], e_prox: List[List[int]], max_nodes: int):
         """
         Returns edge look up tables
         :param e_succ: Lists of successor edges for each node
         :param e_prox: Lists of proximal edges for each node
+        :param max_nodes: Number of rows of the look up tables, also used to offset goal states
         :return:
 
         s_next: Look-up table mapping source node to destination node for each edge. Each row corresponds to
@@ -243,8 +426,8 @@ class NuScenesGraphs(NuScenesVector):
         {0: No edge exists, 1: successor edge, 2: proximal edge, 3: terminal edge}
         """
 
-        s_next = np.zeros((self.max_nodes, self.max_nbr_nodes + 1))
-        edge_type = np.zeros((self.max_nodes, self.max_nbr_nodes + 1), dtype=int)
+        s_next = np.zeros((max_nodes, self.max_nbr_nodes + 1))
+        edge_type = np.zeros((max_nodes, self.max_nbr_nodes + 1), dtype=int)
 
         for src_node in range(len(e_succ)):
             nbr_idx = 0
@@ -264,7 +447,7 @@ class NuScenesGraphs(NuScenesVector):
                 nbr_idx += 1
 
             # Populate terminal edge
-            s_next[src_node, -1] = src_node + self.max_nodes
+            s_next[src_node, -1] = src_node + max_nodes
             edge_type[src_node, -1] = 3
 
         return s_next, edge_type
@@ -277,16 +460,15 @@ class NuScenesGraphs(NuScenesVector):
 
         # Unpack lane node poses
         node_feats = lane_graph['lane_node_feats']
-        node_feat_lens = np.sum(1 - lane_graph['lane_node_masks'][:, :, 0], axis=1)
-        node_poses = []
-        for i, node_feat in enumerate(node_feats):
-            if node_feat_lens[i] != 0:
-                node_poses.append(node_feat[:int(node_feat_lens[i]), :3])
+        node_poses, pose_valid = self.get_node_poses(lane_graph)
 
-        assigned_nodes = self.assign_pose_to_node(node_poses, np.asarray([0, 0, 0]), dist_thresh=3,
-                                                  yaw_thresh=np.pi / 4, return_multiple=True)
+        _, dist_vals, candidates = self.assign_poses_to_nodes(node_poses, pose_valid, np.zeros((1, 3)),
+                                                              dist_thresh=3, yaw_thresh=np.pi / 4)
+        assigned_nodes = np.where(candidates[0])[0]
+        if len(assigned_nodes) == 0:
+            assigned_nodes = np.asarray([np.argmin(dist_vals[0])])
 
-        init_node = np.zeros(self.max_nodes)
+        init_node = np.zeros(len(node_feats))
         init_node[assigned_nodes] = 1/len(assigned_nodes)
         return init_node
 
@@ -300,26 +482,35 @@ class NuScenesGraphs(NuScenesVector):
         :return: node_seq: Sequence of visited node ids.
                  evf: Look-up table of visited edges.
         """
+        fut_xy = self.get_target_agent_future(idx)
+
+        return self.get_traversal_labels(fut_xy, lane_graph)
+
+    def get_traversal_labels(self, fut_xy: np.ndarray, lane_graph: Dict) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Labels the nodes and edges of the lane graph visited by a future trajectory. Distances and yaw differences
+        between all interpolated future poses and all lane node poses are computed in a single batched call, leaving
+        only a scan over the pre-computed node assignments.
+
+        :param fut_xy: future trajectory of the target agent in the agent's frame, shape [num_steps, 2]
+        :param lane_graph: lane graph dictionary with lane node features and edge look-up tables
+        :return: node_seq: Sequence of visited node ids.
+                 evf: Look-up table of visited edges.
+        """
 
         # Unpack lane graph dictionary
         node_feats = lane_graph['lane_node_feats']
         s_next = lane_graph['s_next']
         edge_type = lane_graph['edge_type']
-
-        node_feat_lens = np.sum(1 - lane_graph['lane_node_masks'][:, :, 0], axis=1)
-        node_poses = []
-        for i, node_feat in enumerate(node_feats):
-            if node_feat_lens[i] != 0:
-                node_poses.append(node_feat[:int(node_feat_lens[i]), :3])
+        node_poses, pose_valid = self.get_node_poses(lane_graph)
 
         # Initialize outputs
         current_step = 0
         node_seq = np.zeros(self.traversal_horizon)
         evf = np.zeros_like(s_next)
 
-        # Get future trajectory:
-        i_t, s_t = self.token_list[idx].split("_")
-        fut_xy = self.helper.get_future_for_agent(i_t, s_t, 6, True)
+        # Interpolate future trajectory:
+        fut_xy = np.asarray(fut_xy, dtype=float)
         fut_interpolated = np.zeros((fut_xy.shape[0] * 10 + 1, 2))
         param_query = np.linspace(0, fut_xy.shape[0], fut_xy.shape[0] * 10 + 1)
         param_given = np.linspace(0, fut_xy.shape[0], fut_xy.shape[0] + 1)
@@ -331,120 +522,119 @@ class NuScenesGraphs(NuScenesVector):
 
         # Compute yaw values for future:
         fut_yaw = np.zeros(len(fut_xy))
-        for n in range(1, len(fut_yaw)):
-            fut_yaw[n] = -np.arctan2(fut_xy[n, 0] - fut_xy[n-1, 0], fut_xy[n, 1] - fut_xy[n-1, 1])
-
-        # Loop over future trajectory poses
-        query_pose = np.asarray([fut_xy[0, 0], fut_xy[0, 1], fut_yaw[0]])
-        current_node = self.assign_pose_to_node(node_poses, query_pose)
-        node_seq[current_step] = current_node
-        for n in range(1, len(fut_xy)):
-            query_pose = np.asarray([fut_xy[n, 0], fut_xy[n, 1], fut_yaw[n]])
-            dist_from_current_node = np.min(np.linalg.norm(node_poses[current_node][:, :2] - query_pose[:2], axis=1))
-
-            # If pose has deviated sufficiently from current node and is within area of interest, assign to a new node
-            padding = self.polyline_length * self.polyline_resolution / 2
-            if self.map_extent[0] - padding <= query_pose[0] <= self.map_extent[1] + padding and \
-                    self.map_extent[2] - padding <= query_pose[1] <= self.map_extent[3] + padding:
+        fut_yaw[1:] = -np.arctan2(np.diff(fut_xy[:, 0]), np.diff(fut_xy[:, 1]))
+        query_poses = np.concatenate((fut_xy, fut_yaw[:, np.newaxis]), axis=1)
 
-                if dist_from_current_node >= 1.5:
-                    assigned_node = self.assign_pose_to_node(node_poses, query_pose)
+        # Assign all future poses to nodes at once
+        assigned, dist_vals, _ = self.assign_poses_to_nodes(node_poses, pose_valid, query_poses)
 
-                    # Assign new node to node sequence and edge to visited edges
-                    if assigned_node != current_node:
+        # Trajectory is only labelled until it first leaves the area of interest
+        padding = self.polyline_length * self.polyline_resolution / 2
+        in_extent = (self.map_extent[0] - padding <= fut_xy[:, 0]) & (fut_xy[:, 0] <= self.map_extent[1] + padding) & \
+                    (self.map_extent[2] - padding <= fut_xy[:, 1]) & (fut_xy[:, 1] <= self.map_extent[3] + padding)
+        out_of_extent = np.where(~in_extent[1:])[0]
+        num_poses = out_of_extent[0] + 1 if len(out_of_extent) > 0 else len(fut_xy)
 
-                        if assigned_node in s_next[current_node]:
-                            nbr_idx = np.where(s_next[current_node] == assigned_node)[0]
-                            nbr_valid = np.where(edge_type[current_node] > 0)[0]
-                            nbr_idx = np.intersect1d(nbr_idx, nbr_valid)
-
-                            if edge_type[current_node, nbr_idx] > 0:
-                                evf[current_node, nbr_idx] = 1
-
-                        current_node = assigned_node
-                        if current_step < self.traversal_horizon-1:
-                            current_step += 1
-                            node_seq[current_step] = current_node
+        # Scan over future poses, assigning a new node once a pose has deviated sufficiently from the current node
+        current_node = assigned[0]
+        node_seq[current_step] = current_node
+        for n in range(1, num_poses):
+            assigned_node = assigned[n]
+            if dist_vals[n, current_node] >= 1.5 and assigned_node != current_node:
 
-            else:
-                break
+                # Assign new node to node sequence and edge to visited edges
+                evf[current_node, (s_next[current_node] == assigned_node) & (edge_type[current_node] > 0)] = 1
+                current_node = assigned_node
+                if current_step < self.traversal_horizon-1:
+                    current_step += 1
+                    node_seq[current_step] = current_node
 
         # Assign goal node and edge
-        goal_node = current_node + self.max_nodes
+        goal_node = current_node + len(node_feats)
         node_seq[current_step + 1:] = goal_node
         evf[current_node, -1] = 1
 
         return node_seq, evf
 
     @staticmethod
-    def assign_pose_to_node(node_poses, query_pose, dist_thresh=5, yaw_thresh=np.pi/3, return_multiple=False):
+    def get_node_poses(lane_graph: Dict) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns poses of all non-empty lane nodes along with a mask of valid poses
+        :param lane_graph: lane graph dictionary with lane node features and masks
+        :return node_poses: shape [num_nodes, polyline_length, 3]
+        :return pose_valid: shape [num_nodes, polyline_length], True for valid poses
         """
-        Assigns a given agent pose to a lane node. Takes into account distance from the lane centerline as well as
+        node_feat_lens = np.sum(1 - lane_graph['lane_node_masks'][:, :, 0], axis=1)
+        non_empty = node_feat_lens != 0
+        node_poses = np.asarray(lane_graph['lane_node_feats'][non_empty, :, :3], dtype=float)
+        pose_valid = np.arange(node_poses.shape[1])[np.newaxis, :] < node_feat_lens[non_empty, np.newaxis]
+
+        return node_poses, pose_valid
+
+    @staticmethod
+    def assign_poses_to_nodes(node_poses: np.ndarray, pose_valid: np.ndarray, query_poses: np.ndarray, dist_thresh=5,
+                              yaw_thresh=np.pi/3) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Assigns a batch of agent poses to lane nodes. Takes into account distance from the lane centerline as well as
         direction of motion.
+        :param node_poses: lane node poses, shape [num_nodes, polyline_length, 3]
+        :param pose_valid: mask of valid lane node poses, shape [num_nodes, polyline_length]
+        :param query_poses: agent poses, shape [num_queries, 3]
+        :param dist_thresh: distance threshold for candidate nodes
+        :param yaw_thresh: yaw difference threshold for candidate nodes
+        :return assigned: closest candidate node for each query, or closest node if there are no candidates
+        :return dist_vals: distance of each query from each node, shape [num_queries, num_nodes]
+        :return candidates: nodes within both thresholds, shape [num_queries, num_nodes]
         """
-        dist_vals = []
-        yaw_diffs = []
-
-        for i in range(len(node_poses)):
-            distances = np.linalg.norm(node_poses[i][:, :2] - query_pose[:2], axis=1)
-            dist_vals.append(np.min(distances))
-            idx = np.argmin(distances)
-            yaw_lane = node_poses[i][idx, 2]
-            yaw_query = query_pose[2]
-            yaw_diffs.append(np.arctan2(np.sin(yaw_lane - yaw_query), np.cos(yaw_lane - yaw_query)))
-
-        idcs_yaw = np.where(np.absolute(np.asarray(yaw_diffs)) <= yaw_thresh)[0]
-        idcs_dist = np.where(np.asarray(dist_vals) <= dist_thresh)[0]
-        idcs = np.intersect1d(idcs_dist, idcs_yaw)
-
-        if len(idcs) > 0:
-            if return_multiple:
-                return idcs
-            assigned_node_id = idcs[int(np.argmin(np.asarray(dist_vals)[idcs]))]
-        else:
-            assigned_node_id = np.argmin(np.asarray(dist_vals))
-            if return_multiple:
-                assigned_node_id = np.asarray([assigned_node_id])
+        distances = np.linalg.norm(node_poses[np.newaxis, :, :, :2] - query_poses[:, np.newaxis, np.newaxis, :2],
+                                   axis=-1)
+        distances = np.where(pose_valid[np.newaxis], distances, np.inf)
+        dist_vals = np.min(distances, axis=2)
+
+        # Yaw difference with the closest pose of each node
+        closest = np.argmin(distances, axis=2)
+        yaw_lane = np.take_along_axis(node_poses[:, :, 2], closest.T, axis=1).T
+        yaw_diff = yaw_lane - query_poses[:, 2:3]
+        yaw_diffs = np.arctan2(np.sin(yaw_diff), np.cos(yaw_diff))
 
-        return assigned_node_id
+        candidates = (dist_vals <= dist_thresh) & (np.absolute(yaw_diffs) <= yaw_thresh)
+        assigned = np.where(candidates.any(axis=1), np.argmin(np.where(candidates, dist_vals, np.inf), axis=1),
+                            np.argmin(dist_vals, axis=1))
+
+        return assigned, dist_vals, candidates
 
     @staticmethod
     def get_agent_node_masks(hd_map: Dict, agents: Dict, dist_thresh=10) -> Dict:
         """
         Returns key/val masks for agent-node attention layers. All agents except those within a distance threshold of
         the lane node are masked. The idea is to incorporate local agent context at each lane node.
+        Distances between all lane node poses and the last position of all agents are computed in one batched call.
         """
 
         lane_node_feats = hd_map['lane_node_feats']
         lane_node_masks = hd_map['lane_node_masks']
-        vehicle_feats = agents['vehicles']
-        vehicle_masks = agents['vehicle_masks']
-        ped_feats = agents['pedestrians']
-        ped_masks = agents['pedestrian_masks']
-
-        vehicle_node_masks = np.ones((len(lane_node_feats), len(vehicle_feats)))
-        ped_node_masks = np.ones((len(lane_node_feats), len(ped_feats)))
-
-        for i, node_feat in enumerate(lane_node_feats):
-            if (lane_node_masks[i] == 0).any():
-                node_pose_idcs = np.where(lane_node_masks[i][:, 0] == 0)[0]
-                node_locs = node_feat[node_pose_idcs, :2]
-
-                for j, vehicle_feat in enumerate(vehicle_feats):
-                    if (vehicle_masks[j] == 0).any():
-                        vehicle_loc = vehicle_feat[-1, :2]
-                        dist = np.min(np.linalg.norm(node_locs - vehicle_loc, axis=1))
-                        if dist <= dist_thresh:
-                            vehicle_node_masks[i, j] = 0
-
-                for j, ped_feat in enumerate(ped_feats):
-                    if (ped_masks[j] == 0).any():
-                        ped_loc = ped_feat[-1, :2]
-                        dist = np.min(np.linalg.norm(node_locs - ped_loc, axis=1))
-                        if dist <= dist_thresh:
-                            ped_node_masks[i, j] = 0
-
-        agent_node_masks = {'vehicles': vehicle_node_masks, 'pedestrians': ped_node_masks}
+
+        # Lane node poses, with distances to missing poses set to infinity
+        node_locs = lane_node_feats[:, :, :2]
+        pose_valid = lane_node_masks[:, :, 0] == 0
+        node_valid = (lane_node_masks == 0).any(axis=(1, 2))
+
+        agent_node_masks = {}
+        for agent_type, mask_key in [('vehicles', 'vehicle_masks'), ('pedestrians', 'pedestrian_masks')]:
+            agent_feats = agents[agent_type]
+            agent_masks = agents[mask_key]
+            agent_locs = agent_feats[:, -1, :2]
+            agent_valid = (agent_masks == 0).any(axis=(1, 2))
+
+            # Minimum distance between poses of each node and each agent, shape [num_nodes, num_agents]
+            dist = np.linalg.norm(node_locs[:, :, np.newaxis, :] - agent_locs[np.newaxis, np.newaxis, :, :], axis=-1)
+            dist = np.where(pose_valid[:, :, np.newaxis], dist, np.inf)
+            min_dist = dist.min(axis=1) if dist.shape[1] > 0 else np.full((len(node_locs), len(agent_locs)), np.inf)
+
+            masks = np.ones((len(lane_node_feats), len(agent_feats)))
+            masks[(min_dist <= dist_thresh) & node_valid[:, np.newaxis] & agent_valid[np.newaxis, :]] = 0
+            agent_node_masks[agent_type] = masks
+
         return agent_node_masks
 
     def visualize_graph(self, node_feats, s_next, edge_type, evf_gt, node_seq, fut_xy):
@@ -55,11 +55,7 @@ class NuScenesRaster(NuScenesTrajectories):
         """
         i_t, s_t = self.token_list[idx].split("_")
 
-        vel = self.helper.get_velocity_for_agent(i_t, s_t)
-        acc = self.helper.get_acceleration_for_agent(i_t, s_t)
-        yaw_rate = self.helper.get_heading_change_rate_for_agent(i_t, s_t)
-
-        motion_state = np.asarray([vel, acc, yaw_rate])
+        motion_state = self.get_motion_state(i_t, s_t)
         for i, val in enumerate(motion_state):
             if np.isnan(val):
                 motion_state[i] = 0
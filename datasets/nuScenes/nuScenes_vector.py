@@ -1,4 +1,8 @@
 from datasets.nuScenes.nuScenes import NuScenesTrajectories
+from datasets.nuScenes.map_index import MapPolygonIndex, MapLaneCache
+from datasets.nuScenes.lazy import LazyMaps
+import datasets.nuScenes.reference as reference
+from datasets.sample_store import SampleStore
 from nuscenes.prediction.input_representation.static_layers import correct_yaw , get_lanes_for_agent
 from nuscenes.map_expansion.map_api import NuScenesMap
 from nuscenes.map_expansion.arcline_path_utils import compute_segment_sign
@@ -7,11 +11,12 @@ from pyquaternion import Quaternion
 from nuscenes.prediction import PredictHelper
 import numpy as np
 from typing import Dict, Tuple, Union, List
-from shapely.geometry import Point
-from shapely.geometry.polygon import Polygon
 import os
 import pickle
+import time
 import torch
+from contextlib import contextmanager
+from collections import OrderedDict
 from scipy import spatial 
 import dgl
 import scipy.sparse as spp
@@ -29,6 +34,10 @@ class NuScenesVector(NuScenesTrajectories):
     NuScenes dataset class for single agent prediction, using the vector representation for maps and agents
     """
 
+    # Incremented when the contents of persisted agent tables change, so that tables built by earlier versions are
+    # rebuilt
+    agent_cache_version = 1
+
     def __init__(self, mode: str, data_dir: str, args: Dict, helper: PredictHelper):
         """
         Initialize predict helper, agent and scene representations
@@ -39,15 +48,65 @@ class NuScenesVector(NuScenesTrajectories):
         """
         super().__init__(mode, data_dir, args, helper)
 
-        # Initialize helper and maps
+        # Accumulated time (s) spent in each extraction stage, reported by the extraction engine
+        self.stage_timings = {}
+
+        # Initialize helper and maps. Maps are not needed to load data, so they are only loaded on first use in
+        # load_data mode.
         self.map_locs = ['singapore-onenorth', 'singapore-hollandvillage', 'singapore-queenstown', 'boston-seaport']
-        self.maps = {i: NuScenesMap(map_name=i, dataroot=self.helper.data.dataroot) for i in self.map_locs}
+        self.maps = LazyMaps(self.helper.data.dataroot)
+        if self.mode != 'load_data':
+            self.maps.load(self.map_locs)
+
 
         # Vector map parameters
         self.map_extent = args['map_extent']
         self.polyline_resolution = args['polyline_resolution']
         self.polyline_length = args['polyline_length']
 
+        # Polygon indices for cross-walks and stop lines, built for each map on first use
+        self.polygon_layers = ['ped_crossing', 'stop_line']
+        self.polygon_indices = {}
+
+        # Lane graph cache: discretized lanes, lane flags, connectivity and record bounds for each map, built once and
+        # stored in data_dir/map_cache. Replaces per-sample map api queries while extracting data.
+        self.map_cache = args['map_cache'] if 'map_cache' in args.keys() else False
+        self.lane_caches = {}
+        if self.map_cache and self.mode != 'load_data':
+            self.lane_caches = {i: self.get_lane_cache(i) for i in self.map_locs}
+
+        # Verify vectorized extraction steps against their reference implementations for every extracted sample. Slow,
+        # for checking extraction code changes only (see datasets.nuScenes.reference)
+        self.verify_extraction = args['verify_extraction'] if 'verify_extraction' in args.keys() else False
+
+        # Ragged mode: samples are stored with their actual number of lane nodes and agents, boolean masks and COO
+        # adjacency, and only padded to the batch maximum at collate time (see train_eval.utils.pad_ragged_batch)
+        self.ragged = args['ragged'] if 'ragged' in args.keys() else False
+
+        # Compact dtypes: input features are saved as feat_dtype (float32 or float16), masks and binary adjacency as
+        # uint8, node indices as int16 and edge types as int8 instead of float64 / int64. Ground truth trajectories are
+        # saved as float32, so that losses and metrics are not computed against rounded futures.
+        self.compact_dtypes = args['compact_dtypes'] if 'compact_dtypes' in args.keys() else False
+        self.feat_dtype = np.dtype(args['feat_dtype']) if 'feat_dtype' in args.keys() else np.dtype(np.float32)
+
+        # Spill cache: variable-length map and agent elements computed in compute_stats mode are stored in
+        # data_dir/spill and read back in extract_data mode, instead of querying the map api and helper again.
+        self.spill_cache = args['spill_cache'] if 'spill_cache' in args.keys() else False
+        self.spill_dir = os.path.join(self.data_dir, 'spill')
+        self.spilled_idx, self.spilled_elements = None, None
+
+        # Agent table cache: histories and motion states of all agents in a sample, shared by all target agents of the
+        # sample. Holds the agent_cache_size most recently used samples, optionally persisted to data_dir, in a
+        # directory keyed on the history length, the motion state source and the table format.
+        self.agent_cache_size = args['agent_cache_size'] if 'agent_cache_size' in args.keys() else 0
+        self.agent_cache_persist = args['agent_cache_persist'] if 'agent_cache_persist' in args.keys() else False
+        self.agent_cache_dir = os.path.join(self.data_dir, 'agent_cache_th' + str(self.t_h) + '_ms' +
+                                            str(int(self.motion_state_table)) + '_v' +
+                                            str(NuScenesVector.agent_cache_version))
+        self.agent_tables = OrderedDict()
+        if self.spill_cache and self.mode == 'compute_stats' and not os.path.isdir(self.spill_dir):
+            os.makedirs(self.spill_dir, exist_ok=True)
+
         # Load dataset stats (max nodes, max agents etc.)
         if self.mode == 'extract_data':
             stats = self.load_stats()
@@ -64,17 +123,119 @@ class NuScenesVector(NuScenesTrajectories):
         """
         Function to compute statistics for a given data point
         """
-        num_lane_nodes = self.get_map_representation(idx)
-        num_vehicles, num_pedestrians, num_objects = self.get_surrounding_agent_representation(idx)
+        map_elements, agent_elements = self.get_sample_elements(idx)
         stats = {
-            'num_lane_nodes': num_lane_nodes,
-            'num_vehicles': num_vehicles,
-            'num_pedestrians': num_pedestrians,
-            'num_objects': num_objects
+            'num_lane_nodes': len(map_elements['lane_node_feats']),
+            'num_vehicles': len(agent_elements['vehicles']),
+            'num_pedestrians': len(agent_elements['pedestrians']),
+            'num_objects': len(agent_elements['objects'])
         }
 
         return stats
 
+    def get_sample_elements(self, idx: int) -> Tuple[Dict, Dict]:
+        """
+        Returns variable-length map and agent elements for a sample, i.e. before padding them to the dataset maxima.
+        With the spill cache enabled, elements are written to the spill directory in compute_stats mode and read
+        back from it in extract_data mode.
+        :param idx: data index
+        :return map_elements, agent_elements: dictionaries with lists of lane node features and agent histories
+        """
+        if self.spilled_idx == idx:
+            return self.spilled_elements
+
+        filename = os.path.join(self.spill_dir, self.token_list[idx] + '.pickle')
+        if self.spill_cache and self.mode == 'extract_data' and os.path.isfile(filename):
+            with open(filename, 'rb') as handle:
+                elements = pickle.load(handle)
+        else:
+            elements = self.get_map_elements(idx), self.get_agent_elements(idx)
+            if self.spill_cache and self.mode == 'compute_stats':
+                with open(filename, 'wb') as handle:
+                    pickle.dump(elements, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+        self.spilled_idx, self.spilled_elements = idx, elements
+        return elements
+
+    def save_data(self, idx: int, data: Dict):
+        """
+        Saves extracted pre-processed data, converted to compact dtypes if set
+        :param idx: data index
+        :param data: pre-processed data
+        """
+        if self.compact_dtypes:
+            data = self.to_compact_dtypes(data)
+        super().save_data(idx, data)
+
+    def to_compact_dtypes(self, data: Dict, path: str = '') -> Dict:
+        """
+        Converts arrays in nested dictionary with pre-processed data to compact dtypes, based on their keys
+        :param data: Dictionary with pre-processed data
+        :param path: Keys of the parent dictionaries, joined with '/'
+        :return: Dictionary with pre-processed data in compact dtypes
+        """
+        compact_data = {}
+        for k, v in data.items():
+            key = path + '/' + k
+            if type(v) is dict:
+                v = self.to_compact_dtypes(v, key)
+            elif type(v) is np.ndarray:
+                if 'masks' in key or k in ['succ_adj_matrix', 'prox_adj_matrix', 'adj_matrix', 'evf_gt']:
+                    v = v.astype(np.uint8)
+                elif '_edges' in key or k in ['s_next', 'node_seq_gt']:
+                    v = v.astype(np.int16)
+                elif k == 'edge_type':
+                    v = v.astype(np.int8)
+                elif k in ['lane_node_feats', 'vehicles', 'pedestrians', 'objects', 'target_agent_representation']:
+                    v = v.astype(self.feat_dtype)
+                elif v.dtype == np.float64:
+                    v = v.astype(np.float32)
+            compact_data[k] = v
+
+        return compact_data
+
+    def save_sample_sizes(self, verbose: bool = False):
+        """
+        Saves number of lane nodes, surrounding agents and lane graph edges of each extracted sample of the split to
+        data_dir/sizes_<split>.npy, shape [num_samples, 3]. Read from the packed sample store if it exists, from the
+        per-sample pickle files otherwise. Used to bucket samples of similar size into batches.
+        :param verbose: Whether to print progress
+        """
+        store = SampleStore(self.store_dir) if SampleStore.exists(self.store_dir) else None
+        sizes = np.zeros((len(self.token_list), 3), dtype=np.int32)
+        for idx, token in enumerate(self.token_list):
+            data = store.get(token) if store is not None else self.load_pickle(idx)
+            sizes[idx] = self.get_sample_size(data)
+            if verbose and (idx + 1) % 1000 == 0:
+                print('sample sizes: ' + str(idx + 1) + '/' + str(len(self.token_list)))
+        np.save(os.path.join(self.data_dir, 'sizes_' + self.split + '.npy'), sizes)
+
+    def load_sample_sizes(self) -> np.ndarray:
+        """
+        Loads number of lane nodes, surrounding agents and lane graph edges of each sample, as saved by
+        save_sample_sizes
+        :return sizes: shape [num_samples, 3]
+        """
+        filename = os.path.join(self.data_dir, 'sizes_' + self.split + '.npy')
+        if not os.path.isfile(filename):
+            raise Exception('Could not find sample sizes. Please run preprocess.py with sample_sizes: True')
+        return np.load(filename)
+
+    @staticmethod
+    def get_sample_size(data: Dict) -> Tuple[int, int, int]:
+        """
+        Returns number of lane nodes, surrounding agents and lane graph edges of a pre-processed sample
+        :param data: Dictionary with pre-processed data, padded or ragged
+        """
+        map_representation = data['inputs']['map_representation']
+        agents = data['inputs']['surrounding_agent_representation']
+        num_nodes = np.sum(np.any(map_representation['lane_node_masks'][:, :, 0] == 0, axis=-1))
+        num_agents = sum([np.sum(np.any(agents[k][:, :, 0] == 0, axis=-1))
+                          for k in ['vehicle_masks', 'pedestrian_masks', 'object_masks']])
+        num_edges = np.sum(map_representation['edge_type'] > 0) if 'edge_type' in map_representation else 0
+
+        return num_nodes, num_agents, num_edges
+
     def load_data(self, idx: int) -> Dict:
         """
         Perform random flips if lag is set to true.
@@ -132,7 +293,7 @@ class NuScenesVector(NuScenesTrajectories):
                     points = np.array(lane_points[lane])
                     if len(points.shape) != 2:
                         continue
-                    lane_points[lane] = [self.global_to_local(origin, (pose[0], pose[1], 0)) for pose in points[:,:2] ]
+                    lane_points[lane] = list(self.global_to_local_batch(origin, points[:, :2]))
             arcline_path = map_api.get_arcline_path(lane_candidate)[0]
             arc_vector = list(arcline_path.values())
             arc_vector[2] = list(compute_segment_sign(arcline_path)) 
@@ -163,13 +324,35 @@ class NuScenesVector(NuScenesTrajectories):
 
         return lane_vector_paths
         
-    def get_map_representation(self, idx: int) -> Union[int, Dict]:
+    def get_map_representation(self, idx: int) -> Dict:
         """
         Extracts map representation
         :param idx: data index
         :return: Returns an ndarray with lane node features, shape [max_nodes, polyline_length, 5] and an ndarray of
             masks of the same shape, with value 1 if the nodes/poses are empty,
         """
+        lane_node_feats = self.get_sample_elements(idx)[0]['lane_node_feats']
+
+        # Convert list of lane node feats to fixed size numpy array and masks
+        max_nodes = len(lane_node_feats) if self.ragged else self.max_nodes
+        lane_node_feats, lane_node_masks = self.list_to_tensor(lane_node_feats, max_nodes, self.polyline_length, 7,
+                                                               self.ragged)
+
+        map_representation = {
+            'lane_node_feats': lane_node_feats,
+            'lane_node_masks': lane_node_masks,
+            # 'paths_ids': paths_ids,
+            # 'path_candidates': paths_vectors
+        }
+
+        return map_representation
+
+    def get_map_elements(self, idx: int) -> Dict:
+        """
+        Extracts variable-length map elements
+        :param idx: data index
+        :return: Dictionary with list of lane node features, each of shape [polyline_length, 7] at most
+        """
         i_t, s_t = self.token_list[idx].split("_")
         map_name = self.helper.get_map_name_from_sample_token(s_t)
         map_api = self.maps[map_name]
@@ -197,55 +380,39 @@ class NuScenesVector(NuScenesTrajectories):
         if len(lane_node_feats) == 0:
             lane_node_feats = [np.zeros((1, 7))]
 
-        # While running the dataset class in 'compute_stats' mode:
-        if self.mode == 'compute_stats':
-            return len(lane_node_feats)
+        return {'lane_node_feats': lane_node_feats}
 
-        # Convert list of lane node feats to fixed size numpy array and masks
-        lane_node_feats, lane_node_masks = self.list_to_tensor(lane_node_feats, self.max_nodes, self.polyline_length, 7)
-
-        map_representation = {
-            'lane_node_feats': lane_node_feats,
-            'lane_node_masks': lane_node_masks,
-            # 'paths_ids': paths_ids,
-            # 'path_candidates': paths_vectors
-        }
-
-        return map_representation
-
-    def get_surrounding_agent_representation(self, idx: int) -> \
-            Union[Tuple[int, int], Dict]:
+    def get_surrounding_agent_representation(self, idx: int) -> Dict:
         """
         Extracts surrounding agent representation
         :param idx: data index
         :return: ndarrays with surrounding pedestrian and vehicle track histories and masks for non-existent agents
         """
-
-        # Get vehicles and pedestrian histories for current sample
-        vehicles  = self.get_agents_of_type(idx, 'vehicle')
-        # paths_ids_v, paths_vectors_v = self.split_lanes(paths_vectors_v, self.polyline_length, paths_ids_v)
-        pedestrians = self.get_agents_of_type(idx, 'human')
-        objects = self.get_agents_of_type(idx, 'object')
-
-        # Discard poses outside map extent
-        vehicles = self.discard_poses_outside_extent(vehicles)
-        # paths_vectors_v = self.discard_poses_outside_extent(paths_vectors_v)
-        pedestrians = self.discard_poses_outside_extent(pedestrians)
-        objects = self.discard_poses_outside_extent(objects)
-
-        # While running the dataset class in 'compute_stats' mode:
-        if self.mode == 'compute_stats':
-            return len(vehicles), len(pedestrians), len(objects)
+        agent_elements = self.get_sample_elements(idx)[1]
+        vehicles = agent_elements['vehicles']
+        pedestrians = agent_elements['pedestrians']
+        objects = agent_elements['objects']
 
         # Convert to fixed size arrays for batching
-        vehicles, vehicle_masks = self.list_to_tensor(vehicles, self.max_vehicles, self.t_h * 2 + 1, 5)
-        pedestrians, pedestrian_masks = self.list_to_tensor(pedestrians, self.max_pedestrians, self.t_h * 2 + 1, 5) 
-        objects, object_masks = self.list_to_tensor(objects, self.max_objects, self.t_h * 2 + 1, 5)
+        max_vehicles = len(vehicles) if self.ragged else self.max_vehicles
+        max_pedestrians = len(pedestrians) if self.ragged else self.max_pedestrians
+        max_objects = len(objects) if self.ragged else self.max_objects
+        vehicles, vehicle_masks = self.list_to_tensor(vehicles, max_vehicles, self.t_h * 2 + 1, 5, self.ragged)
+        pedestrians, pedestrian_masks = self.list_to_tensor(pedestrians, max_pedestrians, self.t_h * 2 + 1, 5,
+                                                            self.ragged)
+        objects, object_masks = self.list_to_tensor(objects, max_objects, self.t_h * 2 + 1, 5, self.ragged)
         # max_length = max([len(array) for array in paths_vectors_v])
         # paths_vectors_v, paths_vectors_v_masks = self.list_to_tensor(paths_vectors_v, self.max_vehicles, max_length , 17)
 
-        # Get adjacency matrix
-        adj_matrix, len_adj = self.get_adj_matrix(vehicles,vehicle_masks.any(-1),pedestrians,pedestrian_masks.any(-1), objects, object_masks.any(-1))
+        # Get interaction graph edges
+        adj_edges, len_adj = self.get_adj_edges(vehicles, vehicle_masks.any(-1), pedestrians,
+                                                pedestrian_masks.any(-1), objects, object_masks.any(-1))
+        if self.verify_extraction:
+            adj_matrix = np.zeros((len_adj, len_adj))
+            adj_matrix[adj_edges[:, 0], adj_edges[:, 1]] = 1
+            reference.check_equal('adjacency', adj_matrix,
+                                  reference.get_adj_matrix(vehicles, vehicle_masks.any(-1), pedestrians,
+                                                           pedestrian_masks.any(-1), objects, object_masks.any(-1)))
         """ src, dst = np.nonzero(adj_matrix)
         if len(src) == 0 or len(dst) == 0:
             src, dst = np.array([0]), np.array([0]) """
@@ -257,61 +424,77 @@ class NuScenesVector(NuScenesTrajectories):
             'pedestrian_masks': pedestrian_masks,
             'objects': objects,
             'object_masks': object_masks,
-            'adj_matrix': adj_matrix,  
             'len_adj': len_adj,   
         }
 
+        # Store adjacency in COO format in ragged mode, as a fixed size adjacency matrix otherwise
+        if self.ragged:
+            surrounding_agent_representation['adj_edges'] = adj_edges
+        else:
+            max_agents = self.max_vehicles + self.max_pedestrians + self.max_objects + 1
+            adj_matrix = np.zeros((max_agents, max_agents))
+            adj_matrix[adj_edges[:, 0], adj_edges[:, 1]] = 1
+            surrounding_agent_representation['adj_matrix'] = adj_matrix
+
         return surrounding_agent_representation
 
-    def get_adj_matrix(self, vehicles, veh_masks, pedestrians, ped_masks, objects, obj_masks):
+    def get_agent_elements(self, idx: int) -> Dict:
+        """
+        Extracts variable-length surrounding agent elements
+        :param idx: data index
+        :return: Dictionary with lists of vehicle, pedestrian and object track histories
         """
-        Get adjacency matrix for the interaction graph
-        :param vehicles: ndarray with vehicle track histories, shape [max_vehicles, t_h * 2, 5]
-        :param pedestrians: ndarray with pedestrian track histories, shape [max_pedestrians, t_h * 2, 5]
-        :param objects: ndarray with object track histories, shape [max_objects, t_h * 2, 5]
-        :return: adjacency matrix 
-        """
-        # Remove empty rows 
-        veh_masks = ~veh_masks[np.any(~veh_masks,-1)] 
-        ped_masks = ~ped_masks[np.any(~ped_masks,-1)] 
-        obj_masks = ~obj_masks[np.any(~obj_masks,-1)]
-        index_veh = np.array( [ np.where(mask_i)[0][-1] if len(np.where(mask_i)[0])!=0 else -1 for mask_i in veh_masks])
-        index_ped = np.array( [ np.where(mask_i)[0][-1] if len(np.where(mask_i)[0])!=0 else -1 for mask_i in ped_masks])
-        index_obj = np.array( [ np.where(mask_i)[0][-1] if len(np.where(mask_i)[0])!=0 else -1 for mask_i in obj_masks])
-        # Adding focal agent to the graph
-        agents_last_positions = np.array([[0,0]])
-        
-        if len(veh_masks) > 0:
-            vehicles_masked = vehicles[np.arange(veh_masks.shape[0]), index_veh,:2]
-            agents_last_positions = np.concatenate((agents_last_positions,vehicles_masked),axis=0)
-        else:
-            vehicles_masked = np.array(([[]]))
-        if len(ped_masks) > 0:
-            ped_masked = pedestrians[np.arange(ped_masks.shape[0]), index_ped,:2]
-            agents_last_positions = np.concatenate((agents_last_positions,ped_masked),axis=0)
-        else:
-            ped_masked = np.array(([[]])) 
-        if len(obj_masks) > 0:
-            obj_masked = objects[np.arange(obj_masks.shape[0]), index_obj,:2]
-            agents_last_positions = np.concatenate((agents_last_positions,obj_masked),axis=0)
-        else:
-            obj_masked = np.array(([[]]))
-
-        # Compute distance between any pair of objects
-        dist_matrix = spatial.distance.cdist(agents_last_positions, agents_last_positions) 
 
-        # If distance between last positions is less than 40m, then they are adjacent
-        # Adj matrix between target agent and all neighbors
-        adj_matrix = np.zeros_like(dist_matrix) 
-        adj_matrix[dist_matrix < 20] = 1  
+        # Get vehicles and pedestrian histories for current sample
+        with self.timed('agent_histories'):
+            origin = self.get_target_agent_global_pose(idx)
+            vehicles  = self.get_agents_of_type(idx, 'vehicle', origin)
+            # paths_ids_v, paths_vectors_v = self.split_lanes(paths_vectors_v, self.polyline_length, paths_ids_v)
+            pedestrians = self.get_agents_of_type(idx, 'human', origin)
+            objects = self.get_agents_of_type(idx, 'object', origin)
 
-        # Convert to fixed size for batching 
-        len_adj = len(adj_matrix)
-        adj_array = np.zeros((self.max_vehicles+self.max_pedestrians+self.max_objects+1, self.max_vehicles+self.max_pedestrians+self.max_objects+1))
-        adj_array[:len_adj, :len_adj] = adj_matrix
+        # Discard poses outside map extent
+        vehicles = self.discard_poses_outside_extent(vehicles)
+        # paths_vectors_v = self.discard_poses_outside_extent(paths_vectors_v)
+        pedestrians = self.discard_poses_outside_extent(pedestrians)
+        objects = self.discard_poses_outside_extent(objects)
 
-        return adj_array, len_adj
+        return {'vehicles': vehicles, 'pedestrians': pedestrians, 'objects': objects}
 
+    @staticmethod
+    def get_adj_edges(vehicles, veh_masks, pedestrians, ped_masks, objects, obj_masks,
+                      dist_thresh=20) -> Tuple[np.ndarray, int]:
+        """
+        Get edges of the interaction graph. Nodes are the target agent (node 0) followed by all non-empty vehicles,
+        pedestrians and objects, and two nodes are adjacent if their last valid positions are closer than dist_thresh.
+        :param vehicles: ndarray with vehicle track histories, shape [max_vehicles, t_h * 2, 5]
+        :param veh_masks: ndarray with vehicle pose masks, True for empty poses, shape [max_vehicles, t_h * 2]
+        :param pedestrians: ndarray with pedestrian track histories, shape [max_pedestrians, t_h * 2, 5]
+        :param ped_masks: ndarray with pedestrian pose masks, True for empty poses, shape [max_pedestrians, t_h * 2]
+        :param objects: ndarray with object track histories, shape [max_objects, t_h * 2, 5]
+        :param obj_masks: ndarray with object pose masks, True for empty poses, shape [max_objects, t_h * 2]
+        :param dist_thresh: distance threshold for adjacency
+        :return: edges in COO format, in row-major order, shape [num_edges, 2], and number of nodes
+        """
+        # Last valid position of each non-empty agent, with the target agent at the origin
+        agents_last_positions = [np.zeros((1, 2))]
+        for feats, masks in [(vehicles, veh_masks), (pedestrians, ped_masks), (objects, obj_masks)]:
+            rows = np.nonzero(np.any(~masks, -1))[0]
+            valid = ~masks[rows]
+            last_idx = valid.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1)
+            agents_last_positions.append(feats[rows, last_idx, :2])
+        agents_last_positions = np.concatenate(agents_last_positions, axis=0)
+        len_adj = len(agents_last_positions)
+
+        # Pairs of agents within the distance threshold, including self loops
+        pairs = spatial.cKDTree(agents_last_positions).query_pairs(dist_thresh, output_type='ndarray')
+        dist = np.sqrt(np.sum((agents_last_positions[pairs[:, 0]] - agents_last_positions[pairs[:, 1]]) ** 2, axis=1))
+        pairs = pairs[dist < dist_thresh]
+        self_loops = np.repeat(np.arange(len_adj)[:, np.newaxis], 2, axis=1)
+        adj_edges = np.concatenate((self_loops, pairs, pairs[:, ::-1]), axis=0)
+        adj_edges = adj_edges[np.lexsort((adj_edges[:, 1], adj_edges[:, 0]))]
+
+        return adj_edges, len_adj
 
     def get_target_agent_global_pose(self, idx: int) -> Tuple[float, float, float]:
         """
@@ -337,9 +520,15 @@ class NuScenesVector(NuScenesTrajectories):
         """
         x, y, _ = global_pose
         radius = max(self.map_extent)
-        lanes = map_api.get_records_in_radius(x, y, radius, ['lane', 'lane_connector'])
-        lanes = lanes['lane'] + lanes['lane_connector']
-        lanes = map_api.discretize_lanes(lanes, self.polyline_resolution)
+        lane_graph = self.lane_caches[map_api.map_name] if self.map_cache else map_api
+        with self.timed('map_lookup'):
+            lanes = lane_graph.get_records_in_radius(x, y, radius, ['lane', 'lane_connector'])
+            lanes = lanes['lane'] + lanes['lane_connector']
+        with self.timed('lane_discretization'):
+            if self.map_cache:
+                lanes = lane_graph.discretize_lanes(lanes)
+            else:
+                lanes = map_api.discretize_lanes(lanes, self.polyline_resolution)
 
         return lanes
 
@@ -348,61 +537,127 @@ class NuScenesVector(NuScenesTrajectories):
         Gets polygon layers around the target agent e.g. crosswalks, stop lines
         :param global_pose: (x, y, yaw) or target agent in global co-ordinates
         :param map_api: nuScenes map api
-        :return polygons: Dictionary of polygon layers, each type as a list of shapely Polygons
+        :return polygons: Dictionary of polygon layers, each type as a list of record tokens, looked up in the polygon
+            index of the map
         """
         x, y, _ = global_pose
         radius = max(self.map_extent)
-        record_tokens = map_api.get_records_in_radius(x, y, radius, ['ped_crossing','stop_line'])
-        polygons = {k: [] for k in record_tokens.keys()}
-        for k, v in record_tokens.items():
-            for record_token in v:
-                polygon_token = map_api.get(k, record_token)['polygon_token']
-                polygons[k].append({record_token: map_api.extract_polygon(polygon_token)})
+        lane_graph = self.lane_caches[map_api.map_name] if self.map_cache else map_api
+        with self.timed('map_lookup'):
+            polygons = lane_graph.get_records_in_radius(x, y, radius, self.polygon_layers)
 
         return polygons
 
     def get_lane_node_feats(self, origin: Tuple, lanes: Dict[str, List[Tuple]],
-                            polygons: Dict[str, List[Polygon]], map_api: NuScenesMap) -> Tuple[List[np.ndarray], List[str]]:
+                            polygons: Dict[str, List[str]], map_api: NuScenesMap) -> Tuple[List[np.ndarray], List[str]]:
         """
         Generates vector HD map representation in the agent centric frame of reference
         :param origin: (x, y, yaw) of target agent in global co-ordinates
         :param lanes: lane centerline poses in global co-ordinates
-        :param polygons: stop-line and cross-walk polygons in global co-ordinates
+        :param polygons: stop-line and cross-walk polygon record tokens
         :return:
         """
 
-        # Convert lanes to list
-        lane_ids = [k for k, v in lanes.items()]
-        lanes = [v for k, v in lanes.items()]
+        with self.timed('lane_discretization'):
+
+            # Convert lanes to list
+            lane_ids = [k for k, v in lanes.items()]
+            lanes = [v for k, v in lanes.items()]
 
-        # Get flags indicating whether a lane lies on stop lines or crosswalks
-        lane_flags = self.get_lane_flags(lanes, polygons, map_api)
+            # Get flags indicating whether a lane lies on stop lines or crosswalks
+            if self.map_cache:
+                lane_flags = self.lane_caches[map_api.map_name].get_lane_flags(lane_ids, polygons,
+                                                                               len(mapping_dict.keys())-1)
+            else:
+                lane_flags = self.get_lane_flags(lanes, polygons, map_api)
+            if self.verify_extraction:
+                reference.check_equal('lane flags', lane_flags,
+                                      reference.get_lane_flags(lanes, polygons, map_api, mapping_dict,
+                                                               len(mapping_dict.keys())-1))
 
-        # Convert lane polylines to local coordinates:
-        lanes = [np.asarray([self.global_to_local(origin, pose) for pose in lane]) for lane in lanes]
+            if len(lanes) == 0:
+                return [], []
 
-        # Concatenate lane poses and lane flags
-        lane_node_feats = [np.concatenate((lanes[i], lane_flags[i]), axis=1) for i in range(len(lanes))]
+            # Convert all lane polylines to local coordinates at once and concatenate lane flags
+            offsets = self.get_offsets(lanes)
+            lanes = self.global_to_local_batch(origin, np.concatenate([np.asarray(lane).reshape(-1, 3)
+                                                                       for lane in lanes]))
+            lane_node_feats = np.concatenate((lanes, np.concatenate(lane_flags)), axis=1)
 
-        # Split lane centerlines into smaller segments:
-        lane_node_feats, lane_node_ids = self.split_lanes(lane_node_feats, self.polyline_length, lane_ids)
+            # Split lane centerlines into smaller segments:
+            segment_offsets, segment_lanes = self.get_segment_offsets(offsets, self.polyline_length)
+            lane_node_feats = np.split(lane_node_feats, segment_offsets[1:-1])
+            lane_node_ids = [lane_ids[idx] for idx in segment_lanes]
 
         return lane_node_feats, lane_node_ids
 
-    def get_agents_of_type(self, idx: int, agent_type: str) -> List[np.ndarray]:
+    def get_agents_of_type(self, idx: int, agent_type: str, origin: Tuple = None) -> List[np.ndarray]:
         """
         Returns surrounding agents of a particular class for a given sample
         :param idx: data index
         :param agent_type: 'human' or 'vehicle'
+        :param origin: global pose of the target agent, looked up if not provided
         :return: list of ndarrays of agent track histories.
         """
         i_t, s_t = self.token_list[idx].split("_")
-        map_name = self.helper.get_map_name_from_sample_token(s_t)
-        map_api = self.maps[map_name]
 
         # Get agent representation in global co-ordinates
-        origin = self.get_target_agent_global_pose(idx)
+        if origin is None:
+            origin = self.get_target_agent_global_pose(idx)
 
+        # Load all agents for sample
+        agent_table = self.get_agent_table(s_t)
+
+        # Filter for agent type and convert to target agent's frame of reference
+        agent_list = []
+        for n, category_name in enumerate(agent_table['category_names']):
+            if agent_type in category_name and agent_table['instance_tokens'][n] != i_t:
+                agent = self.global_to_local_batch(origin, agent_table['histories'][n])[:, :2]
+
+                # Flip history to have most recent time stamp last and add past motion states
+                xy = np.flip(agent, axis=0)
+                motion_states = agent_table['motion_states'][n][-len(xy):, :]
+                agent_list.append(np.concatenate((xy, motion_states), axis=1))
+
+        return agent_list
+
+    def get_agent_table(self, s_t: str) -> Dict:
+        """
+        Returns histories and motion states of all agents in a sample, from the LRU cache or disk if available
+        :param s_t: sample token
+        :return: agent table, see build_agent_table
+        """
+        if s_t in self.agent_tables:
+            self.agent_tables.move_to_end(s_t)
+            return self.agent_tables[s_t]
+
+        filename = os.path.join(self.agent_cache_dir, s_t + '.pickle')
+        if self.agent_cache_persist and os.path.isfile(filename):
+            with open(filename, 'rb') as handle:
+                agent_table = pickle.load(handle)
+        else:
+            agent_table = self.build_agent_table(s_t)
+            if self.agent_cache_persist:
+                os.makedirs(self.agent_cache_dir, exist_ok=True)
+                with open(filename + '.tmp', 'wb') as handle:
+                    pickle.dump(agent_table, handle, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(filename + '.tmp', filename)
+
+        # Evict least recently used samples
+        if self.agent_cache_size > 0:
+            self.agent_tables[s_t] = agent_table
+            while len(self.agent_tables) > self.agent_cache_size:
+                self.agent_tables.popitem(last=False)
+
+        return agent_table
+
+    def build_agent_table(self, s_t: str) -> Dict:
+        """
+        Extracts histories and motion states of all agents in a sample, independent of the target agent
+        :param s_t: sample token
+        :return: Dictionary with lists of instance tokens, category names, global track histories (most recent
+            time stamp first) and past motion states of shape [t_h * 2 + 1, 3] for each agent
+        """
         # Load all agents for sample
         agent_details = self.helper.get_past_for_sample(s_t, seconds=self.t_h, in_agent_frame=False, just_xy=False)
         agent_hist = self.helper.get_past_for_sample(s_t, seconds=self.t_h, in_agent_frame=False, just_xy=True)
@@ -418,40 +673,15 @@ class NuScenesVector(NuScenesTrajectories):
                 else:
                     agent_hist[ann_i_t] = present_pose
 
-        # Filter for agent type
-        agent_list = []
-        agent_i_ts = []
-        agent_yaw = []
+        agent_table = {'instance_tokens': [], 'category_names': [], 'histories': [], 'motion_states': []}
         for k, v in agent_details.items():
-            if v and agent_type in v[0]['category_name'] and v[0]['instance_token'] != i_t:
-                agent_list.append(agent_hist[k])
-                agent_i_ts.append(v[0]['instance_token'])
-                yaw = quaternion_yaw(Quaternion(agent_details[v[0]['instance_token']][0]['rotation']))
-                yaw = correct_yaw(yaw)
-                agent_yaw.append(yaw)
-
-        # Convert to target agent's frame of reference
-        paths_ids = {}
-        paths_vectors = []
-        for k, agent in enumerate(agent_list):
-            # if 'vehicle' in agent_type:
-            #     # Get path candidates for vehicles
-            #     paths_ids[agent_i_ts[k]] = self.get_lanes_for_agent(agent[0][0],agent[0][1],agent_yaw[k],map_api)  
-            #     path = self.get_path(paths_ids[agent_i_ts[k]], map_api, origin)
-            #     paths, paths_ids[agent_i_ts[k]] = self.split_lanes(path, self.polyline_length, paths_ids[agent_i_ts[k]])
-            #     paths_vectors.append(paths)
-            for n, pose in enumerate(agent):
-                local_pose = self.global_to_local(origin, (pose[0], pose[1], 0))
-                agent[n] = np.asarray([local_pose[0], local_pose[1]])
-
-        # Flip history to have most recent time stamp last and extract past motion states
-        for n, agent in enumerate(agent_list):
-            xy = np.flip(agent, axis=0)
-            motion_states = self.get_past_motion_states(agent_i_ts[n], s_t)
-            motion_states = motion_states[-len(xy):, :]
-            agent_list[n] = np.concatenate((xy, motion_states), axis=1)
-        
-        return agent_list 
+            if v:
+                agent_table['instance_tokens'].append(v[0]['instance_token'])
+                agent_table['category_names'].append(v[0]['category_name'])
+                agent_table['histories'].append(agent_hist[k])
+                agent_table['motion_states'].append(self.get_past_motion_states(v[0]['instance_token'], s_t, v))
+
+        return agent_table
 
     def discard_poses_outside_extent(self, pose_set: List[np.ndarray],
                                      ids: List[str] = None) -> Union[List[np.ndarray],
@@ -462,26 +692,43 @@ class NuScenesVector(NuScenesTrajectories):
         :param ids: annotation record tokens for pose_set. Only applies to lanes.
         :return: Updated pose set
         """
-        updated_pose_set = []
-        updated_ids = []
-
-        for m, poses in enumerate(pose_set):
-            flag = False
-            for n, pose in enumerate(poses):
-                if self.map_extent[0] <= pose[0] <= self.map_extent[1] and \
-                        self.map_extent[2] <= pose[1] <= self.map_extent[3]:
-                    flag = True
+        if len(pose_set) > 0:
+            offsets = self.get_offsets(pose_set)
+            poses = np.concatenate([np.asarray(poses)[:, :2].reshape(-1, 2) for poses in pose_set])
+            keep = self.get_polylines_in_extent(poses, offsets)
+        else:
+            keep = np.zeros(0, dtype=bool)
 
-            if flag:
-                updated_pose_set.append(poses)
-                if ids is not None:
-                    updated_ids.append(ids[m])
+        updated_pose_set = [poses for m, poses in enumerate(pose_set) if keep[m]]
 
         if ids is not None:
+            updated_ids = [ids[m] for m in range(len(pose_set)) if keep[m]]
             return updated_pose_set, updated_ids
         else:
             return updated_pose_set
 
+    def get_polylines_in_extent(self, poses: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+        """
+        Returns whether each of a set of concatenated polylines has any pose within the map extent
+        :param poses: concatenated polyline poses, shape [num_poses, >=2]
+        :param offsets: start of each polyline in poses, followed by num_poses, shape [num_polylines + 1]
+        :return: boolean array, shape [num_polylines]
+        """
+        in_extent = (self.map_extent[0] <= poses[:, 0]) & (poses[:, 0] <= self.map_extent[1]) & \
+                    (self.map_extent[2] <= poses[:, 1]) & (poses[:, 1] <= self.map_extent[3])
+        num_in_extent = np.concatenate(([0], np.cumsum(in_extent)))
+        return num_in_extent[offsets[1:]] > num_in_extent[offsets[:-1]]
+
+    @staticmethod
+    def get_offsets(polylines: List[np.ndarray]) -> np.ndarray:
+        """
+        Returns offsets of a list of polylines in their concatenation: start of each polyline, followed by the total
+        number of poses
+        """
+        offsets = np.zeros(len(polylines) + 1, dtype=int)
+        offsets[1:] = np.cumsum([len(polyline) for polyline in polylines])
+        return offsets
+
     def load_stats(self) -> Dict[str, int]:
         """
         Function to load dataset statistics like max surrounding agents, max nodes, max edges etc.
@@ -495,23 +742,33 @@ class NuScenesVector(NuScenesTrajectories):
 
         return stats
 
-    def get_past_motion_states(self, i_t, s_t):
+    @contextmanager
+    def timed(self, stage: str):
+        """
+        Accumulates wall-clock time spent in a given extraction stage into self.stage_timings
+        :param stage: name of the stage, e.g. 'map_lookup', 'lane_discretization', 'edges', 'agent_histories'
+        """
+        st_time = time.time()
+        try:
+            yield
+        finally:
+            self.stage_timings[stage] = self.stage_timings.get(stage, 0) + time.time() - st_time
+
+    def get_past_motion_states(self, i_t, s_t, hist: List[Dict] = None):
         """
         Returns past motion states: v, a, yaw_rate for a given instance and sample token over self.t_h seconds
+        :param hist: past annotation records of the agent over self.t_h seconds, looked up if not provided
         """
         motion_states = np.zeros((2 * self.t_h + 1, 3))
-        motion_states[-1, 0] = self.helper.get_velocity_for_agent(i_t, s_t)
-        motion_states[-1, 1] = self.helper.get_acceleration_for_agent(i_t, s_t)
-        motion_states[-1, 2] = self.helper.get_heading_change_rate_for_agent(i_t, s_t)
-        hist = self.helper.get_past_for_agent(i_t, s_t, seconds=self.t_h, in_agent_frame=True, just_xy=False)
+        motion_states[-1] = self.get_motion_state(i_t, s_t)
+        if hist is None:
+            hist = self.helper.get_past_for_agent(i_t, s_t, seconds=self.t_h, in_agent_frame=True, just_xy=False)
 
         for k in range(len(hist)):
             if k>3:
                 print(f"k Is bigger than 3 {k}")
                 break
-            motion_states[-(k + 2), 0] = self.helper.get_velocity_for_agent(i_t, hist[k]['sample_token'])
-            motion_states[-(k + 2), 1] = self.helper.get_acceleration_for_agent(i_t, hist[k]['sample_token'])
-            motion_states[-(k + 2), 2] = self.helper.get_heading_change_rate_for_agent(i_t, hist[k]['sample_token'])
+            motion_states[-(k + 2)] = self.get_motion_state(i_t, hist[k]['sample_token'])
 
         motion_states = np.nan_to_num(motion_states)
         return motion_states
@@ -544,6 +801,34 @@ class NuScenesVector(NuScenesTrajectories):
 
         return local_pose
 
+    @staticmethod
+    def global_to_local_batch(origin: Tuple, global_poses: np.ndarray) -> np.ndarray:
+        """
+        Converts an array of poses in global co-ordinates to local co-ordinates in one vectorized call. Same as
+        applying global_to_local to each pose, including the yaw correction.
+        :param origin: (x, y, yaw) of origin in global co-ordinates
+        :param global_poses: ndarray of (x, y, yaw) or (x, y) in global co-ordinates, shape [N, 3] or [N, 2]. Yaw is
+            taken to be 0 for (x, y) poses
+        :return local_poses: ndarray of (x, y, yaw) in local co-ordinates, shape [N, 3]
+        """
+        # Unpack
+        global_poses = np.asarray(global_poses, dtype=float).reshape(-1, np.shape(global_poses)[-1])
+        global_yaw = global_poses[:, 2] if global_poses.shape[1] > 2 else np.zeros(len(global_poses))
+        origin_x, origin_y, origin_yaw = origin
+
+        # Translate
+        local_x = global_poses[:, 0] - origin_x
+        local_y = global_poses[:, 1] - origin_y
+
+        # Rotate
+        global_yaw = np.where(global_yaw <= 0, -np.pi - global_yaw, np.pi - global_yaw)
+        theta = np.arctan2(-np.sin(global_yaw - origin_yaw), np.cos(global_yaw - origin_yaw))
+
+        cos_r, sin_r = np.cos(np.pi/2 - origin_yaw), np.sin(np.pi/2 - origin_yaw)
+        local_poses = np.stack((cos_r * local_x + sin_r * local_y, -sin_r * local_x + cos_r * local_y, theta), axis=1)
+
+        return local_poses
+
     @staticmethod
     def split_lanes(lanes: List[np.ndarray], max_len: int, lane_ids: List[str]) -> Tuple[List[np.ndarray], List[str]]:
         """
@@ -554,46 +839,86 @@ class NuScenesVector(NuScenesTrajectories):
         :return lane_segments: list of smaller lane segments
                 lane_segment_ids: list of lane ID tokens corresponding to original lane that the segment is part of
         """
-        lane_segments = []
-        lane_segment_ids = []
-        for idx, lane in enumerate(lanes):
-            n_segments = int(np.ceil(len(lane) / max_len))
-            n_poses = int(np.ceil(len(lane) / n_segments))
-            for n in range(n_segments):
-                lane_segment = lane[n * n_poses: (n+1) * n_poses]
-                lane_segments.append(lane_segment)
-                lane_segment_ids.append(lane_ids[idx])
+        if len(lanes) == 0:
+            return [], []
+
+        segment_offsets, segment_lanes = NuScenesVector.get_segment_offsets(NuScenesVector.get_offsets(lanes), max_len)
+        lane_segments = np.split(np.concatenate(lanes), segment_offsets[1:-1])
+        lane_segment_ids = [lane_ids[idx] for idx in segment_lanes]
 
         return lane_segments, lane_segment_ids
 
     @staticmethod
-    def get_lane_flags(lanes: List[List[Tuple]], polygons: Dict[str, List[Polygon]], map_api: NuScenesMap) -> List[np.ndarray]:
+    def get_segment_offsets(offsets: np.ndarray, max_len: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Splits concatenated lanes into roughly equal sized smaller segments with defined maximum length
+        :param offsets: start of each lane in the concatenated poses, followed by the total number of poses
+        :param max_len: maximum admissible length of polyline
+        :return segment_offsets: start of each segment in the concatenated poses, followed by the total number of poses
+                segment_lanes: index of the lane that each segment is part of
+        """
+        lens = np.diff(offsets)
+        n_segments = np.ceil(lens / max_len).astype(int)
+        n_poses = np.ceil(lens / n_segments).astype(int)
+
+        # Segment n of lane m spans poses [n * n_poses[m], (n + 1) * n_poses[m]) of the lane
+        segment_lanes = np.repeat(np.arange(len(lens)), n_segments)
+        segment_idcs = np.arange(len(segment_lanes)) - np.repeat(np.cumsum(n_segments) - n_segments, n_segments)
+        segment_starts = np.minimum(segment_idcs * n_poses[segment_lanes], lens[segment_lanes])
+        segment_offsets = np.append(offsets[segment_lanes] + segment_starts, offsets[-1])
+
+        return segment_offsets, segment_lanes
+
+    def get_lane_flags(self, lanes: List[List[Tuple]], polygons: Dict[str, List[str]],
+                       map_api: NuScenesMap) -> List[np.ndarray]:
         """
         Returns flags indicating whether each pose on lane polylines lies on polygon map layers
-        like stop-lines or cross-walks
+        like stop-lines or cross-walks. All lane poses of the sample are queried at once in the polygon index.
         :param lanes: list of lane poses
-        :param polygons: dictionary of polygon layers
+        :param polygons: dictionary of polygon layers, each a list of record tokens
+        :param map_api: nuScenes map api
         :return lane_flags: list of ndarrays with flags
         """
+        if len(lanes) == 0:
+            return []
 
-        lane_flags = [np.zeros((len(lane), len(mapping_dict.keys())-1)) for lane in lanes]
-        for lane_num, lane in enumerate(lanes):
-            for pose_num, pose in enumerate(lane):
-                point = Point(pose[0], pose[1])
-                for n, k in enumerate(polygons.keys()):
-                    polygon_list = polygons[k]
-                    for polygon in polygon_list:
-                        if list(polygon.values())[0].contains(point):
-                            if k == 'stop_line':
-                                n = mapping_dict[map_api.get('stop_line',list(polygon.keys())[0] )['stop_line_type']] 
-                            lane_flags[lane_num][pose_num][n] = 1
-                            break
+        polygon_index = self.get_polygon_index(map_api)
+        lane_lens = [len(lane) for lane in lanes]
+        poses = np.concatenate([np.asarray(lane).reshape(len(lane), -1) for lane in lanes])
+        flags = polygon_index.get_flags(poses, polygons, len(mapping_dict.keys())-1)
+        lane_flags = np.split(flags, np.cumsum(lane_lens)[:-1])
 
         return lane_flags
 
+    def get_lane_cache(self, map_name: str) -> MapLaneCache:
+        """
+        Loads lane graph cache for a map from disk, building and saving it if it does not exist yet
+        :param map_name: nuScenes map name
+        """
+        cache_dir = os.path.join(self.data_dir, 'map_cache')
+        filename = os.path.join(cache_dir, map_name + '_' + str(self.polyline_resolution) + '_v' +
+                                str(MapLaneCache.version) + '.pickle')
+        if os.path.isfile(filename):
+            return MapLaneCache.load(filename)
+
+        lane_cache = MapLaneCache(self.maps[map_name], self.polyline_resolution, self.polygon_layers, mapping_dict)
+        os.makedirs(cache_dir, exist_ok=True)
+        lane_cache.save(filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+        return lane_cache
+
+    def get_polygon_index(self, map_api: NuScenesMap) -> MapPolygonIndex:
+        """
+        Returns polygon index for a map, building it on first use
+        :param map_api: nuScenes map api
+        """
+        if map_api.map_name not in self.polygon_indices:
+            self.polygon_indices[map_api.map_name] = MapPolygonIndex(map_api, self.polygon_layers, mapping_dict)
+        return self.polygon_indices[map_api.map_name]
+
     @staticmethod
     def list_to_tensor(feat_list: List[np.ndarray], max_num: int, max_len: int,
-                       feat_size: int) -> Tuple[np.ndarray, np.ndarray]:
+                       feat_size: int, bool_masks: bool = False) -> Tuple[np.ndarray, np.ndarray]:
         """
         Converts a list of sequential features (e.g. lane polylines or agent history) to fixed size numpy arrays for
         forming mini-batches
@@ -602,11 +927,12 @@ class NuScenesVector(NuScenesTrajectories):
         :param max_num: Maximum number of sequences in List
         :param max_len: Maximum length of each sequence
         :param feat_size: Feature dimension
+        :param bool_masks: Whether to return boolean instead of float masks
         :return: 1) ndarray of features of shape [max_num, max_len, feat_dim]. Has zeros where elements are missing,
             2) ndarray of binary masks of shape [max_num, max_len, feat_dim]. Has ones where elements are missing.
         """
         feat_array = np.zeros((max_num, max_len, feat_size))
-        mask_array = np.ones((max_num, max_len, feat_size))
+        mask_array = np.ones((max_num, max_len, feat_size), dtype=bool if bool_masks else float)
         for n, feats in enumerate(feat_list):
             feat_array[n, :len(feats), :] = feats
             mask_array[n, :len(feats), :] = 0
@@ -0,0 +1,207 @@
+from shapely.geometry import Point
+from scipy import spatial
+import numpy as np
+from typing import Dict, List, Tuple
+
+
+"""
+Reference implementations of extraction steps that have been vectorized, kept as they were before vectorizing. Used
+to verify the vectorized implementations while extracting data, with verify_extraction: True in the dataset args.
+"""
+
+
+def check_equal(name: str, value, reference):
+    """
+    Raises an exception if the output of a vectorized extraction step differs from the reference implementation
+    :param name: name of the extraction step
+    :param value: output of the vectorized implementation
+    :param reference: output of the reference implementation
+    """
+    if type(reference) in [list, tuple]:
+        equal = len(value) == len(reference) and all(np.array_equal(np.asarray(v), np.asarray(r))
+                                                     for v, r in zip(value, reference))
+    else:
+        equal = np.array_equal(np.asarray(value), np.asarray(reference))
+    if not equal:
+        raise Exception('verify_extraction: ' + name + ' differs from the reference implementation')
+
+
+def get_lane_flags(lanes: List[np.ndarray], polygons: Dict[str, List[str]], map_api,
+                   stop_line_flags: Dict[str, int], num_flags: int) -> List[np.ndarray]:
+    """
+    Returns flags indicating whether each pose on lane polylines lies on polygon map layers like stop-lines or
+    cross-walks, testing every pose against every polygon with shapely Polygon.contains
+    :param lanes: list of lane poses
+    :param polygons: dictionary of polygon layers, each a list of record tokens
+    :param map_api: nuScenes map api
+    :param stop_line_flags: flag index for each stop line type
+    :param num_flags: number of flags
+    :return lane_flags: list of ndarrays with flags
+    """
+    polygons = {k: [{token: map_api.extract_polygon(map_api.get(k, token)['polygon_token'])} for token in tokens]
+                for k, tokens in polygons.items()}
+    lane_flags = [np.zeros((len(lane), num_flags)) for lane in lanes]
+    for lane_num, lane in enumerate(lanes):
+        for pose_num, pose in enumerate(lane):
+            point = Point(pose[0], pose[1])
+            for n, k in enumerate(polygons.keys()):
+                polygon_list = polygons[k]
+                for polygon in polygon_list:
+                    if list(polygon.values())[0].contains(point):
+                        if k == 'stop_line':
+                            n = stop_line_flags[map_api.get('stop_line', list(polygon.keys())[0])['stop_line_type']]
+                        lane_flags[lane_num][pose_num][n] = 1
+                        break
+
+    return lane_flags
+
+
+def get_adj_matrix(vehicles: np.ndarray, veh_masks: np.ndarray, pedestrians: np.ndarray, ped_masks: np.ndarray,
+                   objects: np.ndarray, obj_masks: np.ndarray, dist_thresh: float = 20) -> np.ndarray:
+    """
+    Returns adjacency matrix of the interaction graph from the distances between all pairs of last valid positions.
+    Non-empty agents are assumed to be the leading rows of each input, as output by list_to_tensor.
+    :param vehicles: ndarray with vehicle track histories, shape [max_vehicles, t_h * 2, 5]
+    :param veh_masks: ndarray with vehicle pose masks, True for empty poses, shape [max_vehicles, t_h * 2]
+    :param pedestrians: ndarray with pedestrian track histories, shape [max_pedestrians, t_h * 2, 5]
+    :param ped_masks: ndarray with pedestrian pose masks, True for empty poses, shape [max_pedestrians, t_h * 2]
+    :param objects: ndarray with object track histories, shape [max_objects, t_h * 2, 5]
+    :param obj_masks: ndarray with object pose masks, True for empty poses, shape [max_objects, t_h * 2]
+    :param dist_thresh: distance threshold for adjacency
+    :return: adjacency matrix, shape [num_nodes, num_nodes]
+    """
+    agents_last_positions = np.array([[0, 0]])
+    for feats, masks in [(vehicles, veh_masks), (pedestrians, ped_masks), (objects, obj_masks)]:
+        masks = ~masks[np.any(~masks, -1)]
+        index = np.array([np.where(mask_i)[0][-1] if len(np.where(mask_i)[0]) != 0 else -1 for mask_i in masks])
+        if len(masks) > 0:
+            agents_last_positions = np.concatenate((agents_last_positions,
+                                                    feats[np.arange(masks.shape[0]), index, :2]), axis=0)
+
+    dist_matrix = spatial.distance.cdist(agents_last_positions, agents_last_positions)
+    adj_matrix = np.zeros_like(dist_matrix)
+    adj_matrix[dist_matrix < dist_thresh] = 1
+
+    return adj_matrix
+
+
+def get_visited_edges(fut_xy: np.ndarray, lane_graph: Dict, traversal_horizon: int, polyline_length: int,
+                      polyline_resolution: float, map_extent: List[float]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns nodes and edges of the lane graph visited by a future trajectory, assigning one future pose to a lane node
+    at a time
+    :param fut_xy: future trajectory of the target agent in the agent's frame, shape [num_steps, 2]
+    :param lane_graph: lane graph dictionary with lane node features and edge look-up tables
+    :param traversal_horizon: length of the node sequence
+    :param polyline_length: number of poses per lane node
+    :param polyline_resolution: distance between lane node poses
+    :param map_extent: extent of the map around the target agent
+    :return: node_seq: Sequence of visited node ids.
+             evf: Look-up table of visited edges.
+    """
+
+    # Unpack lane graph dictionary
+    node_feats = lane_graph['lane_node_feats']
+    s_next = lane_graph['s_next']
+    edge_type = lane_graph['edge_type']
+
+    node_feat_lens = np.sum(1 - lane_graph['lane_node_masks'][:, :, 0], axis=1)
+    node_poses = []
+    for i, node_feat in enumerate(node_feats):
+        if node_feat_lens[i] != 0:
+            node_poses.append(node_feat[:int(node_feat_lens[i]), :3])
+
+    # Initialize outputs
+    current_step = 0
+    node_seq = np.zeros(traversal_horizon)
+    evf = np.zeros_like(s_next)
+
+    # Interpolate future trajectory
+    fut_interpolated = np.zeros((fut_xy.shape[0] * 10 + 1, 2))
+    param_query = np.linspace(0, fut_xy.shape[0], fut_xy.shape[0] * 10 + 1)
+    param_given = np.linspace(0, fut_xy.shape[0], fut_xy.shape[0] + 1)
+    val_given_x = np.concatenate(([0], fut_xy[:, 0]))
+    val_given_y = np.concatenate(([0], fut_xy[:, 1]))
+    fut_interpolated[:, 0] = np.interp(param_query, param_given, val_given_x)
+    fut_interpolated[:, 1] = np.interp(param_query, param_given, val_given_y)
+    fut_xy = fut_interpolated
+
+    # Compute yaw values for future
+    fut_yaw = np.zeros(len(fut_xy))
+    for n in range(1, len(fut_yaw)):
+        fut_yaw[n] = -np.arctan2(fut_xy[n, 0] - fut_xy[n-1, 0], fut_xy[n, 1] - fut_xy[n-1, 1])
+
+    # Loop over future trajectory poses
+    query_pose = np.asarray([fut_xy[0, 0], fut_xy[0, 1], fut_yaw[0]])
+    current_node = assign_pose_to_node(node_poses, query_pose)
+    node_seq[current_step] = current_node
+    for n in range(1, len(fut_xy)):
+        query_pose = np.asarray([fut_xy[n, 0], fut_xy[n, 1], fut_yaw[n]])
+        dist_from_current_node = np.min(np.linalg.norm(node_poses[current_node][:, :2] - query_pose[:2], axis=1))
+
+        # If pose has deviated sufficiently from current node and is within area of interest, assign to a new node
+        padding = polyline_length * polyline_resolution / 2
+        if map_extent[0] - padding <= query_pose[0] <= map_extent[1] + padding and \
+                map_extent[2] - padding <= query_pose[1] <= map_extent[3] + padding:
+
+            if dist_from_current_node >= 1.5:
+                assigned_node = assign_pose_to_node(node_poses, query_pose)
+
+                # Assign new node to node sequence and edge to visited edges
+                if assigned_node != current_node:
+
+                    if assigned_node in s_next[current_node]:
+                        nbr_idx = np.where(s_next[current_node] == assigned_node)[0]
+                        nbr_valid = np.where(edge_type[current_node] > 0)[0]
+                        nbr_idx = np.intersect1d(nbr_idx, nbr_valid)
+
+                        if np.any(edge_type[current_node, nbr_idx] > 0):
+                            evf[current_node, nbr_idx] = 1
+
+                    current_node = assigned_node
+                    if current_step < traversal_horizon-1:
+                        current_step += 1
+                        node_seq[current_step] = current_node
+
+        else:
+            break
+
+    # Assign goal node and edge
+    goal_node = current_node + len(node_feats)
+    node_seq[current_step + 1:] = goal_node
+    evf[current_node, -1] = 1
+
+    return node_seq, evf
+
+
+def assign_pose_to_node(node_poses: List[np.ndarray], query_pose: np.ndarray, dist_thresh=5, yaw_thresh=np.pi/3,
+                        return_multiple=False):
+    """
+    Assigns a given agent pose to a lane node. Takes into account distance from the lane centerline as well as
+    direction of motion.
+    """
+    dist_vals = []
+    yaw_diffs = []
+
+    for i in range(len(node_poses)):
+        distances = np.linalg.norm(node_poses[i][:, :2] - query_pose[:2], axis=1)
+        dist_vals.append(np.min(distances))
+        idx = np.argmin(distances)
+        yaw_lane = node_poses[i][idx, 2]
+        yaw_query = query_pose[2]
+        yaw_diffs.append(np.arctan2(np.sin(yaw_lane - yaw_query), np.cos(yaw_lane - yaw_query)))
+
+    idcs_yaw = np.where(np.absolute(np.asarray(yaw_diffs)) <= yaw_thresh)[0]
+    idcs_dist = np.where(np.asarray(dist_vals) <= dist_thresh)[0]
+    idcs = np.intersect1d(idcs_dist, idcs_yaw)
+
+    if len(idcs) > 0:
+        if return_multiple:
+            return idcs
+        assigned_node_id = idcs[int(np.argmin(np.asarray(dist_vals)[idcs]))]
+    else:
+        assigned_node_id = np.argmin(np.asarray(dist_vals))
+        if return_multiple:
+            assigned_node_id = np.asarray([assigned_node_id])
+
+    return assigned_node_id
@@ -0,0 +1,129 @@
+from nuscenes.prediction import PredictHelper
+import numpy as np
+from typing import Dict, List, Tuple
+import os
+import shutil
+
+
+class SplitIndex:
+    """
+    Persistent, memory-mapped index of a prediction challenge split, stored alongside the extracted data:
+        - token list of the split, 'instance_sample'
+        - target agent translation and rotation for each token
+        - indices of the tokens of each instance, sample and scene, in CSR form: group keys in order of first
+          appearance, offsets of each group and token indices in ascending order
+    Replaces parsing the split json and scanning the token list for grouping queries.
+    """
+
+    groupings = ['instance', 'sample', 'scene']
+
+    def __init__(self, index_dir: str):
+        """
+        Opens a split index
+        :param index_dir: Directory with the index, as written by SplitIndex.build
+        """
+        self.index_dir = index_dir
+        self.arrays = {}
+        for filename in os.listdir(index_dir):
+            self.arrays[filename[:-len('.npy')]] = np.load(os.path.join(index_dir, filename), mmap_mode='r')
+        self.token_list = self.arrays['tokens'].tolist()
+
+        # Lookup tables from tokens and group keys to rows, built on first use
+        self.rows = None
+        self.group_rows = {}
+
+    @staticmethod
+    def exists(index_dir: str) -> bool:
+        """
+        Whether a complete index, including the groupings, has been built in index_dir
+        """
+        names = ['tokens'] + [grouping + '_idcs' for grouping in SplitIndex.groupings]
+        return all(os.path.isfile(os.path.join(index_dir, name + '.npy')) for name in names)
+
+    @staticmethod
+    def build(index_dir: str, token_list: List[str], helper: PredictHelper):
+        """
+        Builds the index of a split. The index is written to a temporary directory and moved to index_dir once
+        complete.
+        :param index_dir: Directory to write the index to
+        :param token_list: tokens of the split, 'instance_sample'
+        :param helper: NuScenes PredictHelper
+        """
+        arrays = {}
+        instance_tokens = [token.split("_")[0] for token in token_list]
+        sample_tokens = [token.split("_")[1] for token in token_list]
+        annotations = [helper.get_sample_annotation(i_t, s_t) for i_t, s_t in zip(instance_tokens, sample_tokens)]
+        arrays['tokens'] = np.asarray(token_list, dtype=str)
+        arrays['translations'] = np.asarray([ann['translation'] for ann in annotations], dtype=float).reshape(-1, 3)
+        arrays['rotations'] = np.asarray([ann['rotation'] for ann in annotations], dtype=float).reshape(-1, 4)
+
+        # Group tokens by instance, sample and scene
+        group_keys = {'instance': instance_tokens,
+                      'sample': sample_tokens,
+                      'scene': [helper.data.get('sample', s_t)['scene_token'] for s_t in sample_tokens]}
+        for grouping, keys in group_keys.items():
+            arrays[grouping + '_keys'], arrays[grouping + '_offsets'], arrays[grouping + '_idcs'] = \
+                SplitIndex.group(keys)
+
+        tmp_dir = index_dir + '.tmp'
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, name + '.npy'), array)
+        if os.path.isdir(index_dir):
+            shutil.rmtree(index_dir)
+        os.rename(tmp_dir, index_dir)
+
+    @staticmethod
+    def group(keys: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Groups token indices by key, in CSR form
+        :param keys: group key of each token, e.g. its instance token
+        :return unique_keys: group keys in order of first appearance
+        :return offsets: offsets of each group in idcs, shape [num_groups + 1]
+        :return idcs: token indices of each group in ascending order, concatenated
+        """
+        keys = np.asarray(keys, dtype=str)
+        unique_keys, first_idcs, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        order = np.argsort(first_idcs)
+        group_ids = np.argsort(order)[inverse.reshape(-1)]
+        offsets = np.zeros(len(unique_keys) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(group_ids, minlength=len(unique_keys)))
+
+        return unique_keys[order], offsets, np.argsort(group_ids, kind='stable').astype(np.int64)
+
+    def get_row(self, token: str) -> int:
+        """
+        Returns row of a token, 'instance_sample', in the token list
+        """
+        if self.rows is None:
+            self.rows = {t: row for row, t in enumerate(self.token_list)}
+        return self.rows[token]
+
+    def get_annotation(self, token: str) -> Dict:
+        """
+        Returns translation and rotation of the target agent's sample annotation for a token, 'instance_sample'
+        """
+        row = self.get_row(token)
+        return {'translation': self.arrays['translations'][row].tolist(),
+                'rotation': self.arrays['rotations'][row].tolist()}
+
+    def get_keys(self, grouping: str) -> List[str]:
+        """
+        Returns instance, sample or scene tokens of the split, in order of first appearance in the token list
+        :param grouping: one of 'instance', 'sample', 'scene'
+        """
+        return self.arrays[grouping + '_keys'].tolist()
+
+    def get_idcs(self, grouping: str, key: str) -> np.ndarray:
+        """
+        Returns indices of all tokens of an instance, sample or scene, in ascending order
+        :param grouping: one of 'instance', 'sample', 'scene'
+        :param key: instance, sample or scene token
+        """
+        if grouping not in self.group_rows:
+            self.group_rows[grouping] = {k: row for row, k in enumerate(self.get_keys(grouping))}
+        row = self.group_rows[grouping][key]
+        offsets = self.arrays[grouping + '_offsets']
+        return np.asarray(self.arrays[grouping + '_idcs'][offsets[row]:offsets[row + 1]])
@@ -0,0 +1,233 @@
+import numpy as np
+from typing import Dict, List, Callable, Tuple
+import os
+import pickle
+import shutil
+
+
+class SampleStore:
+    """
+    Packed, memory-mapped store of pre-processed samples. Replaces one pickle file per sample with one file per
+    (flattened) key of the sample dictionary:
+        'fixed': arrays with the same shape for all samples, stored as a single [num_samples, ...] array
+        'ragged': arrays with a varying leading dimension, stored in CSR form as concatenated values along with an
+                  offsets array of length num_samples + 1
+        'str': strings, stored as a fixed width unicode array
+        'scalar': python scalars, stored as a [num_samples] array
+    All arrays are opened with np.load(mmap_mode='r'), so the page cache is shared by all data loader workers.
+    """
+
+    def __init__(self, store_dir: str):
+        """
+        Opens a packed sample store
+        :param store_dir: Directory with the packed store, as written by SampleStore.pack
+        """
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'meta.pickle'), 'rb') as handle:
+            meta = pickle.load(handle)
+        self.schema = meta['schema']
+        self.rows = {token: row for row, token in enumerate(meta['tokens'])}
+
+        # Memory maps are opened lazily, so that each data loader worker maps the files itself
+        self.arrays = None
+
+    def __len__(self):
+        """
+        Number of samples in the store
+        """
+        return len(self.rows)
+
+    @staticmethod
+    def exists(store_dir: str) -> bool:
+        """
+        Whether a complete store has been packed to store_dir
+        """
+        return os.path.isfile(os.path.join(store_dir, 'meta.pickle'))
+
+    def get(self, token: str) -> Dict:
+        """
+        Returns the sample for a token as a nested dictionary, in the same format as the un-packed pickle files.
+        Arrays are copied out of the memory maps, since downstream code (flips, collate functions) modifies samples in
+        place.
+        :param token: sample token, 'instance_sample'
+        :return data: Dictionary with pre-processed data
+        """
+        if self.arrays is None:
+            self.arrays = self.open_arrays()
+
+        row = self.rows[token]
+        data = {}
+        for key, (kind, _, _) in self.schema.items():
+            if kind == 'ragged':
+                values, offsets = self.arrays[key]
+                value = np.array(values[offsets[row]:offsets[row + 1]])
+            elif kind == 'fixed':
+                value = np.array(self.arrays[key][row])
+            elif kind == 'str':
+                value = str(self.arrays[key][row])
+            else:
+                value = self.arrays[key][row].item()
+            self.set_nested(data, key, value)
+
+        return data
+
+    def open_arrays(self) -> Dict:
+        """
+        Memory maps all arrays in the store
+        """
+        arrays = {}
+        for key, (kind, _, _) in self.schema.items():
+            filename = os.path.join(self.store_dir, self.get_filename(key))
+            if kind == 'ragged':
+                arrays[key] = (np.load(filename + '.npy', mmap_mode='r'),
+                               np.load(filename + '.offsets.npy', mmap_mode='r'))
+            else:
+                arrays[key] = np.load(filename + '.npy', mmap_mode='r')
+        return arrays
+
+    @staticmethod
+    def pack(store_dir: str, tokens: List[str], load_fn: Callable[[int], Dict], verbose: bool = False):
+        """
+        Packs samples into a store. Makes two passes over the samples, the first to infer the schema and sizes of all
+        arrays and the second to write them. The store is written to a temporary directory and moved to store_dir
+        once complete, so a partially packed store is never read.
+        :param store_dir: Directory to write the packed store to
+        :param tokens: sample tokens, 'instance_sample'
+        :param load_fn: function returning the sample dictionary for a data index
+        :param verbose: Whether to print progress
+        """
+        tmp_dir = store_dir + '.tmp'
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        # First pass: infer schema and lengths of ragged fields
+        schema, lengths = SampleStore.infer_schema(tokens, load_fn, verbose)
+
+        # Allocate arrays
+        arrays = {}
+        for key, (kind, dtype, shape) in schema.items():
+            filename = os.path.join(tmp_dir, SampleStore.get_filename(key))
+            if kind == 'ragged':
+                offsets = np.zeros(len(tokens) + 1, dtype=np.int64)
+                offsets[1:] = np.cumsum(lengths[key])
+                np.save(filename + '.offsets.npy', offsets)
+                values = np.lib.format.open_memmap(filename + '.npy', mode='w+', dtype=dtype,
+                                                   shape=(int(offsets[-1]),) + shape)
+                arrays[key] = (values, offsets)
+            elif kind == 'str':
+                arrays[key] = []
+            else:
+                arrays[key] = np.lib.format.open_memmap(filename + '.npy', mode='w+', dtype=dtype,
+                                                        shape=(len(tokens),) + shape)
+
+        # Second pass: write samples
+        for idx in range(len(tokens)):
+            for key, value in SampleStore.flatten(load_fn(idx)).items():
+                kind = schema[key][0]
+                if kind == 'ragged':
+                    values, offsets = arrays[key]
+                    values[offsets[idx]:offsets[idx + 1]] = value
+                elif kind == 'str':
+                    arrays[key].append(value)
+                else:
+                    arrays[key][idx] = value
+
+            # Show progress
+            if verbose and (idx + 1) % 1000 == 0:
+                print('packing: ' + str(idx + 1) + '/' + str(len(tokens)))
+
+        # Flush memory maps and write strings and metadata
+        for key, (kind, _, _) in schema.items():
+            if kind == 'str':
+                np.save(os.path.join(tmp_dir, SampleStore.get_filename(key) + '.npy'), np.asarray(arrays[key]))
+            elif kind == 'ragged':
+                arrays[key][0].flush()
+            else:
+                arrays[key].flush()
+        del arrays
+        with open(os.path.join(tmp_dir, 'meta.pickle'), 'wb') as handle:
+            pickle.dump({'schema': schema, 'tokens': list(tokens)}, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+        if os.path.isdir(store_dir):
+            shutil.rmtree(store_dir)
+        os.rename(tmp_dir, store_dir)
+
+    @staticmethod
+    def infer_schema(tokens: List[str], load_fn: Callable[[int], Dict], verbose: bool = False) -> Tuple[Dict, Dict]:
+        """
+        Infers kind, dtype and per-sample shape (trailing shape for ragged fields) of each flattened key
+        :param tokens: sample tokens, 'instance_sample'
+        :param load_fn: function returning the sample dictionary for a data index
+        :param verbose: Whether to print progress
+        :return schema: Dictionary mapping keys to (kind, dtype, shape)
+        :return lengths: Dictionary mapping keys to leading dimension of each sample
+        """
+        schema = {}
+        lengths = {}
+        for idx in range(len(tokens)):
+            for key, value in SampleStore.flatten(load_fn(idx)).items():
+                if isinstance(value, str):
+                    kind, dtype, shape = 'str', None, ()
+                elif isinstance(value, np.ndarray):
+                    kind, dtype, shape = 'fixed', value.dtype, value.shape
+                else:
+                    kind, dtype, shape = 'scalar', np.asarray(value).dtype, ()
+
+                if key not in schema:
+                    schema[key] = (kind, dtype, shape)
+                    lengths[key] = []
+                elif schema[key][0] in ['fixed', 'ragged'] and kind == 'fixed':
+                    ref_shape = schema[key][2]
+                    if schema[key][0] == 'fixed' and shape != ref_shape:
+                        if len(shape) == 0 or len(shape) != len(ref_shape) or shape[1:] != ref_shape[1:]:
+                            raise Exception('Shape of ' + key + ' varies beyond its leading dimension, cannot pack')
+                        schema[key] = ('ragged', np.result_type(schema[key][1], dtype), ref_shape[1:])
+                    elif schema[key][0] == 'ragged' and shape[1:] != ref_shape:
+                        raise Exception('Shape of ' + key + ' varies beyond its leading dimension, cannot pack')
+                    else:
+                        schema[key] = (schema[key][0], np.result_type(schema[key][1], dtype), ref_shape)
+                elif schema[key][0] != kind:
+                    raise Exception('Type of ' + key + ' varies between samples, cannot pack')
+
+                if kind == 'fixed':
+                    lengths[key].append(shape[0] if len(shape) > 0 else 1)
+
+            # Show progress
+            if verbose and (idx + 1) % 1000 == 0:
+                print('inferring schema: ' + str(idx + 1) + '/' + str(len(tokens)))
+
+        # Ragged fields only need their lengths
+        lengths = {key: np.asarray(v, dtype=np.int64) for key, v in lengths.items() if schema[key][0] == 'ragged'}
+
+        return schema, lengths
+
+    @staticmethod
+    def flatten(data: Dict, prefix: str = '') -> Dict:
+        """
+        Flattens a nested dictionary, joining keys with '/'
+        """
+        flat = {}
+        for k, v in data.items():
+            if type(v) is dict:
+                flat.update(SampleStore.flatten(v, prefix + k + '/'))
+            else:
+                flat[prefix + k] = v
+        return flat
+
+    @staticmethod
+    def set_nested(data: Dict, key: str, value):
+        """
+        Sets value of a flattened key in a nested dictionary
+        """
+        keys = key.split('/')
+        for k in keys[:-1]:
+            data = data.setdefault(k, {})
+        data[keys[-1]] = value
+
+    @staticmethod
+    def get_filename(key: str) -> str:
+        """
+        File name (without extension) for a flattened key
+        """
+        return key.replace('/', '.')
@@ -42,7 +42,6 @@ class PGP(PredictionAggregator):
         self.pi_h2_goal = nn.Linear(args['pi_h1_size'], args['pi_h2_size'])
         self.pi_op_goal = nn.Linear(args['pi_h2_size'], 1)
         self.leaky_relu = nn.LeakyReLU()
-        self.log_softmax = nn.LogSoftmax(dim=2)
 
         # For sampling policy
         self.horizon = args['horizon']
@@ -66,7 +65,7 @@ class PGP(PredictionAggregator):
 
         # Unpack encodings:
         target_agent_encoding = encodings['target_agent_encoding']
-        node_encodings = encodings['context_encoding']['combined']
+        node_encodings, node_idcs = self.get_flat_encodings(encodings['context_encoding'])
         node_masks = encodings['context_encoding']['combined_masks']
         s_next = encodings['s_next']
         edge_type = encodings['edge_type']
@@ -76,7 +75,8 @@ class PGP(PredictionAggregator):
             att = None
 
         # Compute pi (log probs)
-        pi = self.compute_policy(target_agent_encoding, node_encodings, node_masks, s_next, edge_type) # (batch_size, num_nodes, num_edges) [64 164 15]
+        pi = self.compute_policy(target_agent_encoding, node_encodings, node_idcs, node_masks, s_next,
+                                 edge_type) # (batch_size, num_nodes, num_edges) [64 164 15]
 
         # If pretraining model, use ground truth node sequences
         if self.pre_train and self.training:
@@ -87,30 +87,62 @@ class PGP(PredictionAggregator):
             sampled_traversals = self.sample_policy(torch.exp(pi), s_next, init_node) # (batch_size, num_samples, horizon) [64 1000 15]
 
         # Selectively aggregate context along traversed paths
-        agg_enc = self.aggregate(sampled_traversals, node_encodings, target_agent_encoding) #[64 1000 160]
+        agg_enc = self.aggregate(sampled_traversals, node_encodings, node_idcs, target_agent_encoding) #[64 1000 160]
 
         outputs = {'agg_encoding': agg_enc, 'pi': pi, 'att': att}
         return outputs
 
-    def aggregate(self, sampled_traversals, node_encodings, target_agent_encoding) -> torch.Tensor:
-
-        # Useful variables:
-        batch_size = node_encodings.shape[0]
-        max_nodes = node_encodings.shape[1]
+    @staticmethod
+    def get_flat_encodings(context_encoding: Dict):
+        """
+        Returns node encodings as a flat tensor over the lane nodes of all samples, followed by a row of zeros for
+        missing nodes and goal states, and the row of each node in the flat tensor.
+        :param context_encoding: context encodings, either with dense node encodings 'combined' of shape
+            [batch_size, max_nodes, node_enc_size], or with flat node encodings 'combined_flat' of shape
+            [num_nodes, node_enc_size] and the row of each node 'combined_idcs', -1 for missing nodes
+        :return node_encodings: flat node encodings, shape [num_nodes + 1, node_enc_size]
+        :return node_idcs: row of each node in the flat node encodings, shape [batch_size, max_nodes]
+        """
+        if context_encoding['combined'] is not None:
+            batch_size, max_nodes, node_enc_size = context_encoding['combined'].shape
+            node_encodings = context_encoding['combined'].reshape(-1, node_enc_size)
+            node_idcs = torch.arange(batch_size * max_nodes, device=node_encodings.device).view(batch_size, max_nodes)
+        else:
+            node_encodings = context_encoding['combined_flat']
+            node_idcs = context_encoding['combined_idcs'].long()
+            node_idcs = torch.where(node_idcs >= 0, node_idcs, torch.full_like(node_idcs, len(node_encodings)))
+        node_encodings = torch.cat((node_encodings, torch.zeros_like(node_encodings[:1])), dim=0)
 
-        # Get unique traversals and form consolidated batch:
-        unique_traversals = [torch.unique(i, dim=0, return_counts=True) for i in sampled_traversals]
-        traversals_batched = torch.cat([i[0] for i in unique_traversals], dim=0)
-        counts_batched = torch.cat([i[1] for i in unique_traversals], dim=0)
-        batch_idcs = torch.cat([n*torch.ones(len(i[1])).long() for n, i in enumerate(unique_traversals)])
-        batch_idcs = batch_idcs.unsqueeze(1).repeat(1, self.horizon)
+        return node_encodings, node_idcs
 
-        # Dummy encodings for goal nodes
-        dummy_enc = torch.zeros_like(node_encodings)
-        node_encodings = torch.cat((node_encodings, dummy_enc), dim=1)
+    def aggregate(self, sampled_traversals, node_encodings, node_idcs, target_agent_encoding) -> torch.Tensor:
+        """
+        Selectively aggregates node encodings along sampled traversals
+        :param sampled_traversals: sampled node sequences, goal states offset by max_nodes, shape
+            [batch_size, num_samples, horizon]
+        :param node_encodings: flat node encodings, see get_flat_encodings
+        :param node_idcs: row of each node in the flat node encodings, shape [batch_size, max_nodes]
+        :param target_agent_encoding: target agent encodings, shape [batch_size, target_agent_enc_size]
+        """
+        # Useful variables:
+        batch_size = node_idcs.shape[0]
+        max_nodes = node_idcs.shape[1]
+
+        # Get unique traversals and form consolidated batch, with a single call to unique over traversals keyed by
+        # batch index. Sorting by batch index first keeps unique traversals grouped by batch element.
+        batch_keys = torch.arange(batch_size, device=sampled_traversals.device)
+        batch_keys = batch_keys.view(batch_size, 1, 1).expand(batch_size, self.num_samples, 1)
+        keys = torch.cat((batch_keys, sampled_traversals), dim=2).view(batch_size * self.num_samples, -1)
+        unique_keys, counts_batched = torch.unique(keys, dim=0, return_counts=True)
+        batch_idcs = unique_keys[:, :1]
+        traversals_batched = unique_keys[:, 1:]
+
+        # Goal nodes point to the row of zeros of the flat node encodings
+        dummy_idcs = torch.full_like(node_idcs, len(node_encodings) - 1)
+        node_idcs = torch.cat((node_idcs, dummy_idcs), dim=1)
 
         # Gather node encodings along traversed paths
-        node_enc_selected = node_encodings[batch_idcs, traversals_batched]
+        node_enc_selected = node_encodings[node_idcs[batch_idcs, traversals_batched]]
 
         # Add positional encodings:
         pos_enc = self.pos_enc(torch.zeros_like(node_enc_selected))
@@ -125,7 +157,8 @@ class PGP(PredictionAggregator):
         att_op, att_weights = self.mha(query, keys, vals, key_padding_mask) #attt_w = (vount_batched, 1, 15)
 
         # Repeat based on counts
-        att_op = att_op.squeeze(0).repeat_interleave(counts_batched, dim=0).view(batch_size, self.num_samples, -1)
+        att_op = att_op.squeeze(0).repeat_interleave(counts_batched, dim=0, output_size=batch_size * self.num_samples)
+        att_op = att_op.view(batch_size, self.num_samples, -1)
 
         # Concatenate target agent encoding
         agg_enc = torch.cat((target_agent_encoding.unsqueeze(1).repeat(1, self.num_samples, 1), att_op), dim=-1)
@@ -180,51 +213,63 @@ class PGP(PredictionAggregator):
 
         return sampled_traversals
 
-    def compute_policy(self, target_agent_encoding, node_encodings, node_masks, s_next, edge_type) -> torch.Tensor:
+    def compute_policy(self, target_agent_encoding, node_encodings, node_idcs, node_masks, s_next,
+                       edge_type) -> torch.Tensor:
         """
-        Forward pass for policy header
+        Forward pass for policy header. Encodings are gathered for the edges and goal states of the lane graph only,
+        using an edge list, and scores are normalized over the outgoing edges of each source node with a segment
+        log-softmax.
         :param target_agent_encoding: tensor encoding the target agent's past motion
-        :param node_encodings: tensor of node encodings provided by the encoder
+        :param node_encodings: flat node encodings, see get_flat_encodings
+        :param node_idcs: row of each node in the flat node encodings, shape [batch_size, max_nodes]
         :param node_masks: masks indicating whether a node exists for a given index in the tensor
         :param s_next: look-up table for next node for a given source node and edge
         :param edge_type: look-up table with edge types
-        :return pi: tensor with probabilities corresponding to the policy
+        :return pi: tensor with log probabilities corresponding to the policy, -inf where no edge exists
         """
         # Useful variables:
-        batch_size = node_encodings.shape[0]
-        max_nodes = node_encodings.shape[1]
+        batch_size, max_nodes = node_idcs.shape
         max_nbrs = s_next.shape[2] - 1
-        node_enc_size = node_encodings.shape[2]
-        target_agent_enc_size = target_agent_encoding.shape[1]
-
-        # Gather source node encodigns, destination node encodings, edge encodings and target agent encodings.
-        src_node_enc = node_encodings.unsqueeze(2).repeat(1, 1, max_nbrs, 1) # [B, max nodes, max nbrs, node enc size]
-        dst_idcs = s_next[:, :, :-1].reshape(batch_size, -1).long()  # [B, max nodes * max nbrs]
-        batch_idcs = torch.arange(batch_size).unsqueeze(1).repeat(1, max_nodes * max_nbrs)  # [B, max nodes * max nbrs]
-        dst_node_enc = node_encodings[batch_idcs, dst_idcs].reshape(batch_size, max_nodes, max_nbrs, node_enc_size)
-        target_agent_enc = target_agent_encoding.unsqueeze(1).unsqueeze(2).repeat(1, max_nodes, max_nbrs, 1)  # [B, max nodes, max nbrs, enc size]
-        edge_enc = torch.cat((torch.as_tensor(edge_type[:, :, :-1] == 1, device=device).unsqueeze(3).float(),
-                              torch.as_tensor(edge_type[:, :, :-1] == 2, device=device).unsqueeze(3).float()), dim=3) # cat(succ, prox)
-        enc = torch.cat((target_agent_enc, src_node_enc, dst_node_enc, edge_enc), dim=3)
-        enc_goal = torch.cat((target_agent_enc[:, :, 0, :], src_node_enc[:, :, 0, :]), dim=2)
-
-        # Form a single batch of encodings
-        masks = torch.sum(edge_enc, dim=3, keepdim=True).bool()
-        masks_goal = ~node_masks.unsqueeze(-1).bool()
-        enc_batched = torch.masked_select(enc, masks).reshape(-1, target_agent_enc_size + 2*node_enc_size + 2)
-        enc_goal_batched = torch.masked_select(enc_goal, masks_goal).reshape(-1, target_agent_enc_size + node_enc_size)
+
+        # Edge list: batch index, source node and edge index of each edge to a neighboring node
+        b, src, e = torch.nonzero(edge_type[:, :, :-1] != 0, as_tuple=True)
+        dst = s_next[b, src, e].long()
+
+        # Gather target agent encodings, source node encodings, destination node encodings and edge encodings
+        edge_enc = torch.stack((edge_type[b, src, e] == 1, edge_type[b, src, e] == 2), dim=1).float() # cat(succ, prox)
+        enc = torch.cat((target_agent_encoding[b], node_encodings[node_idcs[b, src]], node_encodings[node_idcs[b, dst]],
+                         edge_enc), dim=1)
+
+        # Terminal edges to goal states, scored for existing nodes only
+        b_goal, src_goal = torch.nonzero(edge_type[:, :, -1] != 0, as_tuple=True)
+        enc_goal = torch.cat((target_agent_encoding[b_goal], node_encodings[node_idcs[b_goal, src_goal]]), dim=1)
 
         # Compute scores for pi_route
-        pi_ = self.pi_op(self.leaky_relu(self.pi_h2(self.leaky_relu(self.pi_h1(enc_batched)))))
-        pi = torch.zeros_like(masks).float()
-        pi = pi.masked_scatter_(masks, pi_).squeeze(-1)
-        pi_goal_ = self.pi_op_goal(self.leaky_relu(self.pi_h2_goal(self.leaky_relu(self.pi_h1_goal(enc_goal_batched)))))
-        pi_goal = torch.zeros_like(masks_goal).float()
-        pi_goal = pi_goal.masked_scatter_(masks_goal, pi_goal_)
-
-        # Normalize to give log probabilities
-        pi = torch.cat((pi, pi_goal), dim=-1)
-        op_masks = torch.log(torch.as_tensor(edge_type != 0).float())
-        pi = self.log_softmax(pi + op_masks)
+        pi_ = self.pi_op(self.leaky_relu(self.pi_h2(self.leaky_relu(self.pi_h1(enc))))).squeeze(-1)
+        pi_goal_ = self.pi_op_goal(self.leaky_relu(self.pi_h2_goal(self.leaky_relu(self.pi_h1_goal(enc_goal)))))
+        pi_goal_ = pi_goal_.squeeze(-1).masked_fill(node_masks[b_goal, src_goal] != 0, 0)
+
+        # Normalize over outgoing edges of each source node to give log probabilities
+        b = torch.cat((b, b_goal))
+        src = torch.cat((src, src_goal))
+        e = torch.cat((e, torch.full_like(src_goal, max_nbrs)))
+        log_probs = self.segment_log_softmax(torch.cat((pi_, pi_goal_)), b * max_nodes + src, batch_size * max_nodes)
+        pi = torch.full((batch_size, max_nodes, max_nbrs + 1), -float('inf'), device=log_probs.device)
+        pi[b, src, e] = log_probs
 
         return pi
+
+    @staticmethod
+    def segment_log_softmax(scores: torch.Tensor, segments: torch.Tensor, num_segments: int) -> torch.Tensor:
+        """
+        Log-softmax over segments of a flat tensor of scores
+        :param scores: scores, shape [num_scores]
+        :param segments: segment of each score, shape [num_scores]
+        :param num_segments: number of segments
+        :return: log-softmax of each score over the scores of its segment, shape [num_scores]
+        """
+        max_scores = torch.full((num_segments,), -float('inf'), device=scores.device)
+        max_scores = max_scores.scatter_reduce(0, segments, scores.detach(), reduce='amax', include_self=False)
+        scores = scores - max_scores[segments]
+        sum_exp = torch.zeros(num_segments, device=scores.device).index_add(0, segments, torch.exp(scores))
+        return scores - torch.log(sum_exp)[segments]
@@ -2,10 +2,10 @@ from code import interact
 from models.encoders.encoder import PredictionEncoder
 import torch
 import torch.nn as nn
-from torch.nn.utils.rnn import pack_padded_sequence
 from typing import Dict, List
 from torch import Tensor
 from models.heterograph_models import HGT, ieHGCN, SimpleHGN
+from models.sequence_encoding import get_sequence_plan, packed_gru_encode, fused_gru_encode
 import torch.nn.functional as F 
 from dgl import DGLError
 from dgl.nn import GATv2Conv 
@@ -272,6 +272,11 @@ class PGP_SCOUTEncoder(PredictionEncoder):
         nbr_enc_size: int Size of hidden state of neighboring agent GRU encoders
 
         num_gat_layers: int Number of GAT layers to use.
+
+        fused_agent_encoding: bool (optional) Encode vehicle and pedestrian histories with a single GRU call without
+            packing, instead of packed sequences.
+        ragged_nodes: bool (optional) Output lane node encodings as a flat tensor over the lane nodes of all samples
+            instead of scattering them to shape [batch_size, max_nodes, node_enc_size].
         """
 
         super().__init__()
@@ -286,6 +291,8 @@ class PGP_SCOUTEncoder(PredictionEncoder):
         self.nbr_enc = nn.GRU(args['nbr_emb_size'], args['nbr_enc_size'], batch_first=True)
         self.agent_mask_prob_v = args['agent_mask_prob_v']
         self.mask_frames = args['mask_frames']
+        self.fused_agent_encoding = args['fused_agent_encoding'] if 'fused_agent_encoding' in args.keys() else False
+        self.ragged_nodes = args['ragged_nodes'] if 'ragged_nodes' in args.keys() else False
 
         # Node encoders
         self.node_emb = nn.Linear(args['node_feat_size']+1, args['node_emb_size']) 
@@ -387,15 +394,23 @@ class PGP_SCOUTEncoder(PredictionEncoder):
                             (nbr_vehicle_masks_ori[:,:,:,0].sum(-1)<nbr_vehicle_masks.shape[-2]) # True where mask completely a vehicle [B,84]
         ############################
 
-        nbr_vehicle_embedding = self.leaky_relu(self.nbr_emb(nbr_vehicle_feats))
-        nbr_vehicle_enc = self.variable_size_gru_encode(nbr_vehicle_embedding, nbr_vehicle_masks, self.nbr_enc, batched=False) #B,84,32
-        _, masks_for_batching_veh = self.create_batched_input(nbr_vehicle_feats, nbr_vehicle_masks) #64,84,1,1
+        # Sequence plans computed at collate time, or on the device for inputs modified after collating
+        sequence_plans = inputs['sequence_plans'] if 'sequence_plans' in inputs else {}
         nbr_ped_feats = inputs['surrounding_agent_representation']['pedestrians']
         nbr_ped_feats = torch.cat((nbr_ped_feats, torch.ones_like(nbr_ped_feats[:, :, :, 0:1])), dim=-1)
         nbr_ped_masks = inputs['surrounding_agent_representation']['pedestrian_masks']
+        veh_plan = self.get_sequence_plan(sequence_plans, 'vehicles', nbr_vehicle_masks)
+        ped_plan = self.get_sequence_plan(sequence_plans, 'pedestrians', nbr_ped_masks)
+
+        nbr_vehicle_embedding = self.leaky_relu(self.nbr_emb(nbr_vehicle_feats))
         nbr_ped_embedding = self.leaky_relu(self.nbr_emb(nbr_ped_feats))
-        nbr_ped_enc = self.variable_size_gru_encode(nbr_ped_embedding, nbr_ped_masks, self.nbr_enc, batched=True) 
-        _, masks_for_batching_ped = self.create_batched_input(nbr_ped_feats, nbr_ped_masks) 
+        if self.fused_agent_encoding:
+            nbr_vehicle_enc, nbr_ped_enc = fused_gru_encode([nbr_vehicle_embedding, nbr_ped_embedding],
+                                                            [veh_plan, ped_plan], self.nbr_enc, batched=[False, True])
+        else:
+            nbr_vehicle_enc = packed_gru_encode(nbr_vehicle_embedding, veh_plan, self.nbr_enc, batched=False) #B,84,32
+            nbr_ped_enc = packed_gru_encode(nbr_ped_embedding, ped_plan, self.nbr_enc, batched=True)
+        _, masks_for_batching_veh = self.create_batched_input(nbr_vehicle_feats, nbr_vehicle_masks) #64,84,1,1
         # nbr_obj_feats = inputs['surrounding_agent_representation']['objects']
         # nbr_obj_feats = torch.cat((nbr_obj_feats, torch.ones_like(nbr_obj_feats[:, :, :, 0:1])), dim=-1)
         # nbr_obj_masks = inputs['surrounding_agent_representation']['object_masks']
@@ -414,9 +429,9 @@ class PGP_SCOUTEncoder(PredictionEncoder):
         lane_node_masks = inputs['map_representation']['lane_node_masks'] 
         lane_node_feats = torch.cat((lane_node_feats, lane_node_masks[:,:,:,:1]), dim=-1)
         batch_lane_node_masks = (~(lane_node_masks[:,:,:,0]!=0)).any(-1)
-        lane_node_feats_batched = lane_node_feats[batch_lane_node_masks] # BN,20,7
         lane_node_embedding = self.leaky_relu(self.node_emb(lane_node_feats)) 
-        lane_node_enc = self.variable_size_gru_encode(lane_node_embedding, lane_node_masks, self.node_gru_encoder, batched=True) 
+        lane_plan = self.get_sequence_plan(sequence_plans, 'lanes', lane_node_masks)
+        lane_node_enc = packed_gru_encode(lane_node_embedding, lane_plan, self.node_gru_encoder, batched=True)
         att = "att" in inputs 
         if self.hg=="hgt":
             lanes_graphs.nodes['l'].data['inp'] = lane_node_enc
@@ -427,7 +442,14 @@ class PGP_SCOUTEncoder(PredictionEncoder):
         else:
             h_dict = {'l': lane_node_enc, 'p': nbr_ped_enc, 'v': interaction_feats_batched}#, 'o': nbr_obj_enc}
             lane_node_enc, interaction_feats_batched, att = self.hg_encoder(lanes_graphs, h_dict, att)  
-        lane_node_enc = self.scatter_batched_input(lane_node_enc, batch_lane_node_masks.unsqueeze(-1).unsqueeze(-1))
+        if self.ragged_nodes:
+            # Flat lane node encodings, with the row of each lane node in the flat tensor, -1 for missing lane nodes
+            lane_node_flat_enc = lane_node_enc
+            lane_node_idcs = torch.cumsum(batch_lane_node_masks.flatten(), dim=0).view_as(batch_lane_node_masks) - 1
+            lane_node_idcs = lane_node_idcs.masked_fill(~batch_lane_node_masks, -1)
+            lane_node_enc = None
+        else:
+            lane_node_enc = self.scatter_batched_input(lane_node_enc, batch_lane_node_masks.unsqueeze(-1).unsqueeze(-1))
         interaction_feats = self.scatter_batched_input(interaction_feats_batched, interaction_masks[:,:,-1:].unsqueeze(-1)) # B, N, 32
         target_agent_enc = torch.cat((target_agent_enc, interaction_feats[:,0]), dim=-1) # B, 64
 
@@ -469,6 +491,9 @@ class PGP_SCOUTEncoder(PredictionEncoder):
                                           },
                      'att'  : att
                      }
+        if self.ragged_nodes:
+            encodings['context_encoding']['combined_flat'] = lane_node_flat_enc
+            encodings['context_encoding']['combined_idcs'] = lane_node_idcs
 
         # Pass on initial nodes and edge structure to aggregator if included in inputs
         if 'init_node' in inputs:
@@ -495,48 +520,15 @@ class PGP_SCOUTEncoder(PredictionEncoder):
         return input_batched, masks_for_batching
 
     @staticmethod
-    def variable_size_gru_encode(feat_embedding: torch.Tensor, masks: torch.Tensor, gru: nn.GRU, batched: bool = False) -> torch.Tensor:
+    def get_sequence_plan(sequence_plans: Dict, key: str, masks: torch.Tensor) -> Dict:
         """
-        Returns GRU encoding for a batch of inputs where each sample in the batch is a set of a variable number
-        of sequences, of variable lengths.
+        Returns sequence plan computed at collate time for the given input, or computes it from the masks on the
+        device, which synchronizes with the host.
         """
+        if key in sequence_plans:
+            return sequence_plans[key]
+        return get_sequence_plan(masks[:, :, :, 0])
 
-        # Form a large batch of all sequences in the batch
-        masks_for_batching = ~masks[:, :, :, 0].bool() # B, 164,20,6
-        masks_for_batching = masks_for_batching.any(dim=-1).unsqueeze(2).unsqueeze(3) # 32, 164,1,1
-        feat_embedding_batched = torch.masked_select(feat_embedding, masks_for_batching) 
-        feat_embedding_batched = feat_embedding_batched.view(-1, feat_embedding.shape[2], feat_embedding.shape[3]) # 970,20,16
-
-        # Pack padded sequences
-        seq_lens = torch.sum(1 - masks[:, :, :, 0], dim=-1) # B, 164
-        seq_lens_batched = seq_lens[seq_lens != 0].cpu() # Bx164 != 0 =» 970
-        if len(seq_lens_batched) != 0:
-            feat_embedding_packed = pack_padded_sequence(feat_embedding_batched, seq_lens_batched,
-                                                         batch_first=True, enforce_sorted=False)
-
-            # Encode
-            _, encoding_batched = gru(feat_embedding_packed)
-            encoding_batched = encoding_batched.squeeze(0)
-            if batched:
-                return encoding_batched
-
-            # Scatter back to appropriate batch index
-            masks_for_scattering = masks_for_batching.squeeze(3).repeat(1, 1, encoding_batched.shape[-1])
-            encoding = torch.zeros(masks_for_scattering.shape, device=device)
-            encoding = encoding.masked_scatter(masks_for_scattering, encoding_batched)
-
-        else:
-            if batched:
-                # return empty tensor
-                return torch.zeros((0,gru.hidden_size), device=device)
-            batch_size = feat_embedding.shape[0]
-            max_num = feat_embedding.shape[1]
-            hidden_state_size = gru.hidden_size
-            encoding = torch.zeros((batch_size, max_num, hidden_state_size), device=device)
-
-        return encoding
-
-    
     @staticmethod
     def scatter_batched_input(batched_input: torch.Tensor, masks_for_batching: torch.Tensor) -> torch.Tensor:
         """
@@ -0,0 +1,107 @@
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence
+from typing import Dict, List
+
+
+def get_sequence_plan(masks: torch.Tensor) -> Dict:
+    """
+    Computes indices and lengths for encoding a batch of sets of a variable number of sequences, of variable lengths.
+    Called at collate time on the host, so that encoding does not need to synchronize with the host. Computed on the
+    device as a fallback if the masks have been modified after collating, e.g. by GraphAugmentation.
+    :param masks: masks of first feature, 0 where valid, shape [batch_size, max_num, num_frames]
+    :return: Dict with
+        'idcs': indices of non-empty sequences in the flattened [batch_size x max_num] set, shape [num_seqs]
+        'lens': lengths of non-empty sequences, shape [num_seqs]
+        'packed_idcs': idcs, sorted by decreasing length, shape [num_seqs]
+        'unsort': position of each non-empty sequence in packed_idcs, shape [num_seqs]
+        'packed_lens': lengths sorted by decreasing length, np.ndarray kept on the host for packing, shape [num_seqs]
+    """
+    lens = torch.sum(masks == 0, dim=-1).flatten()
+    idcs = torch.nonzero(lens).squeeze(-1)
+    lens = lens[idcs]
+    packed_lens, order = torch.sort(lens, descending=True, stable=True)
+    unsort = torch.empty_like(order)
+    unsort[order] = torch.arange(len(order), device=order.device)
+
+    return {'idcs': idcs, 'lens': lens, 'packed_idcs': idcs[order], 'unsort': unsort,
+            'packed_lens': packed_lens.cpu().numpy()}
+
+
+def packed_gru_encode(feat_embedding: torch.Tensor, plan: Dict, gru: nn.GRU, batched: bool = False) -> torch.Tensor:
+    """
+    Returns GRU encoding for a batch of sets of a variable number of sequences, of variable lengths. Non-empty
+    sequences are selected in order of decreasing length and packed using the lengths of the sequence plan.
+    :param feat_embedding: sequence embeddings, shape [batch_size, max_num, num_frames, emb_size]
+    :param plan: sequence plan, see get_sequence_plan
+    :param gru: GRU encoder, batch first
+    :param batched: whether to return encodings of non-empty sequences only, shape [num_seqs, hidden_size], instead
+        of scattering them back to shape [batch_size, max_num, hidden_size]
+    """
+    batch_size, max_num, num_frames, emb_size = feat_embedding.shape
+    if len(plan['packed_lens']) == 0:
+        return empty_encoding(feat_embedding, gru, batched)
+
+    # Pack sequences, already sorted by decreasing length
+    feat_embedding_batched = feat_embedding.reshape(-1, num_frames, emb_size).index_select(0, plan['packed_idcs'])
+    feat_embedding_packed = pack_padded_sequence(feat_embedding_batched, torch.as_tensor(plan['packed_lens']),
+                                                 batch_first=True, enforce_sorted=True)
+
+    # Encode
+    _, encoding_batched = gru(feat_embedding_packed)
+    encoding_batched = encoding_batched.squeeze(0).index_select(0, plan['unsort'])
+
+    return encoding_batched if batched else scatter_encoding(encoding_batched, plan, batch_size, max_num)
+
+
+def fused_gru_encode(feat_embeddings: List[torch.Tensor], plans: List[Dict], gru: nn.GRU,
+                     batched: List[bool]) -> List[torch.Tensor]:
+    """
+    Returns GRU encodings for several batches of sets of short, fixed-length sequences sharing a GRU encoder, e.g.
+    surrounding vehicle and pedestrian histories, with a single call to the GRU. Sequences are not packed. The GRU runs
+    over all frames and the encoding of each sequence is the output at its last valid frame, which is the final hidden
+    state of the packed sequence.
+    :param feat_embeddings: sequence embeddings, each of shape [batch_size, max_num, num_frames, emb_size]
+    :param plans: sequence plan of each input, see get_sequence_plan
+    :param gru: GRU encoder, batch first, single layer
+    :param batched: whether to return encodings of non-empty sequences only for each input, see packed_gru_encode
+    """
+    # Select non-empty sequences of all inputs
+    feat_embedding_batched = [feat_embedding.reshape(-1, *feat_embedding.shape[2:]).index_select(0, plan['idcs'])
+                              for feat_embedding, plan in zip(feat_embeddings, plans)]
+    feat_embedding_batched = torch.cat(feat_embedding_batched, dim=0)
+    if feat_embedding_batched.shape[0] == 0:
+        return [empty_encoding(feat_embedding, gru, b) for feat_embedding, b in zip(feat_embeddings, batched)]
+
+    # Encode and gather output at last valid frame
+    output, _ = gru(feat_embedding_batched)
+    lens = torch.cat([plan['lens'] for plan in plans], dim=0)
+    encoding_batched = output[torch.arange(len(lens), device=output.device), lens - 1]
+
+    # Split back by input
+    encodings = []
+    for feat_embedding, plan, b, enc in zip(feat_embeddings, plans, batched,
+                                            torch.split(encoding_batched, [len(plan['idcs']) for plan in plans])):
+        encodings.append(enc if b else scatter_encoding(enc, plan, feat_embedding.shape[0], feat_embedding.shape[1]))
+
+    return encodings
+
+
+def scatter_encoding(encoding_batched: torch.Tensor, plan: Dict, batch_size: int, max_num: int) -> torch.Tensor:
+    """
+    Scatters encodings of non-empty sequences back to shape [batch_size, max_num, hidden_size], zeros elsewhere
+    """
+    encoding = torch.zeros((batch_size * max_num, encoding_batched.shape[-1]), device=encoding_batched.device,
+                           dtype=encoding_batched.dtype)
+    encoding = encoding.index_copy(0, plan['idcs'], encoding_batched)
+    return encoding.view(batch_size, max_num, -1)
+
+
+def empty_encoding(feat_embedding: torch.Tensor, gru: nn.GRU, batched: bool) -> torch.Tensor:
+    """
+    Returns encoding of a batch without non-empty sequences
+    """
+    if batched:
+        return torch.zeros((0, gru.hidden_size), device=feat_embedding.device)
+    return torch.zeros((feat_embedding.shape[0], feat_embedding.shape[1], gru.hidden_size),
+                       device=feat_embedding.device)
@@ -0,0 +1,139 @@
+import torch
+from typing import Dict
+
+
+class GraphAugmentation:
+    """
+    Stochastic masking of batches collated by Collate_heterograph, applied with tensor operations on the device after
+    transfer. Supports:
+        - lane masking: each lane node is masked out with probability lane_mask_prob
+        - vehicle masking: each surrounding vehicle is masked out with probability agent_mask_prob_v
+        - frame masking: each frame of vehicles adjacent to the target agent is masked out with probability
+          mask_frames. Vehicles that are not adjacent to the target agent are masked out, and vehicles with a masked
+          frame are disconnected from all lanes.
+    Samples with lanes already masked out by the collate function ('mask_out_lanes', set by the visualizer) are not
+    lane masked again.
+    Masked out lanes and vehicles are removed from the batched heterograph along with their edges. Pedestrian nodes
+    are kept, pedestrians without edges left do not contribute to lane and vehicle encodings. Sequence plans computed
+    at collate time for masked lanes and vehicles are dropped and recomputed by the encoder.
+    """
+
+    def __init__(self, args: Dict, device: torch.device):
+        """
+        :param args: encoder arguments with lane_mask_prob, agent_mask_prob_v, mask_frames and optionally mask_seed,
+            the seed of the random number generator
+        :param device: device the batches are sent to
+        """
+        self.lane_mask_prob = args['lane_mask_prob']
+        self.agent_mask_prob_v = args['agent_mask_prob_v']
+        self.mask_frames = args['mask_frames']
+        self.device = device
+
+        # Initialize random number generator
+        self.generator = torch.Generator(device=device)
+        if 'mask_seed' in args.keys() and args['mask_seed'] is not None:
+            self.generator.manual_seed(args['mask_seed'])
+        else:
+            self.generator.seed()
+
+    def enabled(self) -> bool:
+        """
+        Whether any masking is applied
+        """
+        return self.lane_mask_prob > 0 or self.agent_mask_prob_v > 0 or self.mask_frames > 0
+
+    def __call__(self, inputs: Dict) -> Dict:
+        """
+        Applies masking to model inputs in place
+        :param inputs: model inputs on the device, with compact dtypes upcast
+        :return: masked model inputs
+        """
+        if not self.enabled():
+            return inputs
+
+        map_representation = inputs['map_representation']
+        sequence_plans = inputs['sequence_plans'] if 'sequence_plans' in inputs else {}
+        agents = inputs['surrounding_agent_representation']
+        lane_node_masks = map_representation['lane_node_masks']
+        veh_masks = agents['vehicle_masks']
+        agent_node_masks = inputs['agent_node_masks']['vehicles']
+        batch_size, max_nodes = lane_node_masks.shape[:2]
+        max_vehicles, num_frames = veh_masks.shape[1:3]
+
+        # Graph nodes before masking: lanes kept by the collate function are numbered in order up to the number of lane
+        # nodes of each sample, vehicle nodes are the target agent followed by vehicles that are not fully masked out
+        lanes_graphs = inputs['lanes_graphs'].to(self.device)
+        num_lanes = lanes_graphs.batch_num_nodes('l').to(self.device).long()
+        if 'lane_keep' in map_representation:
+            lane_keep = map_representation['lane_keep'].to(self.device).bool()
+        else:
+            lane_keep = torch.ones((batch_size, max_nodes), dtype=torch.bool, device=self.device)
+        lane_ids = torch.cumsum(lane_keep.long(), dim=1) - 1
+        lane_nodes = torch.nonzero(lane_keep & (lane_ids < num_lanes[:, None]), as_tuple=True)
+        veh_nodes = torch.cat((torch.ones((batch_size, 1), dtype=torch.bool, device=self.device),
+                               (veh_masks[:, :, :, 0] == 0).any(-1)), dim=1)
+        veh_nodes = torch.nonzero(veh_nodes, as_tuple=True)
+
+        # Lane masking
+        lane_out = torch.zeros((batch_size, max_nodes), dtype=torch.bool, device=self.device)
+        if self.lane_mask_prob > 0:
+            lane_out = self.sample((batch_size, max_nodes)) < self.lane_mask_prob
+            lane_out = lane_out & lane_keep.all(dim=1, keepdim=True)
+            sequence_plans.pop('lanes', None)
+            lane_node_masks = torch.maximum(lane_node_masks, lane_out[:, :, None, None].to(lane_node_masks.dtype))
+            map_representation['lane_node_masks'] = lane_node_masks
+            for key in ['succ_adj_matrix', 'prox_adj_matrix']:
+                if key in map_representation:
+                    map_representation[key] = map_representation[key] * (1 - lane_node_masks[:, None, :, 0, 0])
+            agent_node_masks = torch.maximum(agent_node_masks,
+                                             lane_node_masks[:, :, 0, 0:1].to(agent_node_masks.dtype))
+
+            # To keep the indexing consistent, we set to 0 the edge type of edges to masked out lanes, i.e. no edge,
+            # and the edges of masked out lanes point to node 0
+            s_next = map_representation['s_next'].long()
+            to_masked_lane = (s_next < max_nodes) & \
+                torch.gather(lane_out, 1, s_next.clamp(max=max_nodes - 1).view(batch_size, -1)).view_as(s_next)
+            map_representation['edge_type'] = map_representation['edge_type'].masked_fill(to_masked_lane, 0)
+            map_representation['s_next'] = map_representation['s_next'].masked_fill(lane_out[:, :, None], 0)
+
+        # Vehicle masking
+        if self.agent_mask_prob_v > 0:
+            veh_out = self.sample((batch_size, max_vehicles)) < self.agent_mask_prob_v
+            veh_masks = torch.maximum(veh_masks, veh_out[:, :, None, None].to(veh_masks.dtype))
+            agent_node_masks = torch.maximum(agent_node_masks, veh_out[:, None, :].to(agent_node_masks.dtype))
+
+        # Frame masking, for vehicles adjacent to the target agent
+        if self.mask_frames > 0:
+            target_adj_matrix = agents['adj_matrix'][:, 0, 1:max_vehicles + 1]
+            keep = self.sample((batch_size, max_vehicles, num_frames)) > self.mask_frames
+            keep = target_adj_matrix[:, :, None] * keep
+            veh_masks = torch.maximum(veh_masks, (1 - keep)[:, :, :, None].to(veh_masks.dtype))
+            agent_node_masks = torch.maximum(agent_node_masks,
+                                             veh_masks[:, :, :, 0].amax(-1)[:, None, :].to(agent_node_masks.dtype))
+
+        agents['vehicle_masks'] = veh_masks
+        if self.agent_mask_prob_v > 0 or self.mask_frames > 0:
+            sequence_plans.pop('vehicles', None)
+        inputs['agent_node_masks']['vehicles'] = agent_node_masks
+
+        # Remove vehicle-lane edges masked out in the agent-node masks
+        src, dst, eids = lanes_graphs.edges(form='all', etype='v_close_l')
+        src, dst = src.long(), dst.long()
+        b, veh, lane = veh_nodes[0][src], veh_nodes[1][src] - 1, lane_nodes[1][dst]
+        masked_out = (veh >= 0) & (agent_node_masks[b, lane, veh.clamp(min=0)] != 0)
+        lanes_graphs.remove_edges(eids[masked_out], etype='v_close_l')
+
+        # Remove masked out lanes and vehicles that are fully masked out
+        lanes_graphs.remove_nodes(torch.nonzero(lane_out[lane_nodes]).squeeze(-1).to(lanes_graphs.idtype), ntype='l')
+        veh_removed = (veh_masks[:, :, :, 0] != 0).all(-1)
+        veh_removed = torch.cat((torch.zeros_like(veh_removed[:, :1]), veh_removed), dim=1)
+        lanes_graphs.remove_nodes(torch.nonzero(veh_removed[veh_nodes]).squeeze(-1).to(lanes_graphs.idtype), ntype='v')
+        inputs['lanes_graphs'] = lanes_graphs
+
+        return inputs
+
+    def sample(self, size) -> torch.Tensor:
+        """
+        Samples uniform random numbers in [0, 1) on the device with the seeded generator
+        """
+        return torch.rand(size, generator=self.generator, device=self.device)
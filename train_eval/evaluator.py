@@ -9,7 +9,8 @@ import numpy as np
 from nuscenes.prediction.helper import convert_local_coords_to_global
 from nuscenes.eval.prediction.data_classes import Prediction
 import json
-from train_eval.utils import Collate_heterograph
+from train_eval.utils import Collate_heterograph, collate_ragged
+from train_eval.augmentation import GraphAugmentation
 
 
 # Initialize device:
@@ -31,14 +32,15 @@ class Evaluator:
 
         # Initialize dataset
         ds_type = cfg['dataset'] + '_' + cfg['agent_setting'] + '_' + cfg['input_representation']
-        spec_args = get_specific_args(cfg['dataset'], data_root, cfg['version'] if 'version' in cfg.keys() else None)[0]
+        spec_args = get_specific_args(cfg['dataset'], data_root, cfg['version'] if 'version' in cfg.keys() else None,
+                                      lazy=True)[0]
         test_set = initialize_dataset(ds_type, ['load_data', data_dir, cfg['test_set_args']] + spec_args)
 
         # Initialize dataloader
         if 'scout' in cfg['encoder_type']:
-            collate_fn = Collate_heterograph(cfg['encoder_args'])
+            collate_fn = Collate_heterograph()
         else:
-            collate_fn = None
+            collate_fn = collate_ragged
         self.dl = torch_data.DataLoader(test_set, cfg['batch_size'], shuffle=False, num_workers=cfg['num_workers'], collate_fn=collate_fn)
 
         # Initialize model
@@ -47,6 +49,11 @@ class Evaluator:
         self.model = self.model.float().to(device)
         self.model.eval()
 
+        # Initialize stochastic masking of heterograph batches for robustness analysis, applied on the device
+        self.augmentation = None
+        if 'scout' in cfg['encoder_type']:
+            self.augmentation = GraphAugmentation(cfg['encoder_args'], device)
+
         # Load checkpoint
         checkpoint = torch.load(checkpoint_path)
         self.model.load_state_dict(checkpoint['model_state_dict'], strict=False)
@@ -70,7 +77,9 @@ class Evaluator:
             for i, data in enumerate(self.dl):
 
                 # Load data
-                data = u.send_to_device(u.convert_double_to_float(data))
+                data = u.upcast_compact_dtypes(u.send_to_device(u.convert_double_to_float(data)))
+                if self.augmentation is not None:
+                    data['inputs'] = self.augmentation(data['inputs'])
 
                 # Forward pass
                 predictions = self.model(data['inputs'])
@@ -135,8 +144,8 @@ class Evaluator:
         Sets up list of Prediction objects for the nuScenes benchmark.
         """
 
-        # NuScenes prediction helper
-        helper = self.dl.dataset.helper
+        # Dataset, for target agent annotations
+        dataset = self.dl.dataset
 
         # List of predictions
         preds = []
@@ -145,7 +154,9 @@ class Evaluator:
             for i, data in enumerate(self.dl):
 
                 # Load data
-                data = u.send_to_device(u.convert_double_to_float(data))
+                data = u.upcast_compact_dtypes(u.send_to_device(u.convert_double_to_float(data)))
+                if self.augmentation is not None:
+                    data['inputs'] = self.augmentation(data['inputs'])
 
                 # Forward pass
                 predictions = self.model(data['inputs'])
@@ -161,7 +172,7 @@ class Evaluator:
 
                     traj_local = traj[n].detach().cpu().numpy()
                     probs_n = probs[n].detach().cpu().numpy()
-                    starting_annotation = helper.get_sample_annotation(instance_tokens[n], sample_tokens[n])
+                    starting_annotation = dataset.get_target_agent_annotation(instance_tokens[n], sample_tokens[n])
                     traj_global = np.zeros_like(traj_local)
                     for m in range(traj_local.shape[0]):
                         traj_global[m] = convert_local_coords_to_global(traj_local[m],
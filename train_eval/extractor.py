@@ -0,0 +1,166 @@
+from datasets.interface import TrajectoryDataset
+from typing import List, Dict, Tuple, Set
+import multiprocessing as mp
+import hashlib
+import json
+import os
+import time
+
+
+# Dataset being extracted. Set in the parent process right before the worker pool is forked, so that workers inherit
+# the already initialized dataset (nuScenes tables, maps) copy-on-write instead of rebuilding it.
+_shared_dataset = None
+
+
+def _extract_shard(idcs: List[int]) -> Tuple[List[int], Dict[str, float]]:
+    """
+    Worker function. Extracts all samples of a shard and returns their indices along with per-stage timings.
+    :param idcs: dataset indices in the shard
+    :return: extracted indices, time spent in each extraction stage while extracting the shard
+    """
+    dataset = _shared_dataset
+    dataset.stage_timings = {}
+    for idx in idcs:
+        dataset.extract_data(idx)
+
+    return idcs, dict(dataset.stage_timings) if hasattr(dataset, 'stage_timings') else {}
+
+
+class ParallelExtractor:
+    """
+    Multi-process extraction engine. Shards the token list of each split across a pool of worker processes, records
+    completed samples in a per-split manifest and skips them when restarted after a crash. The manifest is keyed on
+    the set args of the split and the dataset stats, and ignored if either has changed since it was written. It is
+    deleted once a split has been extracted completely, so that later runs extract the split again.
+    """
+    def __init__(self, dataset_splits: List[TrajectoryDataset], num_workers: int, shard_size: int = 16,
+                 resume: bool = False, split_args: List[Dict] = None, verbose: bool = False):
+        """
+        Initialize extraction engine
+        :param dataset_splits: List of dataset objects usually corresponding to the train, val and test splits
+        :param num_workers: Number of worker processes, 0 extracts in the main process
+        :param shard_size: Number of consecutive samples handed to a worker at a time
+        :param resume: Whether to skip samples already listed in the manifest of an interrupted run
+        :param split_args: set args of each split, used to key the manifest
+        :param verbose: Whether to print progress
+        """
+        # Check if all datasets have been initialized with the correct mode
+        for dataset in dataset_splits:
+            if dataset.mode != 'extract_data':
+                raise Exception('Dataset mode should be extract_data')
+
+        self.dataset_splits = dataset_splits
+        self.num_workers = num_workers
+        self.shard_size = shard_size
+        self.resume = resume
+        self.split_args = split_args if split_args is not None else [{} for _ in dataset_splits]
+        self.verbose = verbose
+
+    def extract(self):
+        """
+        Extracts pre-processed data for all splits
+        """
+        print("Extracting pre-processed data...")
+        for dataset, args in zip(self.dataset_splits, self.split_args):
+            self.extract_split(dataset, args)
+
+    def extract_split(self, dataset: TrajectoryDataset, args: Dict):
+        """
+        Extracts pre-processed data for a single split
+        :param dataset: dataset object in extract_data mode
+        :param args: set args of the split
+        """
+        global _shared_dataset
+
+        # Skip samples extracted by an interrupted run with the same set args and stats
+        manifest_path = self.get_manifest_path(dataset)
+        manifest_key = self.get_manifest_key(dataset, args)
+        completed = self.load_manifest(manifest_path, manifest_key) if self.resume else set()
+        if len(completed) == 0:
+            with open(manifest_path, 'w') as manifest:
+                manifest.write('# ' + manifest_key + '\n')
+        pending = [idx for idx in range(len(dataset)) if dataset.token_list[idx] not in completed]
+        shards = [pending[i:i + self.shard_size] for i in range(0, len(pending), self.shard_size)]
+        print(dataset.split + ': ' + str(len(completed)) + ' samples already extracted, ' + str(len(pending)) +
+              ' to go')
+
+        # Extract shards, appending completed tokens to the manifest as soon as a shard is done
+        stage_timings = {}
+        num_extracted = 0
+        st_time = time.time()
+        _shared_dataset = dataset
+        with open(manifest_path, 'a') as manifest:
+            if self.num_workers > 0:
+                pool = mp.get_context('fork').Pool(self.num_workers)
+                results = pool.imap_unordered(_extract_shard, shards)
+            else:
+                pool = None
+                results = map(_extract_shard, shards)
+
+            try:
+                for idcs, shard_timings in results:
+                    manifest.write(''.join(dataset.token_list[idx] + '\n' for idx in idcs))
+                    manifest.flush()
+                    for k, v in shard_timings.items():
+                        stage_timings[k] = stage_timings.get(k, 0) + v
+                    num_extracted += len(idcs)
+
+                    # Show progress
+                    if self.verbose:
+                        print(dataset.split + ': ' + str(num_extracted) + '/' + str(len(pending)) + ' samples, ' +
+                              format(time.time() - st_time, '0.1f') + 's')
+            finally:
+                if pool is not None:
+                    pool.terminate()
+                _shared_dataset = None
+
+        # Split is complete, the next run extracts it again
+        os.remove(manifest_path)
+
+        self.print_timings(dataset.split, stage_timings, num_extracted, time.time() - st_time)
+
+    @staticmethod
+    def get_manifest_path(dataset: TrajectoryDataset) -> str:
+        """
+        Returns path of the completion manifest for a split
+        """
+        return os.path.join(dataset.data_dir, 'manifest_' + dataset.split + '.txt')
+
+    @staticmethod
+    def get_manifest_key(dataset: TrajectoryDataset, args: Dict) -> str:
+        """
+        Returns key of the manifest of a split, a hash of its set args and of the dataset stats. The spill cache only
+        changes how samples are extracted, not the extracted data, and is left out.
+        """
+        key = hashlib.md5(json.dumps({k: v for k, v in args.items() if k != 'spill_cache'}, sort_keys=True,
+                                     default=str).encode())
+        stats_path = os.path.join(dataset.data_dir, 'stats.pickle')
+        if os.path.isfile(stats_path):
+            with open(stats_path, 'rb') as handle:
+                key.update(handle.read())
+        return key.hexdigest()
+
+    @staticmethod
+    def load_manifest(manifest_path: str, manifest_key: str) -> Set[str]:
+        """
+        Loads tokens of samples extracted by an interrupted run, if its manifest has the same key
+        """
+        if not os.path.isfile(manifest_path):
+            return set()
+        with open(manifest_path, 'r') as manifest:
+            lines = [line.strip() for line in manifest if line.strip()]
+        if len(lines) == 0 or lines[0] != '# ' + manifest_key:
+            print(manifest_path + ' was written with different set args or stats, extracting all samples')
+            return set()
+        return set(lines[1:])
+
+    @staticmethod
+    def print_timings(split: str, stage_timings: Dict[str, float], num_samples: int, wall_time: float):
+        """
+        Prints time spent in each extraction stage, summed over all worker processes
+        """
+        print(split + ': extracted ' + str(num_samples) + ' samples in ' + format(wall_time, '0.1f') + 's')
+        for stage, stage_time in stage_timings.items():
+            per_sample = stage_time / num_samples * 1000 if num_samples > 0 else 0
+            print('    ' + stage + ': ' + format(stage_time, '0.1f') + 's total, ' + format(per_sample, '0.2f') +
+                  'ms/sample')
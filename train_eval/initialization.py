@@ -2,6 +2,7 @@
 from models.encoders.scout_encoder import SCOUTEncoder
 from nuscenes import NuScenes
 from nuscenes.prediction import PredictHelper
+from datasets.nuScenes.lazy import LazyNuScenes, LazyPredictHelper
 from datasets.interface import TrajectoryDataset
 from datasets.nuScenes.nuScenes_raster import NuScenesRaster
 from datasets.nuScenes.nuScenes_vector import NuScenesVector
@@ -48,15 +49,21 @@ def initialize_dataset(dataset_type: str, args: List) -> TrajectoryDataset:
     return dataset_classes[dataset_type](*args)
 
 
-def get_specific_args(dataset_name: str, data_root: str, version: str = None) -> List:
+def get_specific_args(dataset_name: str, data_root: str, version: str = None, lazy: bool = False) -> List:
     """
     Helper function to get dataset specific arguments.
+    :param lazy: Whether to defer loading dataset metadata until it is first accessed. Used for datasets in load_data
+        mode, which usually do not need it.
     """
     # TODO: Add more datasets as implemented
     specific_args = []
     if dataset_name == 'nuScenes':
-        ns = NuScenes(version, dataroot=data_root)
-        pred_helper = PredictHelper(ns)
+        if lazy:
+            ns = LazyNuScenes(version, dataroot=data_root)
+            pred_helper = LazyPredictHelper(ns)
+        else:
+            ns = NuScenes(version, dataroot=data_root)
+            pred_helper = PredictHelper(ns)
         specific_args.append([pred_helper])
         specific_args.append([ns])
 
@@ -4,7 +4,9 @@ from typing import List, Dict
 import torch
 import os
 import pickle
+import shutil
 from train_eval.initialization import get_specific_args, initialize_dataset
+from train_eval.extractor import ParallelExtractor
 
 
 def preprocess_data(cfg: Dict, data_root: str, data_dir: str, compute_stats=False, extract=True):
@@ -24,6 +26,12 @@ def preprocess_data(cfg: Dict, data_root: str, data_dir: str, compute_stats=Fals
     # Get dataset specific args
     specific_args = get_specific_args(cfg['dataset'], data_root, cfg['version'] if 'version' in cfg.keys() else None)[0]
 
+    # Single pass: cache variable-length map and agent elements while computing stats and only pad them while
+    # extracting data, instead of running every sample through the map api twice
+    spill_cache = compute_stats and extract and 'spill_cache' in cfg.keys() and cfg['spill_cache']
+    for set_args in [cfg['train_set_args'], cfg['val_set_args'], cfg['test_set_args']]:
+        set_args['spill_cache'] = spill_cache
+
     # Compute stats
     if compute_stats:
         train_set = initialize_dataset(ds_type, ['compute_stats', data_dir, cfg['train_set_args']] + specific_args)
@@ -37,7 +45,29 @@ def preprocess_data(cfg: Dict, data_root: str, data_dir: str, compute_stats=Fals
         train_set = initialize_dataset(ds_type, ['extract_data', data_dir, cfg['train_set_args']] + specific_args)
         val_set = initialize_dataset(ds_type, ['extract_data', data_dir, cfg['val_set_args']] + specific_args)
         test_set = initialize_dataset(ds_type, ['extract_data', data_dir, cfg['test_set_args']] + specific_args)
-        extract_data([train_set, val_set, test_set], cfg['batch_size'], cfg['num_workers'], verbose=cfg['verbosity'])
+        if 'extraction_engine' in cfg.keys() and cfg['extraction_engine'] == 'parallel':
+            extractor = ParallelExtractor([train_set, val_set, test_set], cfg['num_workers'],
+                                          shard_size=cfg['shard_size'] if 'shard_size' in cfg.keys() else 16,
+                                          resume=cfg['resume'] if 'resume' in cfg.keys() else False,
+                                          split_args=[cfg['train_set_args'], cfg['val_set_args'],
+                                                      cfg['test_set_args']],
+                                          verbose=cfg['verbosity'])
+            extractor.extract()
+        else:
+            extract_data([train_set, val_set, test_set], cfg['batch_size'], cfg['num_workers'],
+                         verbose=cfg['verbosity'])
+
+        # Spilled elements are no longer needed once all splits have been extracted
+        if spill_cache:
+            shutil.rmtree(train_set.spill_dir, ignore_errors=True)
+
+        # Pack per-sample pickle files into memory-mapped sample stores
+        if 'pack_data' in cfg.keys() and cfg['pack_data']:
+            pack_data([train_set, val_set, test_set], verbose=cfg['verbosity'])
+
+        # Save number of lane nodes, agents and edges of each sample, for length-bucketed batching
+        if 'sample_sizes' in cfg.keys() and cfg['sample_sizes']:
+            save_sample_sizes([train_set, val_set, test_set], verbose=cfg['verbosity'])
 
 
 def compute_dataset_stats(dataset_splits: List[TrajectoryDataset], batch_size: int, num_workers: int, verbose=False):
@@ -121,3 +151,27 @@ def extract_data(dataset_splits: List[TrajectoryDataset], batch_size: int, num_w
             if verbose:
                 print("mini batch " + str(mini_batch_count + 1) + '/' + str(num_mini_batches))
                 mini_batch_count += 1
+
+
+def pack_data(dataset_splits: List[TrajectoryDataset], verbose=False):
+    """
+    Packs extracted pre-processed data into columnar, memory-mapped sample stores, one per split
+
+    :param dataset_splits: List of dataset objects usually corresponding to the train, val and test splits
+    :param verbose: Whether to print progress
+    """
+    print("Packing pre-processed data...")
+    for dataset in dataset_splits:
+        dataset.pack_data(verbose=verbose)
+
+
+def save_sample_sizes(dataset_splits: List[TrajectoryDataset], verbose=False):
+    """
+    Saves number of lane nodes, surrounding agents and lane graph edges of each extracted sample, one file per split
+
+    :param dataset_splits: List of dataset objects usually corresponding to the train, val and test splits
+    :param verbose: Whether to print progress
+    """
+    print("Saving sample sizes...")
+    for dataset in dataset_splits:
+        dataset.save_sample_sizes(verbose=verbose)
@@ -0,0 +1,102 @@
+import torch
+import torch.utils.data as torch_data
+import numpy as np
+from typing import List, Iterator
+
+
+class BucketBatchSampler(torch_data.Sampler):
+    """
+    Batch sampler grouping samples of similar size, so that padding to the batch maximum and packed sequence encoding
+    do not scale with the largest sample in the dataset. Each epoch, samples are shuffled and split into pools of
+    pool_size batches. Samples in each pool are sorted by number of lane nodes, agents and edges and split into
+    batches, and the order of all batches is shuffled.
+    Batches either have a fixed batch_size, or, with node_budget set, a variable size such that the padded number of
+    lane nodes in a batch (batch size x largest number of lane nodes) stays within node_budget.
+    """
+
+    def __init__(self, sizes: np.ndarray, batch_size: int, pool_size: int = 50, node_budget: int = None,
+                 seed: int = None):
+        """
+        :param sizes: number of lane nodes, agents and edges of each sample, shape [num_samples, 3]
+        :param batch_size: number of samples per batch, or maximum number of samples per batch with node_budget
+        :param pool_size: number of batches per pool of samples sorted by size
+        :param node_budget: maximum padded number of lane nodes per batch, fixed batch size if None
+        :param seed: seed of the random number generator, shared by all epochs
+        """
+        super().__init__()
+        self.sizes = np.asarray(sizes).reshape(len(sizes), -1)
+        self.batch_size = batch_size
+        self.pool_size = pool_size
+        self.node_budget = node_budget
+
+        # Initialize random number generator
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        else:
+            self.generator.seed()
+
+        # Batches of the current epoch. Drawn on first use, by __len__ before the first epoch, and by each following
+        # call to __iter__
+        self.batches = None
+        self.iterated = False
+
+    def __iter__(self) -> Iterator[List[int]]:
+        if self.batches is None or self.iterated:
+            self.batches = self.get_batches()
+        self.iterated = True
+        return iter(self.batches)
+
+    def __len__(self) -> int:
+        """
+        Number of batches in the current epoch. With node_budget set, this depends on the shuffle, so it is the number
+        of batches last drawn, which are drawn here if __iter__ has not been called yet. Batches of the next epoch are
+        only drawn by the next call to __iter__.
+        """
+        if self.node_budget is None:
+            num_samples = len(self.sizes)
+            pool_samples = self.batch_size * self.pool_size
+            num_full_pools = num_samples // pool_samples
+            last_pool = num_samples - num_full_pools * pool_samples
+            return num_full_pools * self.pool_size + int(np.ceil(last_pool / self.batch_size))
+        if self.batches is None:
+            self.batches = self.get_batches()
+        return len(self.batches)
+
+    def get_batches(self) -> List[List[int]]:
+        """
+        Draws the batches of an epoch
+        """
+        permutation = torch.randperm(len(self.sizes), generator=self.generator).numpy()
+        pool_samples = self.batch_size * self.pool_size
+        batches = []
+        for start in range(0, len(permutation), pool_samples):
+            pool = permutation[start:start + pool_samples]
+            pool_sizes = self.sizes[pool]
+            pool = pool[np.lexsort(pool_sizes[:, ::-1].T)]
+            batches += self.split_pool(pool, self.sizes[pool, 0])
+
+        order = torch.randperm(len(batches), generator=self.generator).tolist()
+        return [batches[i] for i in order]
+
+    def split_pool(self, pool: np.ndarray, num_nodes: np.ndarray) -> List[List[int]]:
+        """
+        Splits a pool of samples sorted by size into batches
+        :param pool: sample indices, sorted by size
+        :param num_nodes: number of lane nodes of each sample in the pool, ascending
+        """
+        if self.node_budget is None:
+            return [pool[i:i + self.batch_size].tolist() for i in range(0, len(pool), self.batch_size)]
+
+        # Grow each batch while the padded number of lane nodes stays within the budget. Samples are sorted, so the
+        # last sample added has the largest number of lane nodes.
+        batches = []
+        start = 0
+        for end in range(1, len(pool) + 1):
+            if end - start > self.batch_size or (end - start) * max(num_nodes[end - 1], 1) > self.node_budget:
+                if end - 1 > start:
+                    batches.append(pool[start:end - 1].tolist())
+                    start = end - 1
+        batches.append(pool[start:].tolist())
+
+        return batches
@@ -8,6 +8,8 @@ import time
 import math
 import os
 import train_eval.utils as u
+from train_eval.augmentation import GraphAugmentation
+from train_eval.sampler import BucketBatchSampler
 import wandb
 from wandb import AlertLevel
 
@@ -33,18 +35,29 @@ class Trainer:
 
         # Initialize datasets:
         ds_type = cfg['dataset'] + '_' + cfg['agent_setting'] + '_' + cfg['input_representation']
-        spec_args = get_specific_args(cfg['dataset'], data_root, cfg['version'] if 'version' in cfg.keys() else None)[0]
+        spec_args = get_specific_args(cfg['dataset'], data_root, cfg['version'] if 'version' in cfg.keys() else None,
+                                      lazy=True)[0]
         train_set = initialize_dataset(ds_type, ['load_data', data_dir, cfg['train_set_args']] + spec_args)
         val_set = initialize_dataset(ds_type, ['load_data', data_dir, cfg['val_set_args']] + spec_args)
         datasets = {'train': train_set, 'val': val_set}
 
         # Initialize dataloaders
         if 'scout' in cfg['encoder_type']:
-            collate_fn = u.Collate_heterograph(cfg['encoder_args'])
+            collate_fn = u.Collate_heterograph()
         else:
-            collate_fn = None
-        self.tr_dl = torch_data.DataLoader(datasets['train'], cfg['batch_size'], shuffle=True,
-                                           num_workers=cfg['num_workers'], pin_memory=True, collate_fn=collate_fn)
+            collate_fn = u.collate_ragged
+        if 'bucketing' in cfg.keys() and cfg['bucketing']:
+            # Batches of samples with similar numbers of lane nodes, agents and edges
+            batch_sampler = BucketBatchSampler(train_set.load_sample_sizes(), cfg['batch_size'],
+                                               pool_size=cfg['bucket_pool_size'] if 'bucket_pool_size' in cfg.keys()
+                                               else 50,
+                                               node_budget=cfg['node_budget'] if 'node_budget' in cfg.keys() else None,
+                                               seed=cfg['bucket_seed'] if 'bucket_seed' in cfg.keys() else None)
+            self.tr_dl = torch_data.DataLoader(datasets['train'], batch_sampler=batch_sampler,
+                                               num_workers=cfg['num_workers'], pin_memory=True, collate_fn=collate_fn)
+        else:
+            self.tr_dl = torch_data.DataLoader(datasets['train'], cfg['batch_size'], shuffle=True,
+                                               num_workers=cfg['num_workers'], pin_memory=True, collate_fn=collate_fn)
         self.val_dl = torch_data.DataLoader(datasets['val'], cfg['batch_size'], shuffle=False,
                                             num_workers=cfg['num_workers'], pin_memory=True, collate_fn=collate_fn )
 
@@ -53,6 +66,11 @@ class Trainer:
                                                  cfg['encoder_args'], cfg['aggregator_args'], cfg['decoder_args'])
         self.model = self.model.float().to(device)
 
+        # Initialize stochastic masking of heterograph batches, applied on the device
+        self.augmentation = None
+        if 'scout' in cfg['encoder_type']:
+            self.augmentation = GraphAugmentation(cfg['encoder_args'], device)
+
         # Initialize optimizer and scheduler
         self.optimizer = torch.optim.AdamW(self.model.parameters(), lr=cfg['optim_args']['lr'])
         self.scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, step_size=cfg['optim_args']['scheduler_step'],
@@ -169,7 +187,9 @@ class Trainer:
         for i, data in enumerate(dl):
 
             # Load data
-            data = u.send_to_device(u.convert_double_to_float(data))
+            data = u.upcast_compact_dtypes(u.send_to_device(u.convert_double_to_float(data)))
+            if self.augmentation is not None:
+                data['inputs'] = self.augmentation(data['inputs'])
 
             # Forward pass
             predictions = self.model(data['inputs'])
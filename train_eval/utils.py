@@ -1,11 +1,13 @@
 from sklearn.metrics import v_measure_score
 import torch.optim
-from typing import Dict, Union, List
+from typing import Dict, Union, List, Tuple
 import torch
 import numpy as np
 import dgl
 import scipy.sparse as spp 
 from torch.utils.data._utils.collate import default_collate
+import datasets.nuScenes.heterograph as hg
+from models.sequence_encoding import get_sequence_plan
 
 
 # Initialize device:
@@ -26,6 +28,32 @@ def convert_double_to_float(data: Union[Dict, torch.Tensor]):
         return data
 
 
+def upcast_compact_dtypes(data: Union[Dict, torch.Tensor, np.ndarray]):
+    """
+    Utility function to convert compact dtypes in nested dictionary with Tensors (float16 features, uint8 and bool
+    masks, int16 node indices, int8 edge types) back to float32 and int64. Called after sending data to the device,
+    so that host to device transfers use the compact dtypes.
+    """
+    if type(data) is torch.Tensor:
+        if data.dtype in [torch.float16, torch.uint8, torch.int16, torch.bool]:
+            return data.float()
+        elif data.dtype == torch.int8:
+            return data.long()
+        return data
+    elif type(data) is np.ndarray:
+        if data.dtype in [np.float16, np.uint8, np.int16, bool]:
+            return data.astype(np.float32)
+        elif data.dtype == np.int8:
+            return data.astype(np.int64)
+        return data
+    elif type(data) is dict:
+        for k, v in data.items():
+            data[k] = upcast_compact_dtypes(v)
+        return data
+    else:
+        return data
+
+
 def send_to_device(data: Union[Dict, torch.Tensor]):
     """
     Utility function to send nested dictionary with Tensors to GPU
@@ -55,6 +83,104 @@ def convert2tensors(data):
 
 
 
+def is_ragged(element: Dict) -> bool:
+    """
+    Whether a sample has been extracted in ragged mode, i.e. with actual numbers of lane nodes and agents and COO
+    adjacency instead of dense arrays padded to the dataset maxima
+    """
+    return 'adj_edges' in element['inputs']['surrounding_agent_representation']
+
+
+def pad_ragged_batch(batch: List[Dict]) -> List[Dict]:
+    """
+    Pads samples extracted in ragged mode to the maximum number of lane nodes and agents in the batch and converts
+    boolean masks and COO adjacency back to the dense representation. Goal states in s_next and node_seq_gt are
+    offset by the number of lane nodes in the sample and are moved to be offset by the padded number of nodes.
+    Masks and adjacency are kept boolean / uint8 and converted to float on the device by upcast_compact_dtypes.
+    Samples extracted in dense mode are returned as they are.
+    """
+    if not is_ragged(batch[0]):
+        return batch
+
+    # Batch maxima
+    agent_keys = [('vehicles', 'vehicle_masks'), ('pedestrians', 'pedestrian_masks'), ('objects', 'object_masks')]
+    max_nodes = max([len(element['inputs']['map_representation']['lane_node_feats']) for element in batch])
+    max_agents = {k: max([1] + [len(element['inputs']['surrounding_agent_representation'][k]) for element in batch])
+                  for k, _ in agent_keys}
+    num_agents = sum(max_agents.values()) + 1
+
+    for element in batch:
+        inputs = element['inputs']
+
+        # Lane nodes
+        map_representation = inputs['map_representation']
+        num_nodes = len(map_representation['lane_node_feats'])
+        map_representation['lane_node_feats'] = pad_rows(map_representation['lane_node_feats'], max_nodes, 0)
+        map_representation['lane_node_masks'] = pad_rows(map_representation['lane_node_masks'], max_nodes, 1)
+
+        # Lane graph, with goal states offset by the padded number of nodes
+        if 's_next' in map_representation:
+            s_next = pad_rows(map_representation['s_next'], max_nodes, 0)
+            s_next[:num_nodes, -1] += max_nodes - num_nodes
+            map_representation['s_next'] = s_next
+            map_representation['edge_type'] = pad_rows(map_representation['edge_type'], max_nodes, 0)
+            for key in ['succ', 'prox']:
+                edges = map_representation.pop(key + '_edges')
+                adj_matrix = np.zeros((max_nodes, max_nodes), dtype=np.uint8)
+                adj_matrix[edges[:, 0], edges[:, 1]] = 1
+                map_representation[key + '_adj_matrix'] = adj_matrix
+
+            node_seq_gt = inputs['node_seq_gt']
+            node_seq_gt[node_seq_gt >= num_nodes] += max_nodes - num_nodes
+            inputs['init_node'] = pad_rows(inputs['init_node'], max_nodes, 0)
+            element['ground_truth']['evf_gt'] = pad_rows(element['ground_truth']['evf_gt'], max_nodes, 0)
+
+        # Surrounding agents
+        agents = inputs['surrounding_agent_representation']
+        for k, mask_k in agent_keys:
+            agents[k] = pad_rows(agents[k], max_agents[k], 0)
+            agents[mask_k] = pad_rows(agents[mask_k], max_agents[k], 1)
+        adj_edges = agents.pop('adj_edges')
+        adj_matrix = np.zeros((num_agents, num_agents), dtype=np.uint8)
+        adj_matrix[adj_edges[:, 0], adj_edges[:, 1]] = 1
+        agents['adj_matrix'] = adj_matrix
+
+        # Agent-node masks
+        if 'agent_node_edges' in inputs:
+            agent_node_edges = inputs.pop('agent_node_edges')
+            inputs['agent_node_masks'] = {}
+            for k, edges in agent_node_edges.items():
+                agent_node_masks = np.ones((max_nodes, max_agents[k]), dtype=np.uint8)
+                agent_node_masks[edges[:, 0], edges[:, 1]] = 0
+                inputs['agent_node_masks'][k] = agent_node_masks
+
+    return batch
+
+
+def pad_rows(array: np.ndarray, num_rows: int, value) -> np.ndarray:
+    """
+    Pads the leading dimension of an array to num_rows with a constant value
+    """
+    padded = np.full((num_rows,) + array.shape[1:], value, dtype=array.dtype)
+    padded[:len(array)] = array
+    return padded
+
+
+def pop_heterograph_edges(batch: List[Dict]) -> Union[List[Dict], None]:
+    """
+    Removes heterograph edge lists stored at extraction time from the samples of a batch. Returns them if all samples
+    have them, None otherwise.
+    """
+    edge_arrays = [element['inputs'].pop('heterograph_edges', None) for element in batch]
+    return None if any([e is None for e in edge_arrays]) else edge_arrays
+
+
+def collate_ragged(batch):
+    # Collate function for dataloader. Pads samples extracted in ragged mode to the batch maxima
+    pop_heterograph_edges(batch)
+    return default_collate(pad_ragged_batch(batch))
+
+
 def collate_fn_dgl(batch): 
     # Collate function for dataloader. 
     graphs = []
@@ -105,108 +231,137 @@ def collate_fn_dgl_lanes(batch):
 
 
 class Collate_heterograph(object):
-    def __init__(self, args):
-        self.mask_frames = args['mask_frames']
-        self.agent_mask_prob_v = args['agent_mask_prob_v']
-        self.lane_mask_prob = args['lane_mask_prob'] 
-    def __call__(self,batch):
+    """
+    Collate function building a batched heterograph of lanes, vehicles and pedestrians. Edges are read from the
+    edge lists stored at extraction time, or computed with array operations over the stacked batch if lanes are masked
+    out. Node ids are offset by the node counts of the preceding samples and the batched graph is built with a single
+    dgl.heterograph call. Stochastic masking for training and robustness analysis is applied after transfer to the
+    device, see train_eval.augmentation.GraphAugmentation.
+    """
+    def __call__(self, batch):
         # Collate function for dataloader.
-        interaction_graphs = []
-        lanes_graphs = []
-        for element in batch: 
-            adj = element['inputs']['surrounding_agent_representation']['adj_matrix'] 
-            len_adj = element['inputs']['surrounding_agent_representation']['len_adj']  
-            lane_ped_adj_matrix = element['inputs']['agent_node_masks']['pedestrians'].transpose(1,0) # 84 x 164 
-            lane_node_masks = element['inputs']['map_representation']['lane_node_masks']
-            veh_mask=element['inputs']['surrounding_agent_representation']['vehicle_masks']
-            num_v = np.where(veh_mask[:,:,0]==0)[0].max()+2 if len(np.where(veh_mask[:,:,0]==0)[0])>0 else 0 # +1 to account for focal agent which is not present in veh_mask
-            
-            ### ROBUSTNESS ANALYSYS ###
-            # elements in batch which have no vehicles
-            #no_vehicles = np.sum(veh_mask[:,:,0], axis=-1) == veh_mask.shape[-1] # True where no vehicle [B,84].
-            mask_out_lanes = []
-            if 'mask_out_lanes' in element['inputs']['map_representation']:
-                mask_out_lanes = element['inputs']['map_representation']['mask_out_lanes']
-            elif self.lane_mask_prob > 0.:
-                ###### Mask out lane_node_masks by lane p% of the time - 1 means mask out
-                mask_out = np.tile(np.expand_dims((np.random.random((lane_node_masks.shape[0])) < self.lane_mask_prob), [-1,-2]), [ 1,lane_node_masks.shape[-2],lane_node_masks.shape[-1]]) 
-                lane_node_masks =  lane_node_masks.astype(int) | mask_out.astype(int)
-                # Indeces of masked out lanes
-                mask_out_lanes = np.where(mask_out[:,0,0] == True)[0]
-                element['inputs']['map_representation']['lane_node_masks'] = lane_node_masks
-                # Update with masked out lanes
-                element['inputs']['map_representation']['succ_adj_matrix'] = element['inputs']['map_representation']['succ_adj_matrix'] * (1-lane_node_masks[:,0,0])
-                element['inputs']['map_representation']['prox_adj_matrix'] = element['inputs']['map_representation']['prox_adj_matrix'] * (1-lane_node_masks[:,0,0])
-                element['inputs']['agent_node_masks']['vehicles'] = element['inputs']['agent_node_masks']['vehicles'].astype(int) | np.expand_dims((lane_node_masks[:,0,0]), -1).astype(int)
-            
-            if self.mask_frames > 0.0: 
-                target_adj_matrix = element['inputs']['surrounding_agent_representation']['adj_matrix'][0,1:veh_mask.shape[0]+1] 
-                target_adj_matrix = np.tile(np.expand_dims(target_adj_matrix,-1), [1,veh_mask.shape[-2]]) 
-                target_adj_matrix *= (np.random.random((target_adj_matrix.shape[0], target_adj_matrix.shape[1])) > self.mask_frames).astype(int)                
-                veh_mask = veh_mask.astype(int) | np.tile(np.expand_dims((1-target_adj_matrix),-1), [1,1,veh_mask.shape[-1]]).astype(int)  
-                # Mask out frames of nearby agents with a 60% probability
-                element['inputs']['surrounding_agent_representation']['vehicle_masks'] = veh_mask
-                element['inputs']['agent_node_masks']['vehicles'] = element['inputs']['agent_node_masks']['vehicles'].astype(int) | np.tile(np.expand_dims(veh_mask[:,:,0].any(-1 ),0), [164,1])  
-            #############################
-            # Update with new masked out vehicles to update the graph
-            v_nodes_mask = (veh_mask[:,:,0].sum(-1)==veh_mask.shape[-2]) == False # True where there is a vehicle
-            v_nodes = np.where(v_nodes_mask)[0] # 0 to 83
-            v_nodes = np.insert((v_nodes + np.ones((v_nodes.shape[0]))),0,0).astype(int) # 0 is the focal vehicle
-            adj_matrix_v = adj[v_nodes][:,v_nodes] 
-            veh_u, veh_v = np.nonzero(adj_matrix_v)
-            
-            # Pedestrians
-            ped_mask=element['inputs']['surrounding_agent_representation']['pedestrian_masks']
-            num_p = np.where(ped_mask[:,:,0]==0)[0].max()+1 if len(np.where(ped_mask[:,:,0]==0)[0])>0 else 0
-            ped_veh_u, ped_veh_v = np.where(adj[num_v:num_v+num_p, v_nodes] == 1)   
-            # mask those pedestrians that don't appear in the interaction graph v2
-            max_p_in_graph = ped_veh_u.max()+1 if len(ped_veh_u)>0 else 0
-            ped_mask[max_p_in_graph:,:, :] = 1
-            element['inputs']['surrounding_agent_representation']['pedestrian_masks'] =  ped_mask
-
-            # Objects 
-            # obj_mask=element['inputs']['surrounding_agent_representation']['object_masks']
-            # num_o = np.where(obj_mask[:,:,0]==0)[0].max()+1 if len(np.where(obj_mask[:,:,0]==0)[0])>0 else 0
-            # obj_veh_u, obj_veh_v = np.where(adj[num_v+num_p:num_v+num_p+num_o, v_nodes] == 1) 
-            # max_o_in_graph = obj_veh_u.max()+1 if len(obj_veh_u)>0 else 0 
-            # obj_mask[max_o_in_graph:,:, :] = 1
-            # element['inputs']['surrounding_agent_representation']['object_masks'] =  obj_mask 
-
-            # Lane graph 
-            lane_veh_adj_matrix = element['inputs']['agent_node_masks']['vehicles'].transpose(1,0) 
-            # Remove masked lanes
-            lane_veh_adj_matrix = np.delete(lane_veh_adj_matrix, mask_out_lanes, 1)
-            # To keep the indexing consistent, we set to 0 the edge type of masked out lanes, i.e. no edge.
-            if len(mask_out_lanes) > 0:
-                for lane in mask_out_lanes:
-                    element['inputs']['map_representation']['edge_type'] = np.where( element['inputs']['map_representation']['s_next'] == lane, 0, element['inputs']['map_representation']['edge_type'])
-            element['inputs']['map_representation']['s_next'][mask_out_lanes] = 0
-            # Update with new masked out vehicles 
-            lane_veh_adj_matrix = lane_veh_adj_matrix[v_nodes_mask] #num_nbr_vehicles x 164
-            # create a mask for the lanes that are not empty
-            lane_mask = np.delete( (~(lane_node_masks[:,:,0]!=0)).any(-1),  mask_out_lanes) # 164
-            # Add row of zeros to the adjacency matrix to account for the focal vehicle
-            lane_veh_adj_matrix = np.vstack((~lane_mask*1, lane_veh_adj_matrix)) # num_veh x 164
-            veh_lane_u, veh_lane_v = np.where(lane_veh_adj_matrix==0)  
-            succ_adj_matrix = np.delete( np.delete( element['inputs']['map_representation']['succ_adj_matrix'], mask_out_lanes, 1), mask_out_lanes, 0)
-            prox_adj_matrix = np.delete( np.delete( element['inputs']['map_representation']['prox_adj_matrix'], mask_out_lanes, 1), mask_out_lanes, 0)
-            succ_u, succ_v = np.nonzero(succ_adj_matrix)[0], np.nonzero(succ_adj_matrix)[1] 
-            prox_u, prox_v = np.nonzero(prox_adj_matrix) 
-
-            # Create heterogeneous graph  
-            lanes_graphs.append(dgl.heterograph({
-                ('l','successor','l'): (torch.tensor(succ_u, dtype=torch.int), torch.tensor(succ_v, dtype=torch.int)),
-                ('l','proximal','l'):  (torch.tensor(prox_u, dtype=torch.int), torch.tensor(prox_v, dtype=torch.int)),
-                ('v', 'v_close_l','l'): (torch.tensor(veh_lane_u, dtype=torch.int), torch.tensor(veh_lane_v, dtype=torch.int)),
-                ('v', 'v_interact_v','v'): (torch.tensor(veh_u, dtype=torch.int), torch.tensor(veh_v, dtype=torch.int)),  
-                ('p', 'p_interact_v','v'): (torch.tensor(ped_veh_u, dtype=torch.int), torch.tensor(ped_veh_v, dtype=torch.int)),  
-                #('o', 'o_interact_v','v'): (torch.tensor(obj_veh_u, dtype=torch.int), torch.tensor(obj_veh_v, dtype=torch.int)),
-            }) )
-
-            assert len(np.nonzero(veh_mask[:,:,0].sum(-1)<5)[0])+1 == lanes_graphs[-1].num_nodes('v') 
-
-        lanes_batched_graph = dgl.batch(lanes_graphs)  
+        edge_arrays = pop_heterograph_edges(batch)
+        batch = pad_ragged_batch(batch)
+        batch_size = len(batch)
+        agents = [element['inputs']['surrounding_agent_representation'] for element in batch]
+
+        # Use edges stored at extraction time unless lanes are masked out
+        lane_keep = None
+        if edge_arrays is not None and not any(['mask_out_lanes' in element['inputs']['map_representation'] for element in batch]):
+            edges = hg.from_edge_arrays(edge_arrays)
+        else:
+            edges, lane_keep = self.get_edges(batch)
+
+        # mask those pedestrians that don't appear in the interaction graph v2
+        b, u, _ = edges[('p', 'p_interact_v', 'v')]
+        max_p_in_graph = np.zeros(batch_size, dtype=int)
+        np.maximum.at(max_p_in_graph, b, u + 1)
+        for agent, max_p in zip(agents, max_p_in_graph):
+            agent['pedestrian_masks'][max_p:, :, :] = 1
+
+        lanes_batched_graph = self.build_batched_graph(edges, batch_size)
+        veh_mask = np.stack([agent['vehicle_masks'][:, :, 0] for agent in agents])
+        assert np.all((veh_mask.sum(-1) < 5).sum(-1) + 1 == lanes_batched_graph.batch_num_nodes('v').numpy())
+
         data = default_collate(batch) 
         data['inputs']['lanes_graphs'] = lanes_batched_graph
+        data['inputs']['sequence_plans'] = self.get_sequence_plans(data['inputs'])
+
+        # Lanes kept in the lane graph, for mapping lane nodes back to lanes if some have been masked out
+        if lane_keep is not None and not lane_keep.all():
+            data['inputs']['map_representation']['lane_keep'] = torch.as_tensor(lane_keep)
+
+        return data
+
+    @staticmethod
+    def get_sequence_plans(inputs: Dict) -> Dict:
+        """
+        Computes sequence plans for encoding lane nodes, vehicles and pedestrians on the host, so that the encoder
+        selects and packs sequences without synchronizing with the host. See models.sequence_encoding.
+        :param inputs: collated model inputs
+        """
+        agents = inputs['surrounding_agent_representation']
+        return {'lanes': get_sequence_plan(inputs['map_representation']['lane_node_masks'][:, :, :, 0]),
+                'vehicles': get_sequence_plan(agents['vehicle_masks'][:, :, :, 0]),
+                'pedestrians': get_sequence_plan(agents['pedestrian_masks'][:, :, :, 0])}
+
+    def get_edges(self, batch: List[Dict]) -> Tuple[Dict, np.ndarray]:
+        """
+        Applies lane masking to the samples of a batch and computes heterograph edges from the dense adjacency
+        matrices and masks
+        :param batch: padded samples
+        :return: dict with (batch index, source ids, destination ids) for each canonical edge type, and mask of lanes
+            kept in the lane graph, shape [batch_size, max_nodes]
+        """
+        agents = [element['inputs']['surrounding_agent_representation'] for element in batch]
+        map_reps = [element['inputs']['map_representation'] for element in batch]
+
+        # Lanes to keep, False for masked out lanes
+        lane_keep = np.stack([self.mask_out(element) for element in batch])
+
+        edges = hg.get_heterograph_edges(
+            np.stack([agent['adj_matrix'] for agent in agents]),
+            np.stack([agent['vehicle_masks'][:, :, 0] for agent in agents]),
+            np.stack([agent['pedestrian_masks'][:, :, 0] for agent in agents]),
+            np.stack([map_rep['lane_node_masks'][:, :, 0] for map_rep in map_reps]),
+            np.stack([element['inputs']['agent_node_masks']['vehicles'].transpose(1, 0) for element in batch]),
+            np.stack([map_rep['succ_adj_matrix'] for map_rep in map_reps]),
+            np.stack([map_rep['prox_adj_matrix'] for map_rep in map_reps]),
+            lane_keep)
+
+        return edges, lane_keep
+
+    @staticmethod
+    def mask_out(element: Dict) -> np.ndarray:
+        """
+        Masks out lanes listed in the sample's 'mask_out_lanes', e.g. set by the visualizer for robustness analysis.
+        Stochastic lane, vehicle and frame masking is applied on the device by GraphAugmentation.
+        Updates the sample in place.
+        :param element: sample
+        :return: mask of lanes to keep in the lane graph, False for masked out lanes
+        """
+        mask_out_lanes = []
+        if 'mask_out_lanes' in element['inputs']['map_representation']:
+            mask_out_lanes = element['inputs']['map_representation']['mask_out_lanes']
+
+        # To keep the indexing consistent, we set to 0 the edge type of masked out lanes, i.e. no edge.
+        if len(mask_out_lanes) > 0:
+            for lane in mask_out_lanes:
+                element['inputs']['map_representation']['edge_type'] = np.where( element['inputs']['map_representation']['s_next'] == lane, 0, element['inputs']['map_representation']['edge_type'])
+        element['inputs']['map_representation']['s_next'][mask_out_lanes] = 0
+
+        lane_keep = np.ones(element['inputs']['map_representation']['lane_node_masks'].shape[0], dtype=bool)
+        lane_keep[mask_out_lanes] = False
+        return lane_keep
+
+    def build_batched_graph(self, edges: Dict, batch_size: int) -> dgl.DGLGraph:
+        """
+        Builds batched heterograph from the edges of all samples in a single call. Number of nodes of each type in a
+        sample is inferred as max node id + 1 over the sample's edges, as in dgl.heterograph.
+        :param edges: dict with (batch index, source ids, destination ids) for each canonical edge type
+        :param batch_size: number of samples
+        """
+        # Number of nodes of each type in each sample
+        num_nodes = {ntype: np.zeros(batch_size, dtype=int) for ntype in ['l', 'v', 'p']}
+        for (src_type, _, dst_type), (b, u, v) in edges.items():
+            np.maximum.at(num_nodes[src_type], b, u + 1)
+            np.maximum.at(num_nodes[dst_type], b, v + 1)
+        node_offsets = {ntype: np.cumsum(counts) - counts for ntype, counts in num_nodes.items()}
+
+        # Offset node ids by number of nodes in preceding samples
+        data_dict = {}
+        num_edges = {}
+        for etype in hg.etypes:
+            src_type, _, dst_type = etype
+            b, u, v = edges[etype]
+            data_dict[etype] = (torch.as_tensor(u + node_offsets[src_type][b], dtype=torch.int),
+                                torch.as_tensor(v + node_offsets[dst_type][b], dtype=torch.int))
+            num_edges[etype] = torch.as_tensor(np.bincount(b, minlength=batch_size), dtype=torch.int)
+
+        graph = dgl.heterograph(data_dict, num_nodes_dict={ntype: int(counts.sum())
+                                                           for ntype, counts in num_nodes.items()})
+        graph.set_batch_num_nodes({ntype: torch.as_tensor(counts, dtype=torch.int)
+                                   for ntype, counts in num_nodes.items()})
+        graph.set_batch_num_edges(num_edges)
 
-        return data
\ No newline at end of file
+        return graph
\ No newline at end of file
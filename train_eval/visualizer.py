@@ -5,7 +5,7 @@ from matplotlib.lines import Line2D
 from matplotlib.patches import Patch
 from typing import Dict, List
 from train_eval.initialization import initialize_prediction_model, initialize_dataset, get_specific_args
-from nuscenes.eval.prediction.splits import get_prediction_challenge_split
+from datasets.nuScenes.split_index import SplitIndex
 from nuscenes.prediction.input_representation.static_layers_original import StaticLayerRasterizer, color_by_yaw
 from nuscenes.prediction.input_representation.agents import AgentBoxesWithFadedHistory
 from nuscenes.prediction.input_representation.interface_original import InputRepresentation
@@ -13,6 +13,7 @@ from nuscenes.prediction.input_representation.combinators import Rasterizer
 from nuscenes.prediction.helper import convert_local_coords_to_global, convert_global_coords_to_local
 import train_eval.utils as u
 from train_eval.utils import Collate_heterograph
+from train_eval.augmentation import GraphAugmentation
 import imageio
 import os 
 import scipy.sparse as spp
@@ -57,12 +58,14 @@ class Visualizer:
 
         # Initialize dataset
         ds_type = cfg['dataset'] + '_' + cfg['agent_setting'] + '_' + cfg['input_representation']
-        spec_args = get_specific_args(cfg['dataset'], data_root, cfg['version'] if 'version' in cfg.keys() else None)
+        spec_args = get_specific_args(cfg['dataset'], data_root, cfg['version'] if 'version' in cfg.keys() else None,
+                                      lazy=True)
         test_set = initialize_dataset(ds_type, ['load_data', data_dir, cfg['test_set_args']] + spec_args[0])
         self.ds = test_set
         self.encoder_type = cfg['encoder_type']
         if 'scout' in cfg['encoder_type']:
-            self.collate_fn = Collate_heterograph(cfg['encoder_args'])
+            self.collate_fn = Collate_heterograph()
+            self.augmentation = GraphAugmentation(cfg['encoder_args'], device)
         self.lane_mask_prob = cfg['encoder_args']['lane_mask_prob']
         self.agent_mask_prob_v = cfg['encoder_args']['agent_mask_prob_v']
         self.mask_frames = cfg['encoder_args']['mask_frames']
@@ -146,19 +149,21 @@ class Visualizer:
         Returns list of list of indices for generating gifs for the nuScenes val set.
         Instance tokens are hardcoded right now. I'll fix this later (TODO)
         """
-        token_list = get_prediction_challenge_split('val', dataroot=self.ds.helper.data.dataroot)
-        instance_tokens = [token_list[idx].split("_")[0] for idx in range(len(token_list))]
-        unique_instance_tokens = []
-        for i_t in instance_tokens:
-            if i_t not in unique_instance_tokens:
-                unique_instance_tokens.append(i_t)
+        # Group tokens by instance, from the split index if it has been built, in memory otherwise
+        if self.ds.index is not None:
+            offsets = self.ds.index.arrays['instance_offsets']
+            token_idcs = self.ds.index.arrays['instance_idcs']
+        else:
+            print('No split index found in ' + self.ds.data_dir + ', grouping tokens in memory. '
+                  'Re-run preprocess.py to build it.')
+            _, offsets, token_idcs = SplitIndex.group([token.split("_")[0] for token in self.ds.token_list])
 
         instance_tokens_to_visualize = [54, 98, 91, 5, 114, 144, 291, 204, 312, 187, 36, 267, 146,
                                         56,82,89,93,109,111,113,127,166,104]
 
         idcs = []
         for i_t_id in instance_tokens_to_visualize:
-            idcs_i_t = [i for i in range(len(instance_tokens)) if instance_tokens[i] == unique_instance_tokens[i_t_id]]
+            idcs_i_t = np.asarray(token_idcs[offsets[i_t_id]:offsets[i_t_id + 1]]).tolist()
             idcs.append(idcs_i_t)
 
         return idcs
@@ -278,7 +283,7 @@ class Visualizer:
         vehicle_masked_t = []
         for idx in idcs: 
             # Load data
-            data = self.ds[idx]
+            data = u.upcast_compact_dtypes(u.pad_ragged_batch([self.ds[idx]])[0])
             i_t = data['inputs']['instance_token']
             s_t = data['inputs']['sample_token']
             annotations = self.ds.helper.get_annotations_for_sample(s_t)
@@ -501,7 +506,9 @@ class Visualizer:
             # Predict             
             if 'scout' in self.encoder_type:
                 data = self.collate_fn([data])
-            data = u.send_to_device(u.convert_double_to_float(u.convert2tensors(data)))
+            data = u.upcast_compact_dtypes(u.send_to_device(u.convert_double_to_float(u.convert2tensors(data))))
+            if 'scout' in self.encoder_type:
+                data['inputs'] = self.augmentation(data['inputs'])
             data['inputs']['att'] = True 
             predictions = self.model(data['inputs'])
             predictions['probs'][0], probs_ord_idcs = predictions['probs'].sort( dim=1, descending=True) 